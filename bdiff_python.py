@@ -1,11 +1,234 @@
 #!/usr/bin/python3
-# perform a bdiff on two python files
-
+# perform a bdiff on two python files, or on two trees of python files
+# ./bdiff_python.py before.py after.py                 prints the delta, exits with its length
+# ./bdiff_python.py before/ after/ [--json] [--diff]   compares the python files of two directories
+# ./bdiff_python.py --rev BASE [--rev OTHER] [REPO]    compares two git revisions, or a revision and the working tree
+# in tree mode, files with identical bytes are skipped, the others are fingerprinted in a process pool
+# (stockholm_diff.definition_fingerprints), cached by content hash in .bdiff-cache.sqlite,
+# and the exit status is 1 if any file changed behavior
+import ast
+import concurrent.futures
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
 import sys
+
+import click
+
 from stockholm_diff import *
 
-delta = diff_python(open(sys.argv[1]).read(), open(sys.argv[2]).read())
-for i in delta:
-    print(i,file=sys. stderr)
-    
-sys.exit(len(delta))
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.bdiff-cache.sqlite')
+# part of the cache keys, to change when definition_fingerprints changes
+FINGERPRINT_VERSION = '1'
+
+
+def directory_files(root):
+    """Return {path relative to root: None} of the python files of a directory, None meaning read from disk"""
+    files = {}
+    for directory, dirs, names in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+        for name in names:
+            if name.endswith('.py'):
+                files[os.path.relpath(os.path.join(directory, name), root)] = None
+    return files
+
+
+def git(repo, *args, input=None):
+    return subprocess.run(['git', '-C', repo] + list(args), input=input, capture_output=True, check=True).stdout
+
+
+def git_files(repo, rev):
+    """Return {path: blob id} of the python files of a revision"""
+    files = {}
+    for entry in git(repo, 'ls-tree', '-r', '-z', '--full-tree', rev).split(b'\0'):
+        if entry:
+            meta, path = entry.split(b'\t', 1)
+            path = path.decode('utf8')
+            if path.endswith('.py') and meta.split()[1] == b'blob':
+                files[path] = meta.split()[2].decode()
+    return files
+
+
+def worktree_files(repo):
+    """Return {path: None} of the python files of the working tree, tracked or not ignored"""
+    output = git(repo, 'ls-files', '-z', '--cached', '--others', '--exclude-standard')
+    return {path: None for path in output.decode('utf8').split('\0') if path.endswith('.py') and os.path.exists(os.path.join(repo, path))}
+
+
+def git_blobs(repo, blob_ids):
+    """Return {blob id: bytes}, read by a single git cat-file process"""
+    blob_ids = sorted(set(blob_ids))
+    output = git(repo, 'cat-file', '--batch', input=''.join(b + '\n' for b in blob_ids).encode())
+    blobs = {}
+    position = 0
+    for blob_id in blob_ids:
+        header_end = output.index(b'\n', position)
+        size = int(output[position:header_end].split()[2])
+        blobs[blob_id] = output[header_end + 1:header_end + 1 + size]
+        position = header_end + 1 + size + 1
+    return blobs
+
+
+def fingerprint_source(source):
+    """Worker: return the definition fingerprints of a python source, or the error message if it does not parse"""
+    try:
+        return definition_fingerprints(ast.parse(source))
+    except (SyntaxError, ValueError) as e:
+        return str(e)
+
+
+def text_diff(pair):
+    """Worker: return the unified behavioral diff of a (before, after) pair of sources"""
+    return diff_python(pair[0].decode('utf8', 'replace'), pair[1].decode('utf8', 'replace'))
+
+
+class FingerprintCache:
+    """SQLite store of the fingerprints of python sources, by content hash"""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS fingerprints (key TEXT PRIMARY KEY, fingerprints TEXT)')
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(keys)
+        # within the SQLite limit of variables per query
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = 'SELECT key, fingerprints FROM fingerprints WHERE key IN (%s)' % ','.join('?' * len(chunk))
+            found.update((key, json.loads(value)) for key, value in self._db.execute(query, chunk))
+        return found
+
+    def put_many(self, items):
+        self._db.executemany('INSERT OR REPLACE INTO fingerprints VALUES (?, ?)', [(key, json.dumps(value)) for key, value in items])
+        self._db.commit()
+
+
+def compare_trees(before, after, read_before, read_after, jobs=None, cache=None, with_diff=False):
+    """Return the report of the behavioral differences between two trees {path: blob id or None}.
+    read_before/read_after map the paths needing their content to {path: bytes}."""
+    report = []
+    pending = []
+    for path in sorted(set(before) | set(after)):
+        if path not in before:
+            report.append({'path': path, 'status': 'added'})
+        elif path not in after:
+            report.append({'path': path, 'status': 'removed'})
+        elif before[path] is not None and before[path] == after[path]:
+            # same git blob, the bytes are not even read
+            report.append({'path': path, 'status': 'identical'})
+        else:
+            pending.append(path)
+    before_sources = read_before(pending)
+    after_sources = read_after(pending)
+    changed = []
+    for path in pending:
+        if before_sources[path] == after_sources[path]:
+            report.append({'path': path, 'status': 'identical'})
+        else:
+            changed.append(path)
+
+    # fingerprint each distinct content once, from the cache or in the pool
+    key = lambda source: hashlib.sha256(source).hexdigest() + '-' + FINGERPRINT_VERSION
+    sources = {key(s): s for path in changed for s in (before_sources[path], after_sources[path])}
+    fingerprints = cache.get_many(sources) if cache is not None else {}
+    missing = [k for k in sources if k not in fingerprints]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        computed = dict(zip(missing, pool.map(fingerprint_source, [sources[k] for k in missing], chunksize=8)))
+        fingerprints.update(computed)
+        if cache is not None:
+            cache.put_many((k, v) for k, v in computed.items() if not isinstance(v, str))
+
+        differing = []
+        for path in changed:
+            old = fingerprints[key(before_sources[path])]
+            new = fingerprints[key(after_sources[path])]
+            if isinstance(old, str) or isinstance(new, str):
+                report.append({'path': path, 'status': 'error', 'error': old if isinstance(old, str) else new})
+            elif old[MODULE][0] == new[MODULE][0]:
+                report.append({'path': path, 'status': 'equivalent'})
+            else:
+                report.append({'path': path, 'status': 'changed', 'delta': definitions_delta(old, new)})
+                differing.append(report[-1])
+        if with_diff:
+            # the text diffs are only computed when asked for
+            diffs = pool.map(text_diff, [(before_sources[e['path']], after_sources[e['path']]) for e in differing])
+            for entry, diff in zip(differing, diffs):
+                entry['diff'] = diff
+    return sorted(report, key=lambda e: e['path'])
+
+
+def read_directory(root):
+    def read(paths):
+        sources = {}
+        for path in paths:
+            with open(os.path.join(root, path), 'rb') as f:
+                sources[path] = f.read()
+        return sources
+    return read
+
+
+def read_revision(repo, files):
+    def read(paths):
+        blobs = git_blobs(repo, [files[path] for path in paths])
+        return {path: blobs[files[path]] for path in paths}
+    return read
+
+
+@click.command()
+@click.argument('paths', nargs=-1)
+@click.option('--rev', 'revs', multiple=True, help='Git revision to compare, twice to compare two revisions, once to compare with the working tree')
+@click.option('--json', 'as_json', is_flag=True, help='Print a JSON report')
+@click.option('--diff', 'with_diff', is_flag=True, help='Include the unified diff of the files that changed behavior')
+@click.option('--jobs', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+@click.option('--no-cache', is_flag=True, help=f'Do not use the fingerprint cache {CACHE_PATH}')
+def main(paths, revs, as_json, with_diff, jobs, no_cache):
+    if not revs and len(paths) == 2 and os.path.isfile(paths[0]) and os.path.isfile(paths[1]):
+        # two files, as always
+        delta = diff_python(open(paths[0]).read(), open(paths[1]).read())
+        for i in delta:
+            print(i, file=sys.stderr)
+        sys.exit(len(delta))
+
+    if revs:
+        if len(revs) > 2 or len(paths) > 1:
+            raise click.UsageError('--rev BASE [--rev OTHER] [REPO]')
+        repo = git(paths[0] if paths else '.', 'rev-parse', '--show-toplevel').decode().strip()
+        before = git_files(repo, revs[0])
+        read_before = read_revision(repo, before)
+        if len(revs) == 2:
+            after = git_files(repo, revs[1])
+            read_after = read_revision(repo, after)
+        else:
+            after = worktree_files(repo)
+            read_after = read_directory(repo)
+    elif len(paths) == 2 and os.path.isdir(paths[0]) and os.path.isdir(paths[1]):
+        before, after = directory_files(paths[0]), directory_files(paths[1])
+        read_before, read_after = read_directory(paths[0]), read_directory(paths[1])
+    else:
+        raise click.UsageError('bdiff_python.py <before.py> <after.py> | <before-dir> <after-dir> | --rev BASE [--rev OTHER] [REPO]')
+
+    cache = None if no_cache else FingerprintCache(CACHE_PATH)
+    report = compare_trees(before, after, read_before, read_after, jobs, cache, with_diff)
+    summary = {}
+    for entry in report:
+        summary[entry['status']] = summary.get(entry['status'], 0) + 1
+    if as_json:
+        print(json.dumps({'summary': summary, 'files': report}, indent=2))
+    else:
+        for entry in report:
+            if entry['status'] in ('identical', 'equivalent'):
+                continue
+            details = format_delta(entry['delta']) if 'delta' in entry else entry.get('error', '')
+            print(f"{entry['status']} {entry['path']} {details}".rstrip())
+            for line in entry.get('diff', []):
+                print(line)
+        print(', '.join(f'{n} {status}' for status, n in sorted(summary.items())), file=sys.stderr)
+    sys.exit(1 if any(entry['status'] not in ('identical', 'equivalent') for entry in report) else 0)
+
+
+if __name__ == '__main__':
+    main()
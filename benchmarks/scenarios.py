@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+# end-to-end throughput and latency benchmarks against benchmarks/stub_server.py, offline and free
+# each scenario drives a real code path (ellm.get_llm_answer, get_llm_answers, streaming, llm.start_prompt, transform.py)
+# with the base URLs of the providers pointing at a stub server started in a subprocess,
+# and reports the p50/p95/p99 latency of the requests, requests/s and completion tokens/s
+# ./benchmarks/scenarios.py [SCENARIO...] [--requests 64] [--concurrency 8] [--latency 0.05] [--save base.json] [--compare base.json]
+# with --compare, exits with the number of scenarios slower than the baseline beyond the tolerance, so it can gate a regression
+import contextlib
+import io
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ellm
+import providers
+import stub_server
+import tokens
+
+SCENARIOS = {}
+
+
+def scenario(name, **behaviour):
+    """Register a scenario, run with the given stub behaviour on top of the command line one"""
+    def register(function):
+        SCENARIOS[name] = (function, behaviour)
+        return function
+    return register
+
+
+class Recorder:
+    """Latencies, time to first token, completion tokens and errors of the requests of a scenario"""
+
+    def __init__(self):
+        self.latencies = []
+        self.first_tokens = []
+        self.tokens = 0
+        self.errors = 0
+
+    def timed(self, function):
+        """Wrap an answering function, a failed request counts as an error and is raised to the caller"""
+        def timed_function(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                answer = function(*args, **kwargs)
+            except Exception:
+                self.errors += 1
+                raise
+            self.latencies.append(time.monotonic() - start)
+            self.tokens += tokens.count_tokens(answer or '')
+            return answer
+        return timed_function
+
+
+@contextlib.contextmanager
+def timed_answers(recorder):
+    """Time every ellm.get_llm_answer, including those of the batches, which look it up at each request"""
+    original = ellm.get_llm_answer
+    ellm.get_llm_answer = recorder.timed(original)
+    try:
+        yield
+    finally:
+        ellm.get_llm_answer = original
+
+
+def prompts(options):
+    return [f'benchmark prompt {i}: write a function computing the fibonacci numbers' for i in range(options['requests'])]
+
+
+@scenario('answer')
+def sequential_answers(recorder, options):
+    """ellm.get_llm_answer one after the other"""
+    ellm.get_config()['provider'] = 'openai'
+    with timed_answers(recorder):
+        for prompt in prompts(options):
+            try:
+                ellm.get_llm_answer(prompt, use_cache=False)
+            except Exception:
+                pass
+
+
+def batch(recorder, options, provider):
+    ellm.get_config()['provider'] = provider
+    # the failed requests are counted by the recorder, not printed
+    with timed_answers(recorder), contextlib.redirect_stderr(io.StringIO()):
+        ellm.get_llm_answers(prompts(options), concurrency=options['concurrency'], use_cache=False, errors='none')
+
+
+@scenario('batch-openai')
+def batch_openai(recorder, options):
+    """ellm.get_llm_answers, concurrent requests to the OpenAI API"""
+    batch(recorder, options, 'openai')
+
+
+@scenario('batch-anthropic')
+def batch_anthropic(recorder, options):
+    batch(recorder, options, 'anthropic')
+
+
+@scenario('batch-vertex')
+def batch_vertex(recorder, options):
+    batch(recorder, options, 'google')
+
+
+@scenario('batch-429', **{'rate-limit-rate': 0.2})
+def batch_rate_limited(recorder, options):
+    """20% of the requests are answered 429 and retried by the ratelimit scheduler"""
+    batch(recorder, options, 'openai')
+
+
+@scenario('batch-errors', **{'error-rate': 0.05})
+def batch_errors(recorder, options):
+    batch(recorder, options, 'openai')
+
+
+def stream(recorder, options, provider):
+    """Sequential streamed answers, with the time to first token"""
+    backend = providers.get_provider(provider, ellm.get_config())
+    for prompt in prompts(options):
+        start = time.monotonic()
+        first = None
+        text = ''
+        try:
+            for delta in backend.stream([{'role': 'user', 'content': prompt}], max_tokens=100):
+                if first is None:
+                    first = time.monotonic() - start
+                text += delta
+        except Exception:
+            recorder.errors += 1
+            continue
+        recorder.latencies.append(time.monotonic() - start)
+        recorder.first_tokens.append(first or 0)
+        recorder.tokens += tokens.count_tokens(text)
+
+
+@scenario('stream-openai', **{'token-time': 0.002})
+def stream_openai(recorder, options):
+    stream(recorder, options, 'openai')
+
+
+@scenario('stream-anthropic', **{'token-time': 0.002})
+def stream_anthropic(recorder, options):
+    stream(recorder, options, 'anthropic')
+
+
+@scenario('chat', **{'token-time': 0.002})
+def chat(recorder, options):
+    """Turns of llm.py (llm.start_prompt), streamed and rendered to an off-screen console"""
+    import llm
+    import session_log
+    from rich.console import Console
+
+    class Session:
+        def __init__(self):
+            self.turn = 0
+
+        def prompt(self, *args, **kwargs):
+            self.turn += 1
+            return f'turn {self.turn}: explain the fibonacci numbers'
+
+    config = dict(ellm.get_config(), model='gpt-4o-mini', stream=True, temperature=0, max_tokens=100, markdown=True)
+    config['context-policy'] = 'sliding-window'
+    directory = tempfile.mkdtemp(prefix='bench-chat-')
+    llm.console = Console(file=io.StringIO(), width=100)
+    llm.log = session_log.SessionLog(os.path.join(directory, 'session.jsonl'), config['model'], 'never')
+    llm.messages.clear()
+    session = Session()
+    try:
+        for _ in range(min(options['requests'], 20)):
+            start = time.monotonic()
+            completion_tokens = llm.completion_tokens
+            llm.start_prompt(session, config)
+            recorder.latencies.append(time.monotonic() - start)
+            recorder.tokens += llm.completion_tokens - completion_tokens
+    finally:
+        llm.log.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@scenario('comment')
+def comment_files(recorder, options):
+    """transform.py comment on copies of the python files of this repository, chunked and verified"""
+    import asyncio
+    import transform
+    ellm.get_config()['provider'] = 'openai'
+    directory = tempfile.mkdtemp(prefix='bench-comment-')
+    try:
+        files = []
+        for name in sorted(os.listdir(ROOT))[:40]:
+            if name.endswith('.py'):
+                shutil.copy(os.path.join(ROOT, name), directory)
+                files.append(os.path.join(directory, name))
+        transform_options = {'in_place': False, 'suffix': '.commented', 'print': False, 'instruction': None}
+        with timed_answers(recorder), contextlib.redirect_stderr(io.StringIO()):
+            asyncio.run(transform.transform(files, transform.plan_comment, transform_options, concurrency=options['concurrency']))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def metrics(recorder, wall):
+    ms = lambda seconds: None if seconds is None else round(seconds * 1000, 1)
+    result = {'requests': len(recorder.latencies), 'errors': recorder.errors,
+              'p50_ms': ms(percentile(recorder.latencies, 50)), 'p95_ms': ms(percentile(recorder.latencies, 95)), 'p99_ms': ms(percentile(recorder.latencies, 99)),
+              'requests_per_s': round(len(recorder.latencies) / wall, 1), 'tokens_per_s': round(recorder.tokens / wall, 1), 'wall_s': round(wall, 3)}
+    if recorder.first_tokens:
+        result['first_token_p50_ms'] = ms(percentile(recorder.first_tokens, 50))
+    return result
+
+
+def start_stub(behaviour):
+    """Start benchmarks/stub_server.py in a subprocess, so that it does not share the GIL with the code measured"""
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'stub_server.py'), '--port', '0'], stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().split()[-1]
+    requests.post(url.rsplit('/v1', 1)[0] + '/_stub/config', json=behaviour).raise_for_status()
+    return process, url
+
+
+def client_config(url, concurrency):
+    """The config.yaml of the code measured: every provider on the stub, no cache, no ledger, no router"""
+    return {'provider': 'openai', 'api-key': 'stub', 'model': 'gpt-4o-mini', 'anthropic-key': 'stub',
+            'openai-base-url': url, 'anthropic-base-url': url, 'vertex-base-url': url, 'vertex-auth': False,
+            'cache': False, 'usage-ledger': False, 'batch-concurrency': concurrency, 'http-pool-size': max(10, concurrency)}
+
+
+def regressions(results, baseline, tolerance):
+    """Return the scenarios whose p95 latency or throughput got worse than the baseline by more than tolerance"""
+    slower = []
+    for name, base in baseline.items():
+        result = results.get(name)
+        if result is None or not result['requests'] or not base['requests']:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance) or result['requests_per_s'] < base['requests_per_s'] * (1 - tolerance):
+            slower.append(name)
+    return slower
+
+
+@click.command()
+@click.argument('names', nargs=-1)
+@click.option('--requests', 'count', type=int, default=64, show_default=True, help='Requests per scenario')
+@click.option('--concurrency', type=int, default=8, show_default=True, help='Requests in flight in the batch scenarios')
+@click.option('--latency', type=float, default=0.05, show_default=True, help='Latency of the stub in seconds')
+@click.option('--token-time', type=float, default=0.0, show_default=True, help='Seconds per completion token of the stub')
+@click.option('--save', type=click.Path(), default=None, help='Write the results as JSON, eg as the baseline')
+@click.option('--compare', type=click.Path(exists=True), default=None, help='Baseline JSON to compare with')
+@click.option('--tolerance', type=float, default=0.2, show_default=True, help='Allowed degradation relative to the baseline')
+def main(names, count, concurrency, latency, token_time, save, compare, tolerance):
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise click.UsageError(f'unknown scenarios {", ".join(unknown)}, known: {", ".join(SCENARIOS)}')
+    base_behaviour = {'latency': latency, 'token-time': token_time, 'jitter': latency / 2}
+    process, url = start_stub(base_behaviour)
+    stub_config = url.rsplit('/v1', 1)[0] + '/_stub/config'
+    ellm._config = client_config(url, concurrency)
+    options = {'requests': count, 'concurrency': concurrency}
+    results = {}
+    try:
+        for name in names or SCENARIOS:
+            function, behaviour = SCENARIOS[name]
+            # from the defaults, the stub keeps the changes of the previous scenario otherwise
+            requests.post(stub_config, json={**stub_server.DEFAULTS, **base_behaviour, **behaviour}).raise_for_status()
+            recorder = Recorder()
+            start = time.monotonic()
+            function(recorder, options)
+            results[name] = metrics(recorder, time.monotonic() - start)
+            r = results[name]
+            first_token = f", first token p50 {r['first_token_p50_ms']}ms" if 'first_token_p50_ms' in r else ''
+            print(f"{name:16} {r['requests']:4} requests {r['errors']:3} errors  p50 {r['p50_ms']}ms p95 {r['p95_ms']}ms p99 {r['p99_ms']}ms  "
+                  f"{r['requests_per_s']} req/s {r['tokens_per_s']} tok/s{first_token}")
+    finally:
+        process.terminate()
+        process.wait()
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if compare:
+        with open(compare) as f:
+            slower = regressions(results, json.load(f), tolerance)
+        for name in slower:
+            print(f'{name}: REGRESSION against {compare}')
+        sys.exit(len(slower))
+
+
+if __name__ == '__main__':
+    main()
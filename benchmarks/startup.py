@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# cold-start benchmark of the library modules
+# runs `python -X importtime -c "import <module>"` in fresh interpreters and checks the median against a budget
+# ./benchmarks/startup.py [module ...]
+# exits with the number of modules over budget, so it can gate a regression
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 7
+# milliseconds of cumulative import time, about 3x the measured median (ellm ~15ms, stockholm_diff ~5ms)
+BUDGET_MS = {
+    'ellm': 60,
+    'stockholm_diff': 40,
+}
+
+
+def import_time_ms(module):
+    """Return the cumulative import time of module in a fresh interpreter, in milliseconds"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+    # import time: self [us] | cumulative | imported package
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S+)$', line)
+        if match and match.group(2) == module:
+            return int(match.group(1)) / 1000
+    raise Exception('no import time for ' + module)
+
+
+def slowest_imports(module, n=10):
+    """Return the n slowest direct and indirect imports of module, to see what to make lazy"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (.*)$', line)
+        if match:
+            rows.append((int(match.group(1)) / 1000, match.group(3).strip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+def main(modules):
+    over_budget = 0
+    for module in modules:
+        median = statistics.median(import_time_ms(module) for _ in range(RUNS))
+        budget = BUDGET_MS.get(module)
+        status = '' if budget is None else ('ok' if median <= budget else 'OVER BUDGET')
+        print(f'{module}: {median:.1f}ms (budget {budget}ms) {status}')
+        if budget is not None and median > budget:
+            over_budget += 1
+            for self_ms, name in slowest_imports(module):
+                print(f'    {self_ms:8.1f}ms {name}')
+    return over_budget
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:] or list(BUDGET_MS)))
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# local HTTP stub of the OpenAI, Anthropic and Vertex AI endpoints, to benchmark without spending money
+# the latency, streaming pace, errors and 429s are configurable, at start or per scenario with POST /_stub/config
+# an answer echoes the first ```python block of the prompt, so that the rewriting scripts accept it, otherwise it is words
+# ./benchmarks/stub_server.py [--port 8000] [--latency 0.2] [--rate-limit-rate 0.1] ...
+# then set openai-base-url: http://127.0.0.1:8000/v1, anthropic-base-url: http://127.0.0.1:8000/v1,
+# vertex-base-url: http://127.0.0.1:8000/v1 and vertex-auth: false in config.yaml
+import http.server
+import json
+import random
+import re
+import threading
+import time
+
+import click
+
+DEFAULTS = {
+    # seconds before the answer (or its first chunk), plus up to jitter seconds
+    'latency': 0.05,
+    'jitter': 0.0,
+    # seconds per completion token of a non-streamed answer, and between the chunks of a streamed one
+    'token-time': 0.0,
+    # completion tokens of the answers that are not an echo
+    'tokens': 50,
+    'chunk-tokens': 5,
+    # share of the requests answered by a 500 error, and by a 429 with retry-after-ms
+    'error-rate': 0.0,
+    'rate-limit-rate': 0.0,
+    'retry-after': 0.01,
+    'seed': 0,
+}
+
+
+class Stub:
+    """The behaviour and the counters of the server, shared by the handler threads"""
+
+    def __init__(self, **behaviour):
+        self.behaviour = dict(DEFAULTS, **behaviour)
+        self.lock = threading.Lock()
+        self.random = random.Random(self.behaviour['seed'])
+        self.stats = {}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def draw(self):
+        with self.lock:
+            return self.random.random(), self.random.random()
+
+
+def answer_text(prompt, tokens):
+    """Echo the first python code block of the prompt, or tokens words"""
+    match = re.search(r'```(?:python)?\n(.*?)\n```', prompt, re.S)
+    if match:
+        return '```python\n' + match.group(1) + '\n```'
+    return ' '.join('word' for _ in range(tokens))
+
+
+def count(text):
+    return len(text) // 4 + 1
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are separate writes, with Nagle each keep-alive answer would wait for a delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path == '/_stub/stats':
+            self.send(200, stub.stats)
+        elif self.path.endswith('/models'):
+            self.send(200, {'data': [{'id': 'gpt-4o-mini'}, {'id': 'gpt-4o'}]})
+        else:
+            self.send(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path == '/_stub/config':
+            stub.behaviour.update(body)
+            self.send(200, stub.behaviour)
+            return
+        if self.path.endswith('/chat/completions'):
+            api = 'openai'
+        elif self.path.endswith('/messages'):
+            api = 'anthropic'
+        elif self.path.endswith(':predict'):
+            api = 'vertex'
+        else:
+            self.send(404, {'error': {'message': 'not found'}})
+            return
+        behaviour = dict(stub.behaviour)
+        fault, jitter = stub.draw()
+        if fault < behaviour['rate-limit-rate']:
+            stub.count(api + ' 429')
+            self.send(429, {'error': {'type': 'rate_limit_error', 'message': 'stub rate limit'}},
+                      {'retry-after-ms': str(int(behaviour['retry-after'] * 1000))})
+            return
+        if fault < behaviour['rate-limit-rate'] + behaviour['error-rate']:
+            stub.count(api + ' 500')
+            self.send(500, {'error': {'type': 'server_error', 'message': 'stub error'}})
+            return
+        stub.count(api + ' 200')
+        time.sleep(behaviour['latency'] + jitter * behaviour['jitter'])
+        if api == 'vertex':
+            prompt = body['instances'][0]['prefix']
+        else:
+            prompt = '\n'.join(m['content'] if isinstance(m['content'], str) else ''.join(b['text'] for b in m['content']) for m in body['messages'])
+        text = answer_text(prompt, behaviour['tokens'])
+        if body.get('stream'):
+            self.stream(api, body, prompt, text, behaviour)
+            return
+        time.sleep(behaviour['token-time'] * count(text))
+        if api == 'openai':
+            choices = [{'index': i, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'} for i in range(body.get('n', 1))]
+            self.send(200, {'model': body['model'], 'choices': choices,
+                            'usage': {'prompt_tokens': count(prompt), 'completion_tokens': count(text) * len(choices)}})
+        elif api == 'anthropic':
+            self.send(200, {'model': body['model'], 'content': [{'type': 'text', 'text': text}],
+                            'usage': {'input_tokens': count(prompt), 'output_tokens': count(text)}})
+        else:
+            self.send(200, {'predictions': [{'content': text}]})
+
+    def stream(self, api, body, prompt, text, behaviour):
+        """Send the answer as server-sent events, chunk-tokens tokens every token-time * chunk-tokens seconds"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def event(payload, name=None):
+            data = (f'event: {name}\n' if name else '') + 'data: ' + (payload if isinstance(payload, str) else json.dumps(payload)) + '\n\n'
+            data = data.encode('utf8')
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+            self.wfile.flush()
+
+        size = behaviour['chunk-tokens'] * 4
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        if api == 'anthropic':
+            event({'type': 'message_start', 'message': {'model': body['model'], 'usage': {'input_tokens': count(prompt)}}}, 'message_start')
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(behaviour['token-time'] * behaviour['chunk-tokens'])
+            if api == 'openai':
+                event({'choices': [{'index': 0, 'delta': {'content': chunk}}]})
+            else:
+                event({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': chunk}}, 'content_block_delta')
+        if api == 'openai':
+            event({'choices': [], 'usage': {'prompt_tokens': count(prompt), 'completion_tokens': count(text)}})
+            event('[DONE]')
+        else:
+            event({'type': 'message_delta', 'usage': {'output_tokens': count(text)}}, 'message_delta')
+            event({'type': 'message_stop'}, 'message_stop')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # the benchmarks open many connections at once
+    request_queue_size = 128
+
+
+def start(host='127.0.0.1', port=0, **behaviour):
+    """Start a stub server in a thread and return it, its base URL is server.url"""
+    server = Server((host, port), Handler)
+    server.stub = Stub(**behaviour)
+    server.url = f'http://{host}:{server.server_address[1]}/v1'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, default=8000, help='0 picks a free port')
+@click.option('--latency', type=float, default=DEFAULTS['latency'], help='Seconds before the answer or its first chunk')
+@click.option('--jitter', type=float, default=DEFAULTS['jitter'], help='Up to this many seconds added to the latency')
+@click.option('--token-time', type=float, default=DEFAULTS['token-time'], help='Seconds per completion token')
+@click.option('--tokens', type=int, default=DEFAULTS['tokens'], help='Completion tokens of the answers that are not an echo')
+@click.option('--error-rate', type=float, default=DEFAULTS['error-rate'], help='Share of the requests failing with 500')
+@click.option('--rate-limit-rate', type=float, default=DEFAULTS['rate-limit-rate'], help='Share of the requests failing with 429')
+@click.option('--seed', type=int, default=DEFAULTS['seed'])
+def main(host, port, latency, jitter, token_time, tokens, error_rate, rate_limit_rate, seed):
+    server = start(host, port, **{'latency': latency, 'jitter': jitter, 'token-time': token_time, 'tokens': tokens,
+                                  'error-rate': error_rate, 'rate-limit-rate': rate_limit_rate, 'seed': seed})
+    # the first line tells the scenario runner where to connect
+    print(f'listening on {server.url}', flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
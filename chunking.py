@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# AST-aware chunking of python files for the LLM rewriting scripts
+# a file is split between top-level statements (imports, functions, classes...) into chunks of at most
+# 'chunk-tokens' tokens, the chunks are rewritten concurrently and each is verified with diff_python,
+# a chunk whose behavior changed is kept as it was, so that the reassembled file always behaves the same
+# ./chunking.py <file.py> [max tokens] prints the chunks
+import ast
+import sys
+
+import ellm
+import stockholm_diff
+import tokens
+
+# default size of a chunk, see 'chunk-tokens' in config.yaml
+# the answer repeats the chunk with comments, it must fit the output limit of the model
+CHUNK_TOKENS = 1500
+
+
+def chunk_tokens():
+    """Return the configured size of a chunk, in tokens"""
+    return ellm.get_config().get('chunk-tokens', CHUNK_TOKENS)
+
+
+def split(source, max_tokens=None, model=None):
+    """Split a python source between top-level statements into chunks of at most max_tokens, their concatenation is the source.
+    The comments and blank lines before a statement go with it, a statement larger than max_tokens is a chunk of its own."""
+    max_tokens = max_tokens or chunk_tokens()
+    lines = source.splitlines(keepends=True)
+    # the units are the top-level statements, with what precedes them, the last one up to the end of the file
+    ends = [node.end_lineno for node in ast.parse(source).body]
+    starts = [0] + ends
+    ends = ends[:-1] + [len(lines)] if ends else [len(lines)]
+    units = [''.join(lines[start:end]) for start, end in zip(starts, ends) if end > start]
+
+    chunks = []
+    current, size = '', 0
+    for unit in units:
+        unit_size = tokens.count_tokens(unit, model)
+        if current and size + unit_size > max_tokens:
+            chunks.append(current)
+            current, size = '', 0
+        current += unit
+        size += unit_size
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+def prompts(chunks, instruction, lang='python'):
+    """Return the prompts asking to rewrite each chunk with the instruction"""
+    return [instruction + "```" + lang + "\n" + chunk + "\n```" for chunk in chunks]
+
+
+def reassemble(chunks, answers, extract):
+    """Return (the source reassembled from the rewritten chunks, [(chunk index, reason)] of the chunks kept as they were).
+    A chunk is kept when its answer is missing, has no code, does not parse or changes the behavior."""
+    result = []
+    kept = []
+    for index, (chunk, answer) in enumerate(zip(chunks, answers)):
+        try:
+            rewritten = extract(answer)
+            if chunk.endswith('\n') and not rewritten.endswith('\n'):
+                rewritten += '\n'
+            delta = stockholm_diff.diff_python(chunk, rewritten)
+        except Exception as e:
+            # no answer, no code block, or code that does not parse
+            delta = [f'{type(e).__name__}: {e}']
+        if delta:
+            kept.append((index, delta))
+            result.append(chunk)
+        else:
+            result.append(rewritten)
+    return ''.join(result), kept
+
+
+def rewrite(source, instruction, metaprompt, extract, lang='python', max_tokens=None, task='rewrite'):
+    """Rewrite a python source chunk by chunk, the chunks being sent concurrently with the instruction.
+    Return (the reassembled source, [(chunk index, reason)] of the chunks kept as they were)."""
+    chunks = split(source, max_tokens)
+    answers = ellm.get_llm_answers(prompts(chunks, instruction, lang), metaprompt, task=task, errors='none')
+    return reassemble(chunks, answers, extract)
+
+
+class Outline(ast.NodeTransformer):
+    """Replaces the bodies of the functions by their docstring and ..."""
+
+    def visit_FunctionDef(self, node):
+        docstring = node.body[:1] if ast.get_docstring(node) is not None else []
+        node.body = docstring + [ast.Expr(ast.Constant(...))]
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+
+def outline(source, max_tokens=None):
+    """Return the outline of a python source: its module-level code, classes and function signatures with their docstrings,
+    at most max_tokens, to describe a file too large to be sent in full"""
+    return tokens.truncate(ast.unparse(Outline().visit(ast.parse(source))), max_tokens or chunk_tokens(), keep='start')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('chunking.py <file.py> [max tokens]', file=sys.stderr)
+        sys.exit(-1)
+    for i, chunk in enumerate(split(open(sys.argv[1]).read(), int(sys.argv[2]) if len(sys.argv) > 2 else CHUNK_TOKENS)):
+        print(f'--- chunk {i}: {tokens.count_tokens(chunk)} tokens')
+        print(chunk, end='')
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# keeps a conversation within the context window of the model, counted locally before sending
+# the system messages (markdown instruction, -c context files) and the last message are pinned,
+# the older turns are dropped (sliding-window) or replaced by a summary (summarize)
+# see 'context-policy' in config.yaml
+import tokens
+
+POLICIES = ('sliding-window', 'summarize', 'none')
+# tokens kept free for the approximations of the local count (eg claude with a tiktoken encoding)
+SAFETY_MARGIN = 0.05
+SUMMARY_PREFIX = 'Summary of the earlier conversation: '
+
+
+class ContextOverflow(Exception):
+    """Raised when the pinned messages alone do not fit the context window"""
+
+    def __init__(self, needed, available):
+        super().__init__(f'{needed} tokens needed, {available} available')
+        self.needed = needed
+        self.available = available
+
+
+def budget(context_window, max_output_tokens):
+    """Return the number of prompt tokens available for a request"""
+    return int(context_window * (1 - SAFETY_MARGIN)) - (max_output_tokens or 0)
+
+
+def fit_messages(messages, model, context_window, max_output_tokens=None, policy='sliding-window', summarize=None):
+    """Return the messages to send so that the prompt fits the context window.
+    summarize(messages) returns the text summarizing the given messages, for the summarize policy."""
+    available = budget(context_window, max_output_tokens)
+    if policy == 'none' or tokens.count_message_tokens(messages, model) <= available:
+        return messages
+
+    pinned = [i for i, m in enumerate(messages) if m['role'] == 'system' and not m['content'].startswith(SUMMARY_PREFIX)]
+    pinned.append(len(messages) - 1)
+    needed = tokens.count_message_tokens([messages[i] for i in pinned], model)
+    if needed > available:
+        raise ContextOverflow(needed, available)
+
+    # drop the oldest turns until the rest fits
+    droppable = [i for i in range(len(messages)) if i not in pinned]
+    dropped = set()
+    kept = messages
+    summary = None
+    while droppable:
+        dropped.add(droppable.pop(0))
+        # an assistant answer goes with the question before it
+        if droppable and messages[droppable[0]]['role'] == 'assistant':
+            dropped.add(droppable.pop(0))
+        kept = [m for i, m in enumerate(messages) if i not in dropped]
+        if policy == 'summarize':
+            summary = {'role': 'system', 'content': SUMMARY_PREFIX}
+            kept = insert_summary(kept, summary)
+        if tokens.count_message_tokens(kept, model) <= available:
+            break
+
+    if policy == 'summarize' and summarize is not None:
+        old = [m for i, m in enumerate(messages) if i in dropped]
+        # the summary replaces the dropped turns, it gets whatever room they leave
+        room = max(available - tokens.count_message_tokens(kept, model), 0)
+        summary['content'] = tokens.truncate(SUMMARY_PREFIX + summarize(old), room, model, keep='start')
+    return kept
+
+
+def insert_summary(messages, summary):
+    """Insert the summary after the leading system messages"""
+    i = 0
+    while i < len(messages) - 1 and messages[i]['role'] == 'system':
+        i += 1
+    return messages[:i] + [summary] + messages[i:]
+
+
+def conversation_text(messages, model=None, max_tokens=None):
+    """Render messages as plain text for a summarization prompt, keeping the most recent max_tokens"""
+    text = '\n\n'.join(f"{m['role']}: {m['content']}" for m in messages)
+    return tokens.truncate(text, max_tokens, model) if max_tokens else text
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+# documents a whole source tree: every function and class without a docstring gets one from the LLM
+# each file is parsed once, the docstrings of all files are requested concurrently,
+# and each file is rewritten once, as soon as all its docstrings have arrived
+# the progress is appended to a JSONL manifest, an interrupted run resumes where it stopped,
+# and a rerun only regenerates the docstrings of the definitions whose code changed (see stockholm_diff.fingerprint)
+# ./document_repo.py <directory> [--overwrite] [--estimate] [--limit N]
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import sys
+
+import click
+
+import ellm
+import fileio
+import stockholm_diff
+import tokens
+
+STATE_FILE = '.document-repo.jsonl'
+# directories never documented, in addition to the hidden ones
+SKIP_DIRS = {'__pycache__', 'venv', 'node_modules', 'build', 'dist', 'site-packages'}
+# a class is sent with its beginning only, its methods are documented on their own
+CLASS_SOURCE_TOKENS = 1500
+
+
+def python_files(root):
+    """Yield the paths of the python files under root, relative to it, in a stable order"""
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in SKIP_DIRS)
+        for name in sorted(files):
+            if name.endswith('.py'):
+                yield os.path.relpath(os.path.join(directory, name), root)
+
+
+def digest(source):
+    return hashlib.sha256(source.encode('utf8')).hexdigest()
+
+
+def definitions(source):
+    """Return [(qualified name, kind, source, fingerprint, docstring)] of the definitions of a module, from one parse"""
+    result = []
+    tree = ast.parse(source)
+    fingerprints = stockholm_diff.definition_fingerprints(tree)
+    for qualname, node in stockholm_diff.iter_definitions(tree):
+        segment = ast.get_source_segment(source, node)
+        kind = 'class' if isinstance(node, ast.ClassDef) else 'function'
+        if kind == 'class':
+            segment = tokens.truncate(segment, CLASS_SOURCE_TOKENS, keep='start')
+        result.append((qualname, kind, segment, fingerprints[qualname][0], ast.get_docstring(node)))
+    return result
+
+
+class State:
+    """Manifest of the generated docstrings, with the fingerprint of the definition each was generated for,
+    and of the files rewritten. Append-only, to resume an interrupted run, and compacted when reopened."""
+
+    def __init__(self, path):
+        self.path = path
+        # (file, qualified name) -> {'docstring': str, 'fingerprint': str}
+        self.docstrings = {}
+        # file -> digest of its content once documented
+        self.done = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # truncated by a crash
+                        continue
+                    if 'docstring' in record:
+                        self.docstrings[(record['file'], record['qualname'])] = {'docstring': record['docstring'], 'fingerprint': record.get('fingerprint')}
+                    else:
+                        self.done[record['file']] = record['digest']
+        if lines > 2 * (len(self.docstrings) + len(self.done)) + 100:
+            # most records are superseded after many runs
+            self.compact()
+        self.file = fileio.open_log(path)
+
+    def compact(self):
+        """Rewrite the manifest with the current records only"""
+        records = [{'file': file, 'qualname': qualname, **record} for (file, qualname), record in self.docstrings.items()]
+        records += [{'file': file, 'digest': file_digest} for file, file_digest in self.done.items()]
+        fileio.write_atomically(self.path, ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def add_docstring(self, file, qualname, docstring, fingerprint):
+        self.docstrings[(file, qualname)] = {'docstring': docstring, 'fingerprint': fingerprint}
+        self.write({'file': file, 'qualname': qualname, 'docstring': docstring, 'fingerprint': fingerprint})
+
+    def add_done(self, file, source):
+        self.done[file] = digest(source)
+        self.write({'file': file, 'digest': self.done[file]})
+
+
+def plan(root, state, overwrite):
+    """Return {file: (source, {qualified name: docstring} to apply, [(qualified name, kind, source, fingerprint)] to request)}.
+    A definition is requested when it has no docstring (all of them with overwrite), or when it changed since its docstring was generated."""
+    files = {}
+    unchanged = 0
+    for file in python_files(root):
+        with open(os.path.join(root, file), encoding='utf8') as f:
+            source = f.read()
+        if state.done.get(file) == digest(source):
+            continue
+        try:
+            module_definitions = definitions(source)
+        except SyntaxError as e:
+            print(f'{file}: skipped, {e}', file=sys.stderr)
+            continue
+        received = {}
+        todo = []
+        for qualname, kind, segment, fingerprint, docstring in module_definitions:
+            record = state.docstrings.get((file, qualname))
+            if record is not None and record['fingerprint'] == fingerprint:
+                unchanged += 1
+                # received by an interrupted run, a docstring written since is kept
+                if docstring is None:
+                    received[qualname] = record['docstring']
+            elif record is not None or overwrite or docstring is None:
+                todo.append((qualname, kind, segment, fingerprint))
+        if todo or received:
+            files[file] = (source, received, todo)
+    if unchanged:
+        print(f'{unchanged} definitions unchanged since their docstring was generated', file=sys.stderr)
+    return files
+
+
+async def document(root, state, files, limit=None, concurrency=None):
+    """Request the missing docstrings concurrently and rewrite each file once it has all of them"""
+    requests = [(file, qualname, fingerprint, ellm.docstring_prompt(source, kind=kind)) for file, (_, _, todo) in files.items() for qualname, kind, source, fingerprint in todo]
+    if limit is not None:
+        # the files whose requests are cut are completed by the next run
+        requests = requests[:limit]
+    pending = {file: len(todo) for file, (_, _, todo) in files.items()}
+
+    def rewrite(file):
+        # one parse and one write per file, the file is left untouched if its behavior changed
+        program = ellm.replace_docstrings(os.path.join(root, file), files[file][1])
+        if program is not None:
+            state.add_done(file, program)
+            print(f'{file}: {len(files[file][1])} docstrings', file=sys.stderr)
+
+    for file in files:
+        if pending[file] == 0:
+            rewrite(file)
+    async for index, answer in ellm.aget_llm_answers([r[3] for r in requests], concurrency=concurrency, ordered=False, task='docstring', errors='none'):
+        file, qualname, fingerprint, _ = requests[index]
+        if answer is None:
+            # the file is completed by the next run
+            continue
+        docstring = ellm.extract_docstring(answer).strip()
+        state.add_docstring(file, qualname, docstring, fingerprint)
+        files[file][1][qualname] = docstring
+        pending[file] -= 1
+        if pending[file] == 0:
+            rewrite(file)
+
+
+@click.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.option('--overwrite', is_flag=True, help='Regenerate the existing docstrings too')
+@click.option('--estimate', is_flag=True, help='Print the expected requests, tokens and cost, and exit')
+@click.option('--limit', type=int, default=None, help='Maximum number of docstrings requested by this run')
+@click.option('--concurrency', type=int, default=None, help='Maximum number of requests in flight (default: batch-concurrency)')
+@click.option('--state', 'state_path', default=None, help=f'Progress file (default: <root>/{STATE_FILE})')
+def main(root, overwrite, estimate, limit, concurrency, state_path):
+    state = State(state_path or os.path.join(root, STATE_FILE))
+    files = plan(root, state, overwrite)
+    definitions_todo = [(kind, source) for _, _, todo in files.values() for _, kind, source, _ in todo][:limit]
+    print(f'{len(files)} files to document, {len(definitions_todo)} docstrings to request', file=sys.stderr)
+    if estimate:
+        expected = ellm.estimate_llm_answers([ellm.docstring_prompt(source, kind=kind) for kind, source in definitions_todo], task='docstring')
+        cost = 'unknown pricing' if expected['cost'] is None else f"${expected['cost']:.4f}"
+        print(f"{expected['requests']} requests, {expected['prompt_tokens']} prompt tokens, ~{expected['completion_tokens']} completion tokens, {cost}")
+        return
+    asyncio.run(document(root, state, files, limit, concurrency))
+
+
+if __name__ == '__main__':
+    main()
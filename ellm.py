@@ -1,126 +1,208 @@
 #!/usr/bin/python3
 # This library is a harness for OpenLLMs
+# the provider SDKs (openai, vertexai, google.auth, keyring) and the AST tooling are imported on first use,
+# so that scripts only needing eg extract_program start fast, see benchmarks/startup.py
 import os
-from openai import OpenAI
-
 import sys
 import re
 import time
-import yaml
-import requests
 import json
 import ast
-import astor
-import stockholm_diff
-import ast_comments
-import keyring
-login_keyring=keyring.get_keyring()
-
-import vertexai
-from vertexai.generative_models import GenerativeModel
-
-import google.auth
-# credentials, project = google.auth.default()
-
-# Initialize an empty dictionary for configuration
-config = {}
-# Load the configuration from a YAML file
-with open(os.path.dirname(__file__)+"/"+'config.yaml') as file:
-    config = yaml.load(file, Loader=yaml.FullLoader)
-    
-client = OpenAI(api_key=config['api-key'])
+import fileio
+import llm_cache
+import providers
+import router
+import tokens
+import usage_ledger
+
+_config = None
+_login_keyring = None
+
+def get_config():
+    """Load the configuration from config.yaml on first use"""
+    global _config
+    if _config is None:
+        _config = fileio.load_config()
+    return _config
+
+def get_login_keyring():
+    """Open the keyring holding the Google service account on first use"""
+    global _login_keyring
+    if _login_keyring is None:
+        import keyring
+        _login_keyring = keyring.get_keyring()
+    return _login_keyring
+
+def __getattr__(name):
+    # ellm.config and ellm.login_keyring are still available, loaded on access
+    lazy = {'config': get_config, 'login_keyring': get_login_keyring}
+    if name in lazy:
+        return lazy[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 VERBOSE=0
+# set to False (or ELLM_NO_CACHE=1, or 'cache: false' in config.yaml) to always call the API
+USE_CACHE = os.environ.get('ELLM_NO_CACHE', '') == ''
+_cache = None
+
 DEFAULT_META=lambda x: [{"content":x, "role":"user"}]
+
+def get_cache():
+    """Return the response cache, opened on first use"""
+    global _cache
+    if _cache is None:
+        _cache = llm_cache.from_config(get_config())
+    return _cache
+
+def get_provider(name=None):
+    """Return the backend of the given provider, by default the one configured in config.yaml"""
+    return providers.get_provider(name or get_config()['provider'], get_config())
+
+def get_cache_key(prompt, metaprompt=DEFAULT_META, provider=None, model=None):
+    """Return the cache key of a prompt for the configured provider"""
+    provider = get_provider(provider)
+    return llm_cache.cache_key(provider.name, provider.model(model), provider.default_temperature, metaprompt(prompt))
+
+def route(prompt, metaprompt=DEFAULT_META, task=None):
+    """This function returns the (provider name, model) to use for the prompt: the choice of the router when a router section is configured in config.yaml, otherwise the configured provider and its default model. task (eg 'classify', 'docstring', 'rewrite') tells the router the expected size of the answer."""
+    model_router = router.get_router(get_config())
+    if model_router is None:
+        provider = get_provider()
+        return provider.name, provider.model()
+    provider, model = model_router.choose(metaprompt(prompt), task)
+    if VERBOSE>0: print('routed to ' + provider.name + '/' + model, file=sys.stderr)
+    return provider.name, model
+
 # Function to get the LLM answer based on the provider specified in the configuration
-def get_llm_answer(prompt, metaprompt=DEFAULT_META):
-    """This function determines the appropriate answer provider based on the configuration settings and then calls the corresponding function to get the answer to the given prompt. If the provider is 'openai', it calls get_openai_answer, if 'google', it calls get_google_answer, and if 'huggingface', it calls get_huggingface_answer. If none of these providers are specified, it raises an Exception."""
-    if VERBOSE>0: print('using provider ' + config['provider'], file=sys.stderr)
-    if config['provider'] == 'openai':
-        if VERBOSE>0: print('using model ' + config['model'], file=sys.stderr)
-        return get_openai_answer(prompt, metaprompt)
-    if config['provider'] == 'google':
-        return get_google_answer_predict_api(prompt, metaprompt)
-    if config['provider'] == 'huggingface':
-        return get_huggingface_answer(prompt, metaprompt)
-    raise Exception()
-# Function to get the answer from Hugging Face model
+def get_llm_answer(prompt, metaprompt=DEFAULT_META, use_cache=None, task=None, provider=None, model=None):
+    """This function returns the answer to the prompt from the on-disk cache when the same request was already answered, otherwise it asks the configured (or routed, see route) provider and caches the answer. use_cache overrides the module-wide USE_CACHE flag, and a given provider (and model) skips the routing."""
+    if use_cache is None:
+        use_cache = USE_CACHE and get_config().get('cache', True)
+    if provider is None:
+        provider, model = route(prompt, metaprompt, task)
+    if not use_cache:
+        return get_llm_answer_uncached(prompt, metaprompt, provider, model)
+    key = get_cache_key(prompt, metaprompt, provider, model)
+    answer = get_cache().get(key)
+    if answer is not None:
+        if VERBOSE>0: print('cache hit ' + key, file=sys.stderr)
+        return answer
+    answer = get_llm_answer_uncached(prompt, metaprompt, provider, model)
+    if answer is not None:
+        get_cache().put(key, answer)
+    return answer
 
-def get_huggingface_answer(prompt, metaprompt=DEFAULT_META):
-    """This function prepares a prompt, sets up the URL, headers, and data for making a request to the Hugging Face API, sends the request, and prints the generated text in response."""
-    # Prepare the prompt
-    prompt = ' '.join((x['content'] for x in metaprompt(prompt)))
-    # Set the URL for the Hugging Face API
-    url = 'https://api-inference.huggingface.co/models/bigcode/starcoderplus'
-    # Set the headers for the API request
-    headers = {'Authorization': 'Bearer '+config["hf-key"], 'Content-Type': 'application/json'}
-    # Set the data for the API request
-    data = {'inputs': prompt, 'parameters': {'max_new_tokens': 100, 'stop': []}}
-    # Make the API request and print the generated text
-    response = requests.post(url, headers=headers, json=data)
-    # print(response.json())
-    print(response.json()[0]["generated_text"])
+# default number of requests in flight in get_llm_answers, see 'batch-concurrency' in config.yaml
+# keep it below 'http-pool-size' so that every request gets a pooled connection
+BATCH_CONCURRENCY = 8
+_next_request_time = {}
 
+async def _throttle(provider, rate):
+    """Wait until the provider can be sent another request, at most rate requests per second"""
+    import asyncio
+    now = time.monotonic()
+    start = max(now, _next_request_time.get(provider, now))
+    _next_request_time[provider] = start + 1.0 / rate
+    await asyncio.sleep(start - now)
 
-def get_google_answer_gemini_api(prompt, metaprompt=DEFAULT_META):
-    """
-    works on August 2024
-    """
-    
-    # Prepare the prompt
-    prompt = ' '.join((x['content'] for x in metaprompt(prompt)))
+async def aget_llm_answers(prompts, metaprompt=DEFAULT_META, concurrency=None, ordered=True, use_cache=None, task=None, errors='raise'):
+    """This async generator sends the prompts to the configured provider with at most concurrency requests in flight (and at most 'batch-rate' requests per second if configured), and yields (index, answer) pairs, in prompt order if ordered, otherwise as soon as each answer arrives. With errors='none' a failed request is reported on stderr and answers None instead of cancelling the others."""
+    import asyncio
+    import concurrent.futures
+    config = get_config()
+    concurrency = concurrency or config.get('batch-concurrency', BATCH_CONCURRENCY)
+    semaphore = asyncio.Semaphore(concurrency)
+    rate = config.get('batch-rate')
+    # the provider functions are blocking, they run in a thread pool as large as the concurrency
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def answer(index, prompt):
+        async with semaphore:
+            provider = model = None
+            if rate:
+                # the rate is per provider, the one the router picks for this prompt
+                provider, model = await loop.run_in_executor(executor, route, prompt, metaprompt, task)
+                await _throttle(provider, rate)
+            try:
+                return index, await loop.run_in_executor(executor, get_llm_answer, prompt, metaprompt, use_cache, task, provider, model)
+            except Exception as e:
+                if errors != 'none':
+                    raise
+                print(f'request {index}: failed, {type(e).__name__}: {e}', file=sys.stderr)
+                return index, None
 
-    vertexai.init(project="assert-experiments", location="us-central1")
+    futures = [asyncio.ensure_future(answer(i, p)) for i, p in enumerate(prompts)]
+    try:
+        for next_answer in (futures if ordered else asyncio.as_completed(futures)):
+            yield await next_answer
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    MODEL_ID = "gemini-1.5-flash-001"
-    MODEL_ID = "gemini-1.5-pro-001"
-    model = GenerativeModel(MODEL_ID)
+def get_llm_answers(prompts, metaprompt=DEFAULT_META, concurrency=None, ordered=True, use_cache=None, task=None, errors='raise'):
+    """This function is the blocking counterpart of aget_llm_answers. It returns the list of answers in prompt order, or the list of (index, answer) pairs in completion order if not ordered."""
+    import asyncio
+    async def collect():
+        return [x async for x in aget_llm_answers(prompts, metaprompt, concurrency, ordered, use_cache, task, errors)]
+    results = asyncio.run(collect())
+    return [answer for _, answer in results] if ordered else results
 
-    response = model.generate_content(prompt)
+def get_llm_answer_uncached(prompt, metaprompt=DEFAULT_META, provider=None, model=None):
+    """This function sends the prompt to the provider configured in config.yaml (or the given one), looked up in the providers registry, and returns the text of the answer. The latency is reported to the router if one is configured, and the usage to the ledger (see usage_ledger.py)."""
+    provider = get_provider(provider)
+    if VERBOSE>0: print('using provider ' + provider.name + ' and model ' + str(provider.model(model)), file=sys.stderr)
+    messages = metaprompt(prompt)
+    ledger = usage_ledger.get_ledger(get_config())
+    estimated_tokens = tokens.count_message_tokens(messages, provider.model(model)) if ledger is not None else 0
+    start = time.monotonic()
+    completion = provider.complete(messages, model)
+    model_router = router.get_router(get_config())
+    if model_router is not None:
+        model_router.record(provider.model(model), time.monotonic() - start, completion['usage']['completion_tokens'])
+    if ledger is not None:
+        ledger.record(provider.model(model), estimated_tokens, completion['usage'], completion['content'])
+    return completion['content']
 
-    return response.text
+# default temperature of get_llm_candidates, the candidates of a pass@k must differ
+CANDIDATE_TEMPERATURE = 0.8
 
+def get_llm_candidates(prompt, metaprompt=DEFAULT_META, n=5, temperature=None, provider=None, model=None):
+    """This function returns n answers to the prompt sampled at temperature ('candidate-temperature' in config.yaml, 0.8 by default), for pass@k: in one request on providers with a number of choices (OpenAI n), otherwise in n concurrent requests. The answers are not cached, and the usage goes to the ledger as one request."""
+    provider = get_provider(provider)
+    if temperature is None:
+        temperature = get_config().get('candidate-temperature', CANDIDATE_TEMPERATURE)
+    messages = metaprompt(prompt)
+    ledger = usage_ledger.get_ledger(get_config())
+    estimated_tokens = tokens.count_message_tokens(messages, provider.model(model)) if ledger is not None else 0
+    if not provider.supports_choices:
+        # the prompt is sent n times
+        estimated_tokens *= n
+    completion = provider.complete_n(messages, n, model, temperature)
+    if ledger is not None:
+        ledger.record(provider.model(model), estimated_tokens, completion['usage'], ''.join(completion['contents']))
+    return completion['contents']
+
+def estimate_llm_answers(prompts, metaprompt=DEFAULT_META, task=None, provider=None, model=None):
+    """This function returns the expected requests, tokens and cost in $ of answering the prompts with the configured provider, counted locally before sending anything, to budget a bulk job. The cost is None when the pricing of the model is unknown."""
+    provider = get_provider(provider)
+    return usage_ledger.estimate(prompts, provider.model(model), metaprompt, task, get_config())
+
+def get_huggingface_answer(prompt, metaprompt=DEFAULT_META):
+    """This function sends the prompt to the Hugging Face inference API and returns the generated text."""
+    return get_llm_answer_uncached(prompt, metaprompt, 'huggingface')
+
+def get_google_answer_gemini_api(prompt, metaprompt=DEFAULT_META):
+    """
+    works on August 2024
+    """
+    return get_llm_answer_uncached(prompt, metaprompt, 'gemini')
 
 def get_google_answer_predict_api(prompt, metaprompt=DEFAULT_META):
-    # Prepare the prompt
-    prompt = ' '.join((x['content'] for x in metaprompt(prompt)))
+    """This function sends the prompt to the Vertex AI predict API and returns the generated content."""
+    return get_llm_answer_uncached(prompt, metaprompt, 'google')
 
-    """This function takes a prompt and a metaprompt as input, prepares the prompt, sets the necessary headers and data for an API request to a Google model, makes the API request, and returns the generated content from the response."""
-    # Set the project and model IDs for the Google API
-    PROJECT_ID = 'assert-experiments'
-    
-    # https://console.cloud.google.com/vertex-ai/publishers/google/model-garden/code-bison
-    # MODEL_ID = 'code-bison'
-    
-    # gemini
-    MODEL_ID = 'gemini-1.5-pro-001'
-    # {'error': {'code': 400, 'message': 'Gemini cannot be accessed through Vertex Predict/RawPredict API. Please follow https://cloud.google.com/vertex-ai/docs/generative-ai/start/quickstarts/quickstart-multimodal for Gemini usage.', 'status': 'FAILED_PRECONDITION'}}
-
-
-    url = f'https://us-central1-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}/locations/us-central1/publishers/google/models/{MODEL_ID}:predict'
-    # Set the headers for the API request
-    # headers = {'Authorization': f'Bearer ' + config['google-token'], 'Content-Type': 'application/json'}
-    headers={}
-    # https://console.cloud.google.com/iam-admin/serviceaccounts
-    
-    # credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
-    
-    
-    from google.oauth2 import service_account
-    credentials = service_account.Credentials.from_service_account_info(json.loads(login_keyring.get_password('login2', 'google-service-account')))
-
-    scoped_credentials = credentials.with_scopes(['https://www.googleapis.com/auth/cloud-platform'])
-
-    from google.auth.transport.requests import AuthorizedSession
-
-    authed_session = AuthorizedSession(scoped_credentials)
-
-    # Set the data for the API request
-    data = {'instances': [{'prefix': prompt}], 'parameters': {'temperature': 0.5, 'maxOutputTokens': 256}}
-    # Make the API request and return the generated content
-    response = authed_session.post(url, headers=headers, json=data)
-    # print(response.json())
-    return response.json()["predictions"][0]["content"]
 # Function to prepare the chat prompt for OpenAI
 
 def decorate_prompt_exec(prompt):
@@ -132,15 +214,8 @@ def get_openai_synthesis_prompt(prompt):
 # Function to get the answer from OpenAI's GPT-3 model
 
 def get_openai_answer(prompt, metaprompt):
-    """This function generates a synthesis prompt for OpenAI GPT-3 based on the input prompt provided. The prompt includes instructions for a software developer to write Python code that outputs only code enclosed in triple backticks."""
-    # Set the temperature for the model
-    temperature = 0  # for live coding
-    if VERBOSE>0: print('using temperature ' + str(temperature), file=sys.stderr)
-    # Create a chat completion request
-    response = client.chat.completions.create(model=config['model'], messages=metaprompt(prompt), temperature=temperature)
-    # Extract the generated answer from the response
-    answer = response.choices[0].message.content
-    return answer
+    """This function sends the chat messages built by metaprompt to the OpenAI chat completions API at temperature 0 and returns the answer."""
+    return get_llm_answer_uncached(prompt, metaprompt, 'openai')
 # Function to extract the generated program from the answer
 
 def extract_program(answer, lang='python'):
@@ -155,15 +230,32 @@ def extract_program(answer, lang='python'):
     result = re.findall('```(?:' + lang + ')?([\\s\\S]*?)```', answer)
     return '\n'.join(result)
 
-def llm_doctsring(source, lang='python'):
-    """This function extracts the code program from a given answer string by removing the syntax and returning the code program in the specified language (default is Python)."""
-    prompt = 'write a docstring summary of the following python function.\n'
+def docstring_prompt(source, lang='python', kind='function'):
+    """This function builds the prompt asking for a docstring summary of the given function (or class) source."""
+    prompt = 'write a docstring summary of the following python ' + kind + '.\n'
     initial_program = source
     prompt += '```' + lang + '\n' + initial_program + '\n```'
-    return get_llm_answer(prompt)
+    return prompt
+
+def llm_doctsring(source, lang='python'):
+    """This function extracts the code program from a given answer string by removing the syntax and returning the code program in the specified language (default is Python)."""
+    return get_llm_answer(docstring_prompt(source, lang), task='docstring')
+
+def extract_docstring(answer):
+    """This function returns the docstring in an LLM answer: the content of its first triple-quoted string if any, otherwise the whole answer."""
+    # Regular expression pattern with multiline support
+    match = re.search(r'"""((?:.|[\n\r])*?)"""', answer, re.DOTALL)
+    if match:
+        return match.group(1)
+    return answer
+
+def llm_docstrings(sources, lang='python'):
+    """This function asks the LLM for the docstrings of many function sources concurrently and returns them in the same order."""
+    return get_llm_answers([docstring_prompt(source, lang) for source in sources], task='docstring')
 
 def remove_function(initial_program, function_name):
     """This function extracts the code program from a given answer string by removing the syntax and returning the code program in the specified language (default is Python)."""
+    import ast_comments
     tree = ast_comments.parse(initial_program)
     # Find function named 'foo' and remove it
     for node in ast.walk(tree):
@@ -174,42 +266,45 @@ def remove_function(initial_program, function_name):
     return ast_comments.unparse(tree)
 
 def replace_docstring(filename, fname, newdocstring):
-    """This function extracts the code program from a given answer string by removing the syntax and returning the code program in the specified language (default is Python)."""
-    initial_program = ''
-
-    # Regular expression pattern with multiline support
-    pattern = r'"""((?:.|[\n\r])*?)"""'
-
-    # Find and display the content of the docstring
-    match = re.search(pattern, newdocstring, re.DOTALL)
-    if match:
-        newdocstring = match.group(1)
+    """This function replaces the docstring of the function fname in the file with the docstring found in the LLM answer newdocstring, see replace_docstrings to replace many at once. The file is written even if the behavior check fails, as before."""
+    return replace_docstrings(filename, {fname: extract_docstring(newdocstring)}, force=True)
 
+def replace_docstrings(filename, docstrings, force=False, output=None):
+    """This function sets the docstrings {qualified name: docstring} of the functions, methods ('Class.method'), nested functions ('outer.inner') and classes of the file in one parse, one unparse, one behavior check and one write, to the file itself or to output. A plain name matching no qualified name falls back to all the definitions of that name. It returns the new program, or None when the rewrite changed the behavior and force is False, in which case nothing is written."""
+    import ast_comments
+    import stockholm_diff
     # Parse the Python source file
     with open(filename, 'r') as source:
         initial_program = source.read()
-        # parse the source with comments nodes in ast
-        tree = ast_comments.parse(initial_program)
-    # Find function named 'foo' and replace its docstring
-    for node in ast.walk(tree):
-        if isinstance(node, ast.FunctionDef) and node.name == fname:
-            ast.get_docstring(node, clean=True)
+    # parse the source with comments nodes in ast
+    tree = ast_comments.parse(initial_program)
+    # index the definitions once: qualified name -> node, name -> nodes
+    by_qualname = {}
+    by_name = {}
+    for qualname, node in stockholm_diff.iter_definitions(tree):
+        by_qualname[qualname] = node
+        by_name.setdefault(node.name, []).append(node)
+    for name, newdocstring in docstrings.items():
+        nodes = [by_qualname[name]] if name in by_qualname else by_name.get(name, [])
+        if not nodes:
+            print('no definition ' + name + ' in ' + filename, file=sys.stderr)
+        for node in nodes:
             # if first statement is docstring, replace it
-            if len(node.body) > 0 and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Str):
-                node.body[0].value.s = newdocstring
+            if len(node.body) > 0 and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Constant) and isinstance(node.body[0].value.value, str):
+                node.body[0].value = ast.Constant(newdocstring)
             else:
                 # prepend it
-                node.body.insert(0, ast.Expr(ast.Str(newdocstring)))
+                node.body.insert(0, ast.Expr(ast.Constant(newdocstring)))
     # pretty print incl. comments
-    # checking for absenece of differences
-    ppprogram = ast_comments.unparse(tree)
-    delta = stockholm_diff.diff_python(initial_program, ppprogram)
-    for i in delta:
-        print(i, file=sys.stderr)
-    if len(delta) > 0:
-        print('behavior has been changed by the LLM!!!', file=sys.stderr)
-        # print the command to output the diff of the original and the commented program
-    # print(f"diff -u {file_to_comment} {file_to_comment}.commented",file=sys.stderr)
-    # Write the modified tree back to the source file
-    with open(filename, 'w') as source:
-        source.write(ppprogram)
+    # checking for absence of differences
+    ppprogram = ast_comments.unparse(tree) + '\n'
+    if not stockholm_diff.same_behavior(initial_program, ppprogram):
+        for i in stockholm_diff.diff_python(initial_program, ppprogram):
+            print(i, file=sys.stderr)
+        delta = stockholm_diff.diff_definitions(initial_program, ppprogram)
+        print('behavior has been changed by the LLM!!! ' + filename + ' ' + stockholm_diff.format_delta(delta), file=sys.stderr)
+        if not force:
+            return None
+    # Write the modified tree back to the source file (or to output), atomically
+    fileio.write_atomically(output or filename, ppprogram)
+    return ppprogram
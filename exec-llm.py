@@ -1,21 +1,33 @@
 #!/usr/bin/python3
 # a harness for openai llms with execution
 # ./exec-llm.py "a function that computes the babbage number" | python
+# ./exec-llm.py --run "a function that computes the babbage number"   runs it in the sandbox, see sandbox.py
+# ./exec-llm.py --k 10 "a function that computes the babbage number"  pass@k: 10 candidates, the distinct ones are run in the sandbox
 
 import openai
+import os
 import sys
 import re
 import time
 import yaml 
+import json
 import requests
 from ellm import *
-import subprocess
 
 
 # Prompt for testing
 
 prompt = "a function that computes the babbage number."
 
+run = "--run" in sys.argv
+if run:
+    sys.argv.remove("--run")
+
+k = None
+if "--k" in sys.argv:
+    k = int(sys.argv.pop(sys.argv.index("--k") + 1))
+    sys.argv.remove("--k")
+
 if len(sys.argv)>1:
     prompt = sys.argv[1]
 
@@ -27,10 +39,39 @@ for i in files:
 
 #sys.exit()
 
-def get_llm_local(prompt):
-    return subprocess.check_output(["llm","-m","mistral-7b-instruct-v0", prompt]).decode("utf8")
-
+# the prompts are logged in the prompt store, with their artefacts and executions, see prompt_store.py
+import prompt_store
+store = prompt_store.from_config(get_config())
+prompt_id, _ = store.add(prompt)
 
+def get_llm_local(prompt):
+    # the model stays loaded in the local worker between runs, see local_worker.py
+    return get_provider('local-worker').complete([{'role': 'user', 'content': prompt}])['content']
+
+
+
+def pass_at_k(prompt, k, provider='local-worker'):
+    """Sample k candidates, execute each distinct program once (stockholm_diff.group_equivalent) and return [(program, number of candidates, result)]"""
+    import sandbox
+    import stockholm_diff
+    programs = [extract_program(answer) for answer in get_llm_candidates(prompt, get_openai_synthesis_prompt, k, provider=provider)]
+    groups = stockholm_diff.group_equivalent(programs)
+    with sandbox.Sandbox(workers=min(len(groups), get_config().get('sandbox-workers') or os.cpu_count()), config=get_config()) as box:
+        results = box.run_many([programs[group[0]] for group in groups])
+    return [(programs[group[0]], len(group), result) for group, result in zip(groups, results)]
+
+if k:
+    tstamp = str(int(time.time()))
+    candidates = pass_at_k(prompt, k)
+    print(f"# {k} candidates, {len(candidates)} distinct programs executed", file=sys.stderr)
+    for i, (program, count, result) in enumerate(candidates):
+        print(f"# candidate {i} (x{count}): {result['status']} ({result['returncode']}) in {result['duration']:.2f}s", file=sys.stderr)
+        with open("."+tstamp+"-"+str(i)+".py", "w") as f: f.write(program)
+        store.add_execution(prompt_id, result, store.add_artefact(prompt_id, "."+tstamp+"-"+str(i)+".py", "program"))
+    passed = [program for program, _, result in candidates if result['status'] == 'ok']
+    if passed:
+        print(passed[0])
+    sys.exit(0 if passed else 1)
 
 # Get the answer from OpenAI
 # answer = get_openai_answer(prompt, get_openai_synthesis_prompt)
@@ -53,10 +94,8 @@ fname2 = "."+tstamp+".py"
 with open(fname, "w") as f: f.write(prompt +"\n\n--------------------\n\n"+ program+"\n\n--------------------\n\n"+answer)
 with open(fname2, "w") as f: f.write(program)
 
-
-PROMPTS=open("prompts.txt").read()
-if prompt not in PROMPTS:
-    with open("prompts.txt", "a") as f: f.write(prompt+"\n\n")
+store.add_artefact(prompt_id, fname, "record")
+program_id = store.add_artefact(prompt_id, fname2, "program")
 #print("print('# cat "+fname+"')")
 #print("# cat "+fname2+"", file=sys. stderr)
 
@@ -66,3 +105,14 @@ if prompt not in PROMPTS:
 print()
 print(program)
 print()
+
+if run:
+    import sandbox
+    with sandbox.Sandbox(workers=1, config=get_config()) as box:
+        result = box.run(program)
+    print(result['stdout'], end='')
+    print(result['stderr'], end='', file=sys.stderr)
+    print(f"# {result['status']} ({result['returncode']}) in {result['duration']:.2f}s", file=sys.stderr)
+    with open(fname, "a") as f: f.write("\n\n--------------------\n\n" + json.dumps(result))
+    store.add_execution(prompt_id, result, program_id)
+    sys.exit(0 if result['status'] == 'ok' else 1)
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+# file helpers shared by the modules: reading config.yaml, atomic writes, append-only JSONL logs
+# from fileio import load_config, write_atomically, open_log
+import os
+import shutil
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# the temporary files of write_atomically are created 0600, new files get the usual 0666 & ~umask instead
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def load_config(path=None):
+    """Return the content of config.yaml (next to this file by default), {} if it is empty"""
+    import yaml
+    with open(path or os.path.join(HERE, 'config.yaml')) as file:
+        return yaml.load(file, Loader=yaml.FullLoader) or {}
+
+
+def write_atomically(path, text):
+    """Write text to path through a temporary file, so that a crash never leaves the file half written.
+    The permissions of an existing file are kept."""
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with open(descriptor, 'w', encoding='utf8') as f:
+            f.write(text)
+        if os.path.exists(path):
+            shutil.copymode(path, temporary)
+        else:
+            os.chmod(temporary, 0o666 & ~UMASK)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def open_log(path):
+    """Open an append-only JSONL log, ending the last line if a crash left it truncated"""
+    truncated = False
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            truncated = f.read() != b'\n'
+    file = open(path, 'a', encoding='utf8')
+    if truncated:
+        # so that the next record is readable
+        file.write('\n')
+    return file
@@ -16,7 +16,8 @@ def sanitize(x):
 
 
 def check_vuln(code):
-  output = ellm.get_llm_answer("```python\n"+code+"\n``` is there a vulnerability? answer only by yes/no.")
+  # a yes/no answer, the router can send it to a cheap and fast model
+  output = ellm.get_llm_answer("```python\n"+code+"\n``` is there a vulnerability? answer only by yes/no.", task="classify")
   print(output)
   answer = sanitize(output)
   return answer
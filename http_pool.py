@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# shared HTTP sessions for the LLM providers
+# one session per provider and pool configuration, so that TCP+TLS connections are kept alive across calls
+# requests (urllib3) speaks HTTP/1.1 only, there is no HTTP/2: the handshakes are saved by keep-alive
+# from http_pool import post, get
+import threading
+
+# number of connections kept alive per host, see 'http-pool-size' in config.yaml
+DEFAULT_POOL_SIZE = 10
+# seconds, see 'http-connect-timeout' and 'http-timeout' in config.yaml
+# the read timeout is long because completions can take minutes
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 600
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def pool_size(config=None):
+    """Return the number of pooled connections per host configured in config.yaml"""
+    return int((config or {}).get("http-pool-size", DEFAULT_POOL_SIZE))
+
+
+def timeout(config=None):
+    """Return the (connect, read) timeout tuple configured in config.yaml"""
+    config = config or {}
+    return (float(config.get("http-connect-timeout", DEFAULT_CONNECT_TIMEOUT)),
+            float(config.get("http-timeout", DEFAULT_READ_TIMEOUT)))
+
+
+def get_session(provider, config=None, factory=None):
+    """Return the keep-alive session of the given provider, creating it on first use.
+    factory builds the underlying requests.Session, eg an AuthorizedSession for Google.
+    Sessions are keyed on the pool size and the factory too, so that a later config is not served the first one's session."""
+    # requests is imported on first use, it is a large part of the import time of ellm
+    import requests
+    from requests.adapters import HTTPAdapter
+    key = (provider, pool_size(config), factory is None)
+    with _lock:
+        if key not in _sessions:
+            session = factory() if factory else requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size(config), pool_maxsize=pool_size(config))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def post(provider, url, config=None, **kwargs):
+    """requests.post through the pooled session of the provider, with the configured timeout"""
+    kwargs.setdefault("timeout", timeout(config))
+    return get_session(provider, config).post(url, **kwargs)
+
+
+def get(provider, url, config=None, **kwargs):
+    """requests.get through the pooled session of the provider, with the configured timeout"""
+    kwargs.setdefault("timeout", timeout(config))
+    return get_session(provider, config).get(url, **kwargs)
+
+
+def close_all():
+    """Close all pooled sessions"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -9,15 +9,16 @@ def print_func_details(module):
     """This function takes a module as input and prints the module name, attributes, and function details. It then writes each function to a separate file and updates the docstring of the function in the original module file."""
     print(module.__name__)
     print(dir(module))
-    for name, obj in inspect.getmembers(module):
-        if inspect.isfunction(obj):
-            filename='function_' + name + '.py'
-            with open(filename, 'w') as f:
-                f.write(inspect.getsource(obj))
-            docstring = ellm.llm_doctsring(inspect.getsource(obj))
-            ellm.replace_docstring(module.__name__+".py", name, docstring)
-            print(f'Function Name: {name}')
-            #return
+    functions = [(name, inspect.getsource(obj)) for name, obj in inspect.getmembers(module) if inspect.isfunction(obj)]
+    for name, source in functions:
+        filename='function_' + name + '.py'
+        with open(filename, 'w') as f:
+            f.write(source)
+    # all docstrings are requested concurrently, then written in one rewrite of the module
+    docstrings = ellm.llm_docstrings([source for _, source in functions])
+    ellm.replace_docstrings(module.__name__+".py", {name: ellm.extract_docstring(docstring) for (name, _), docstring in zip(functions, docstrings)}, force=True)
+    for name, _ in functions:
+        print(f'Function Name: {name}')
 
 
 print_func_details(locals()[sys.argv[1]])
@@ -6,14 +6,22 @@ import datetime
 import os
 import requests
 import sys
+import time
 import yaml
-import json
 import re
 
+import context_window
+import http_pool
+import providers
+import ratelimit
+import session_log
+import tokens
+import usage_ledger
 from pathlib import Path
 from prompt_toolkit import PromptSession, HTML
 from prompt_toolkit.history import FileHistory
 from rich.console import Console
+from rich.live import Live
 from rich.markdown import Markdown
 
 WORKDIR = Path(__file__).parent
@@ -23,17 +31,7 @@ BASE_ENDPOINT = "https://api.openai.com/v1"
 ENV_VAR = "OPENAI_API_KEY"
 SAVE_FOLDER = "session-history"
 # contains the model name
-SAVE_FILE = "llm-session-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
-
-# https://openai.com/api/pricing/
-PRICING_RATE = {
-    "gpt-3.5-turbo-0125": {"prompt": 0.5/1e6, "completion": 1.5/1e6},
-    "gpt-3.5-turbo-instruct": {"prompt": 1.5/1e6, "completion": 2/1e6},
-    "gpt-4": {"prompt": 30/1e6, "completion": 60/1e6},
-    "gpt-4-turbo": {"prompt": 10/1e6, "completion": 15/1e6},
-    "gpt-4-32k": {"prompt": 60/1e6, "completion": 120/1e6},
-    "gpt-4o": {"prompt": 5/1e6, "completion": 15/1e6},
-}
+SAVE_FILE = "llm-session-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".jsonl"
 
 
 # Initialize the messages history list
@@ -42,6 +40,13 @@ messages = []
 # Initialize the token counters
 prompt_tokens = 0
 completion_tokens = 0
+# the part of the prompt tokens read from and written to the provider prompt cache
+cached_tokens = 0
+cache_write_tokens = 0
+# Append-only log of the messages, see session_log.py
+log = None
+# Length of the summary of the old turns with the summarize context policy
+SUMMARY_MAX_TOKENS = 500
 # Initialize the console
 console = Console()
 
@@ -57,6 +62,12 @@ def load_config(config_file: str) -> dict:
     # note max_tokens are for output tokens, not for input tokens
     if "max_tokens" not in config:
         config["max_tokens"] = 100 # default, otherwise see config.yaml
+    # stream tokens as they arrive, the time to first token is what the user feels
+    if "stream" not in config:
+        config["stream"] = True
+    # what to do with the old turns when the conversation outgrows the context window
+    if "context-policy" not in config:
+        config["context-policy"] = "sliding-window"
 
     return config
 
@@ -77,35 +88,21 @@ def add_markdown_system_message() -> None:
     messages.append({"role": "system", "content": instruction})
 
 
-def calculate_expense(
-    prompt_tokens: int,
-    completion_tokens: int,
-    prompt_pricing: float,
-    completion_pricing: float,
-) -> float:
-    """
-    Calculate the expense, given the number of tokens and the pricing rates
-    """
-    expense = ((prompt_tokens) * prompt_pricing) + (
-        (completion_tokens) * completion_pricing
-    )
-    return round(expense, 6)
-
-
-def display_expense(model: str) -> None:
+def display_expense(model: str, config: dict) -> None:
     """
     Given the model used, display total tokens used and estimated expense
     """
-    total_expense = calculate_expense(
-        prompt_tokens,
-        completion_tokens,
-        PRICING_RATE[model]["prompt"],
-        PRICING_RATE[model]["completion"],
-    )
     console.print(
         f"\nTotal tokens used: [green bold]{prompt_tokens + completion_tokens}"
     )
-    console.print(f"Estimated expense: [green bold]${total_expense}")
+    if cached_tokens:
+        console.print(f"Prompt tokens read from the cache: [green bold]{cached_tokens}")
+    # $ per token, see the capabilities of each provider in providers.py
+    total_expense = usage_ledger.cost(model, prompt_tokens, completion_tokens, config, cached_tokens, cache_write_tokens)
+    if total_expense is None:
+        console.print(f"Estimated expense: [yellow bold]unknown pricing for {model}")
+        return
+    console.print(f"Estimated expense: [green bold]${round(total_expense, 6)}")
 
 
 def get_openai_model(config):
@@ -129,7 +126,7 @@ def get_openai_model(config):
     }
     
     try:
-        r = requests.get(f"{BASE_ENDPOINT}/models", headers=headers)
+        r = http_pool.get("openai", f"{BASE_ENDPOINT}/models", config, headers=headers)
         r.raise_for_status()
         
         models = r.json()['data']
@@ -161,42 +158,11 @@ def get_openai_model(config):
         return "gpt-3.5-turbo"
 
 
-def prompt_openai_api(messages, config):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {config['api-key']}",
-    }
-
-    # Base body parameters
-    body = {
-        "model": config["model"],
-        "temperature": config["temperature"],
-        "messages": messages,
-    }
-    # Optional parameter
-    if "max_tokens" in config:
-        body["max_tokens"] = config["max_tokens"]
-
-    r = None
-    try:
-        r = requests.post(
-            f"{BASE_ENDPOINT}/chat/completions", headers=headers, json=body
-        )
-    except requests.ConnectionError:
-        console.print("Connection error, try again...", style="red bold")
-        messages.pop()
-        raise KeyboardInterrupt
-    except requests.Timeout:
-        console.print("Connection timed out, try again...", style="red bold")
-        messages.pop()
-        raise KeyboardInterrupt
-    return r
-
 def start_prompt(session: PromptSession, config: dict) -> None:
     """
     Ask the user for input, build the request and perform it
     """
-
+    global prompt_tokens, completion_tokens, cached_tokens, cache_write_tokens
 
     message = session.prompt(HTML(f"<b>[{prompt_tokens + completion_tokens}] >>> </b>"))
 
@@ -207,105 +173,125 @@ def start_prompt(session: PromptSession, config: dict) -> None:
 
     messages.append({"role": "user", "content": message})
 
-    lines = []
-    if config["model"].startswith("gpt"):
-        r = prompt_openai_api(messages, config)
-        lines = parse_openai(r, config, messages)
-    elif config["model"].startswith("claude"):
-        # call the anthropic API
-        lines = call_anthropic_api(messages, config)
-        # print(lines)
-    with open(os.path.join(SAVE_FOLDER, SAVE_FILE), "w") as f:
-        json.dump({"model": config["model"], "messages": messages}, f, indent=4)
-
+    try:
+        messages[:] = fit_context(messages, config)
+    except context_window.ContextOverflow as e:
+        console.print(f"Maximum context length exceeded: {e}", style="red bold")
+        messages.pop()
+        raise KeyboardInterrupt
 
+    ledger = usage_ledger.get_ledger(config)
+    estimated_tokens = tokens.count_message_tokens(messages, config["model"])
+    timings = {}
+    start = time.monotonic()
+    content, usage, lines = call_provider(messages, config, timings)
+    timings["total"] = round(time.monotonic() - start, 3)
+    messages.append({"role": "assistant", "content": content})
+    if ledger is not None:
+        # the counts missing from the provider answer (eg an interrupted stream) are estimated locally
+        usage = ledger.record(config["model"], estimated_tokens, usage, content)
+    prompt_tokens += usage.get("prompt_tokens", 0)
+    completion_tokens += usage.get("completion_tokens", 0)
+    cached_tokens += usage.get("cached_tokens", 0)
+    cache_write_tokens += usage.get("cache_write_tokens", 0)
+
+    # only the turn is appended, the user message is logged once it got an answer
+    log.append(messages[-2])
+    log.append(messages[-1], usage=usage, timings=timings, model=config["model"])
 
     for line in lines:
         console.print(line)
 
-def call_anthropic_api(messages, config):
-    url = "https://api.anthropic.com/v1/messages"
-    headers = {
-        "x-api-key": os.environ["ANTHROPIC_API_KEY"],
-        "anthropic-version": "2023-06-01",
-        "Content-Type": "application/json"
-    }
-    # data = {
-    #     "prompt": "\n".join([m["content"] for m in messages]),
-    #     "max_tokens": 100,  # Adjust as needed
-    #     "top_p": 1.0,  # Adjust as needed
-    #     "stop_sequences": []  # Adjust as needed
-    # }
-    data = {
-        "model": config["model"],
-        "temperature": config["temperature"],
-        "messages": messages,
-        "max_tokens": config["max_tokens"],
-    }
+def fit_context(messages, config):
+    """
+    Apply the context policy so that the request fits the context window of the model,
+    counted locally before sending (see context_window.py)
+    """
+    provider = providers.provider_for_model(config["model"], config)
+    window = config.get("context-window") or provider.capabilities(config["model"]).get("context_window")
+    if window is None:
+        return messages
 
-    response = requests.post(url, headers=headers, json=data)
-    # print(response.json())
-    if response.status_code == 200:
-        answer = response.json()["content"][0]
-        answer["role"] = "assistant"
-        answer["content"] = answer["text"]
-        del answer["text"]
-        del answer["type"]
-        messages.append(answer)
-
-        return [x["text"] for x in response.json()["content"]]
-    else:
-        print(f"Error: {response.status_code}, {response.text}")
-        return None
-
-def parse_openai(r, config, messages):
-    # TODO: Refactor to avoid a global variables
-    global prompt_tokens, completion_tokens
-    result = []
-    # console.log(r.json())
-    if r.status_code == 200:
-        response = r.json()
-        # console.log(response)
-        message_response = response["choices"][0]["message"]
-        usage_response = response["usage"]
-
-        result.append("\n")
-        if config["markdown"]:
-            result.append(Markdown(message_response["content"].strip(), code_theme="lightbulb"))
-        else:
-            result.append(message_response["content"].strip())
-        result.append("\n")
-
-        prompt_tokens += usage_response["prompt_tokens"]
-        completion_tokens += usage_response["completion_tokens"]
-
-    elif r.status_code == 400:
-        response = r.json()
-        console.log(response)
-        if "error" in response:
-            if response["error"]["code"] == "context_length_exceeded":
-                result.append("Maximum context length exceeded", style="red bold")
-                raise EOFError
-                # TODO: Develop a better strategy to manage this case
-        result.append("Invalid request", style="bold red")
-        raise EOFError
+    def summarize(old):
+        console.print("Summarizing the earlier conversation...", style="yellow")
+        text = context_window.conversation_text(old, config["model"], context_window.budget(window, SUMMARY_MAX_TOKENS) // 2)
+        prompt = [{"role": "user", "content": "Summarize the following conversation concisely, keeping the facts, decisions and code needed to continue it.\n\n" + text}]
+        return provider.complete(prompt, config["model"], 0, SUMMARY_MAX_TOKENS)["content"]
 
-    elif r.status_code == 401:
-        result.append("Invalid API Key", style="bold red")
-        raise EOFError
+    return context_window.fit_messages(messages, config["model"], window, config["max_tokens"], config["context-policy"], summarize)
 
-    elif r.status_code == 429:
-        result.append("Rate limit or maximum monthly limit exceeded", style="bold red")
+def call_provider(messages, config, timings=None):
+    """
+    Send the conversation to the provider serving the model (see providers.py),
+    and return the answer, its usage and the lines left to print
+    """
+    provider = providers.provider_for_model(config["model"], config)
+    usage = {}
+    timings = {} if timings is None else timings
+    start = time.monotonic()
+    try:
+        if config["stream"]:
+            deltas = provider.stream(messages, config["model"], config["temperature"], config["max_tokens"], usage)
+            return render_stream(deltas, config, timings), usage, ["\n"]
+        completion = provider.complete(messages, config["model"], config["temperature"], config["max_tokens"])
+    except ratelimit.RateLimitExceeded:
+        console.print("Rate limit or maximum monthly limit exceeded", style="red bold")
         messages.pop()
         raise KeyboardInterrupt
+    except requests.ConnectionError:
+        console.print("Connection error, try again...", style="red bold")
+        messages.pop()
+        raise KeyboardInterrupt
+    except requests.Timeout:
+        console.print("Connection timed out, try again...", style="red bold")
+        messages.pop()
+        raise KeyboardInterrupt
+    except providers.ProviderError as e:
+        handle_provider_error(e, messages)
 
+    timings["first_token"] = round(time.monotonic() - start, 3)
+    content = completion["content"]
+    if config["markdown"]:
+        lines = ["\n", Markdown(content.strip(), code_theme="lightbulb"), "\n"]
     else:
-        response = r.json()
-        console.log(response)
-        result.append(f"Unknown error, status code {r.status_code}", style="bold red")
-        result.append(r.json())
-        raise EOFError
-    return result
+        lines = ["\n", content.strip(), "\n"]
+    return content, completion["usage"], lines
+
+def render_stream(deltas, config, timings=None) -> str:
+    """
+    Render text deltas incrementally on the console and return the full text
+    """
+    content = ""
+    start = time.monotonic()
+    console.print("\n")
+    with Live(console=console, refresh_per_second=10, vertical_overflow="visible") as live:
+        for delta in deltas:
+            if not content and timings is not None:
+                timings["first_token"] = round(time.monotonic() - start, 3)
+            content += delta
+            if config["markdown"]:
+                live.update(Markdown(content.strip(), code_theme="lightbulb"))
+            else:
+                live.update(content.strip())
+    return content
+
+def handle_provider_error(error, messages):
+    """
+    Report an error answer of the provider and end the session
+    """
+    console.log(error.body)
+    if error.code == "context_length_exceeded":
+        # the local count of fit_context was too optimistic, the session can go on with a shorter message
+        console.print("Maximum context length exceeded", style="red bold")
+        messages.pop()
+        raise KeyboardInterrupt
+    elif error.status_code == 400:
+        console.print("Invalid request", style="bold red")
+    elif error.status_code == 401:
+        console.print("Invalid API Key", style="bold red")
+    else:
+        console.print(f"Unknown error, status code {error.status_code}", style="bold red")
+    raise EOFError
 
 @click.command()
 @click.option(
@@ -321,7 +307,21 @@ def parse_openai(r, config, messages):
 @click.option(
     "-ml", "--multiline", "multiline", is_flag=True, help="Use the multiline input mode"
 )
-def main(context, api_key, model, multiline) -> None:
+@click.option(
+    "--stream/--no-stream", "stream", default=None, help="Render the answer token by token"
+)
+@click.option(
+    "-r", "--resume", "resume", type=click.Path(exists=True), help="Resume a session from its .jsonl log"
+)
+@click.option(
+    "--fsync",
+    "fsync",
+    type=click.Choice(session_log.FSYNC_POLICIES),
+    default=None,
+    help="When to fsync the session log (default: turn)",
+)
+def main(context, api_key, model, multiline, stream, resume, fsync) -> None:
+    global log, prompt_tokens, completion_tokens
     history = FileHistory(HISTORY_FILE)
     if multiline:
         session = PromptSession(history=history, multiline=True)
@@ -348,9 +348,18 @@ def main(context, api_key, model, multiline) -> None:
     # If the --model command line argument is used overwrite the configuration
     if model:
         config["model"] = model.strip()
-
-    # Run the display expense function when exiting the script
-    # atexit.register(display_expense, model=config["model"])
+    if stream is not None:
+        config["stream"] = stream
+
+    if resume:
+        resumed_model, resumed_messages, usage = session_log.load_session(resume)
+        messages.extend(resumed_messages)
+        prompt_tokens += usage["prompt_tokens"]
+        completion_tokens += usage["completion_tokens"]
+        # the model of the session, unless another one is asked for
+        if resumed_model and not model:
+            config["model"] = resumed_model
+        console.print(f"Resumed session: [green bold]{resume} ({len(resumed_messages)} messages)")
 
     #console.print("ChatGPT CLI", style="bold")
     console.print(f"Model in use: [green bold]{config['model']}")
@@ -358,7 +367,8 @@ def main(context, api_key, model, multiline) -> None:
     console.print(f"Max tokens: [green bold]{config['max_tokens']}")
 
     # Add the system message for code blocks in case markdown is enabled in the config file
-    if config["markdown"]:
+    # a resumed session already has it
+    if config["markdown"] and not resume:
         add_markdown_system_message()
 
     # Context from the command line option
@@ -370,6 +380,14 @@ def main(context, api_key, model, multiline) -> None:
     if config["model"].startswith("gpt") and config["model"].endswith("ask"):
         config["model"] = get_openai_model(config)
 
+    # Run the display expense function when exiting the script, once the model is chosen
+    atexit.register(display_expense, model=config["model"], config=config)
+
+    log = session_log.SessionLog(resume or os.path.join(SAVE_FOLDER, SAVE_FILE), config["model"], fsync or config.get("session-fsync", "turn"))
+    # the system and context messages of this run
+    for m in messages[len(resumed_messages) if resume else 0:]:
+        log.append(m)
+
     console.rule()
 
     while True:
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# content-addressed on-disk cache of LLM answers, backed by SQLite
+# the key is a hash of (provider, model, temperature, messages)
+# ./llm_cache.py stats|evict|clear
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm-cache.sqlite")
+# seconds, None means forever, see 'cache-max-age' in config.yaml
+DEFAULT_MAX_AGE = None
+# megabytes of stored answers, see 'cache-max-size' in config.yaml
+DEFAULT_MAX_SIZE = 256
+# eviction is checked every EVICT_EVERY insertions
+EVICT_EVERY = 100
+
+
+def cache_key(provider, model, temperature, messages):
+    """Return the hex digest identifying a request, independent of dict ordering"""
+    payload = json.dumps([provider, model, temperature, messages], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+
+class Cache:
+    """SQLite store mapping request keys to answers, with age- and size-based eviction"""
+
+    def __init__(self, path=DEFAULT_PATH, max_age=DEFAULT_MAX_AGE, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, answer TEXT, size INTEGER, created REAL, accessed REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS answers_accessed ON answers (accessed)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+        self._db.commit()
+
+    def get(self, key):
+        """Return the cached answer or None, and count the hit or miss"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT answer, created FROM answers WHERE key=?', (key,)).fetchone()
+            if row is not None and self.max_age is not None and now - row[1] > self.max_age:
+                self._db.execute('DELETE FROM answers WHERE key=?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                self._count('misses')
+                self._db.commit()
+                return None
+            self.hits += 1
+            self._count('hits')
+            self._db.execute('UPDATE answers SET accessed=? WHERE key=?', (now, key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key, answer):
+        """Store an answer, evicting old entries from time to time"""
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)', (key, answer, len(answer.encode('utf8')), now, now))
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 1:
+                self._evict(now)
+            self._db.commit()
+
+    def evict(self):
+        """Remove expired entries, then least recently used ones until under max_size"""
+        with self._lock:
+            removed = self._evict(time.time())
+            self._db.commit()
+            return removed
+
+    def _evict(self, now):
+        removed = 0
+        if self.max_age is not None:
+            removed += self._db.execute('DELETE FROM answers WHERE created < ?', (now - self.max_age,)).rowcount
+        if self.max_size is not None:
+            budget = self.max_size * 1024 * 1024
+            total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM answers').fetchone()[0]
+            for key, size in self._db.execute('SELECT key, size FROM answers ORDER BY accessed').fetchall():
+                if total <= budget:
+                    break
+                self._db.execute('DELETE FROM answers WHERE key=?', (key,))
+                total -= size
+                removed += 1
+        return removed
+
+    def _count(self, name):
+        self._db.execute('INSERT INTO stats VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value=value+1', (name,))
+
+    def stats(self):
+        """Return the number of entries, their size in bytes and the lifetime hit/miss counters"""
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers').fetchone()
+            counters = dict(self._db.execute('SELECT name, value FROM stats').fetchall())
+        return {'entries': entries, 'bytes': size, 'hits': counters.get('hits', 0), 'misses': counters.get('misses', 0)}
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._db.execute('DELETE FROM answers')
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def from_config(config):
+    """Open the cache configured by the cache-* keys of config.yaml"""
+    return Cache(config.get('cache-path', DEFAULT_PATH), config.get('cache-max-age', DEFAULT_MAX_AGE), config.get('cache-max-size', DEFAULT_MAX_SIZE))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('stats', 'evict', 'clear'):
+        print('llm_cache.py stats|evict|clear', file=sys.stderr)
+        sys.exit(-1)
+    import fileio
+    cache = from_config(fileio.load_config())
+    if sys.argv[1] == 'stats':
+        print(json.dumps(cache.stats(), indent=2))
+    if sys.argv[1] == 'evict':
+        print(cache.evict(), 'entries removed')
+    if sys.argv[1] == 'clear':
+        cache.clear()
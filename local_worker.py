@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# keeps a local model resident in a long-lived CPU worker, serving completions over a Unix socket
+# the 'local' provider runs the llm CLI per prompt and pays the model load every time,
+# the 'local-worker' provider (providers.py) starts this worker on first use and then only pays the inference
+# the model answers one prompt at a time (neither backend has a batched call): the requests arriving together are
+# grouped only so that identical deterministic prompts are computed once, the others wait their turn
+# the model is a name of the llm library (https://llm.datasette.io), or the path of a .gguf file for llama-cpp-python
+# ./local_worker.py serve [model]   ./local_worker.py status [model]   ./local_worker.py stop [model]
+import fcntl
+import hashlib
+import json
+import os
+import queue
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL = 'mistral-7b-instruct-v0'
+# requests arriving within BATCH_WINDOW seconds of each other are grouped, at most BATCH_SIZE, see Worker.run
+BATCH_WINDOW = 0.005
+BATCH_SIZE = 16
+# seconds without requests before the worker exits and frees the memory, see 'local-idle-timeout'
+IDLE_TIMEOUT = 1800
+# seconds to wait for a starting worker to load its model, see 'local-start-timeout'
+START_TIMEOUT = 300
+# the local-* keys of the config of the process starting a worker, as JSON, so that both use the same socket and settings
+CONFIG_VARIABLE = 'LOCAL_WORKER_CONFIG'
+# one lock per socket, so that the threads of a process starting the same worker wait for the first one
+_start_locks = {}
+# names of the completion options in the llm plugins, the first one a model declares is used
+OPTION_ALIASES = {'temperature': ('temperature', 'temp'), 'max_tokens': ('max_tokens', 'max_new_tokens', 'num_predict')}
+
+
+def socket_path(model, config=None):
+    """Return the socket of the worker serving model, one per model and user"""
+    directory = (config or {}).get('local-socket-dir') or tempfile.gettempdir()
+    digest = hashlib.sha256(model.encode('utf8')).hexdigest()[:12]
+    return os.path.join(directory, f'gakollm-local-{os.getuid()}-{digest}.sock')
+
+
+def import_llm_library():
+    """Import the llm library, which our llm.py shadows when this directory is on sys.path"""
+    path = sys.path
+    sys.path = [p for p in path if os.path.abspath(p or '.') != HERE]
+    try:
+        import llm
+    finally:
+        sys.path = path
+    return llm
+
+
+class LlmLibraryBackend:
+    """A model of the llm library, loaded once"""
+
+    def __init__(self, model):
+        self.model = import_llm_library().get_model(model)
+
+    def complete(self, prompt, max_tokens, temperature):
+        content = self.model.prompt(prompt, **self.options(max_tokens=max_tokens, temperature=temperature)).text()
+        return content, {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4}
+
+    def options(self, **values):
+        """Return the options the plugin serving the model declares, under its names (eg temp for gpt4all),
+        the plugins reject the others"""
+        options = getattr(self.model, 'Options', None)
+        fields = getattr(options, 'model_fields', None) or getattr(options, '__fields__', None) or {}
+        accepted = {}
+        for name, value in values.items():
+            for alias in OPTION_ALIASES.get(name, (name,)):
+                if value is not None and alias in fields:
+                    accepted[alias] = value
+                    break
+        return accepted
+
+
+class LlamaCppBackend:
+    """A .gguf model loaded once by llama-cpp-python, on the CPU"""
+
+    def __init__(self, path, config):
+        from llama_cpp import Llama
+        self.model = Llama(model_path=path, n_ctx=config.get('local-context-window', 8192), n_gpu_layers=0, verbose=False)
+
+    def complete(self, prompt, max_tokens, temperature):
+        response = self.model.create_completion(prompt, max_tokens=max_tokens or 1024, temperature=0 if temperature is None else temperature)
+        usage = response['usage']
+        return response['choices'][0]['text'], {'prompt_tokens': usage['prompt_tokens'], 'completion_tokens': usage['completion_tokens']}
+
+
+def load_backend(model, config):
+    if model.endswith('.gguf'):
+        return LlamaCppBackend(model, config)
+    return LlmLibraryBackend(model)
+
+
+class Worker:
+    """Serves the requests queued by the connections on one resident model, one prompt at a time"""
+
+    def __init__(self, model, config):
+        self.model = model
+        self.backend = load_backend(model, config)
+        self.batch_size = config.get('local-batch-size', BATCH_SIZE)
+        self.requests = queue.Queue()
+        self.last_request = time.monotonic()
+        self.served = 0
+        self.batches = 0
+
+    def submit(self, request):
+        """Queue a request and wait for its answer"""
+        self.last_request = time.monotonic()
+        done = threading.Event()
+        item = {'request': request, 'done': done}
+        self.requests.put(item)
+        done.wait()
+        return item['response']
+
+    def take_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + BATCH_WINDOW
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.requests.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            self.batches += 1
+            answers = {}
+            for item in batch:
+                request = item['request']
+                # with temperature 0 the same prompt gets the same answer, the other requests run one after another
+                key = json.dumps([request['prompt'], request.get('max_tokens')]) if not request.get('temperature') else id(item)
+                if key not in answers:
+                    start = time.monotonic()
+                    try:
+                        content, usage = self.backend.complete(request['prompt'], request.get('max_tokens'), request.get('temperature'))
+                        answers[key] = {'content': content, 'model': self.model, 'usage': usage, 'seconds': time.monotonic() - start}
+                    except Exception as e:
+                        answers[key] = {'error': f'{type(e).__name__}: {e}'}
+                item['response'] = answers[key]
+                self.served += 1
+                item['done'].set()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            worker = self.server.worker
+            if request.get('type') == 'status':
+                response = {'model': worker.model, 'pid': os.getpid(), 'served': worker.served, 'batches': worker.batches, 'queued': worker.requests.qsize()}
+            elif request.get('type') == 'stop':
+                response = {'stopping': True}
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                response = worker.submit(request)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf8'))
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def request(model, payload, config=None, timeout=None):
+    """Send a request to the worker of model and return its response, raise OSError if there is no worker"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path(model, config))
+        client.sendall((json.dumps(payload) + '\n').encode('utf8'))
+        response = b''
+        while not response.endswith(b'\n'):
+            data = client.recv(65536)
+            if not data:
+                raise ConnectionError('the local worker closed the connection')
+            response += data
+    return json.loads(response)
+
+
+def start(model, config=None):
+    """Start a worker for model in the background and wait until it serves, its log is next to its socket.
+    The concurrent starts, of this process or of others, wait for the first one instead of spawning their own worker."""
+    config = config or {}
+    path = socket_path(model, config)
+    with _start_locks.setdefault(path, threading.Lock()), open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # started while we waited for the lock
+            return request(model, {'type': 'status'}, config, timeout=5)
+        except OSError:
+            pass
+        return spawn(model, config, path)
+
+
+def spawn(model, config, path):
+    """Run a worker for model in a new session and wait until it serves on path"""
+    environment = dict(os.environ, **{CONFIG_VARIABLE: json.dumps({k: v for k, v in config.items() if k.startswith('local-')})})
+    with open(path + '.log', 'a') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(HERE, 'local_worker.py'), 'serve', model], stdin=subprocess.DEVNULL,
+                                   stdout=log, stderr=log, env=environment, start_new_session=True)
+    deadline = time.monotonic() + config.get('local-start-timeout', START_TIMEOUT)
+    while time.monotonic() < deadline:
+        try:
+            return request(model, {'type': 'status'}, config, timeout=5)
+        except OSError:
+            # exited without serving: the model did not load, or another worker serves it
+            if process.poll() is not None and not os.path.exists(path):
+                break
+            time.sleep(0.2)
+    raise Exception(f'the local worker for {model} did not start, see {path}.log')
+
+
+def complete(model, prompt, max_tokens=None, temperature=None, config=None):
+    """Return the completion of prompt by the worker of model, starting it if needed"""
+    payload = {'prompt': prompt, 'max_tokens': max_tokens, 'temperature': temperature}
+    try:
+        response = request(model, payload, config)
+    except (FileNotFoundError, ConnectionRefusedError):
+        start(model, config)
+        response = request(model, payload, config)
+    if 'error' in response:
+        raise Exception(f'local worker: {response["error"]}')
+    return response
+
+
+def serve(model, config):
+    path = socket_path(model, config)
+    try:
+        request(model, {'type': 'status'}, config, timeout=5)
+        print(f'a worker already serves {model} on {path}', file=sys.stderr)
+        return
+    except OSError:
+        if os.path.exists(path):
+            # left by a worker that died
+            os.unlink(path)
+    print(f'loading {model}', file=sys.stderr)
+    worker = Worker(model, config)
+    threading.Thread(target=worker.run, daemon=True).start()
+    server = Server(path, Handler)
+    server.worker = worker
+    os.chmod(path, 0o600)
+    idle_timeout = config.get('local-idle-timeout', IDLE_TIMEOUT)
+
+    def exit_when_idle():
+        while True:
+            time.sleep(min(60, idle_timeout))
+            if worker.requests.empty() and time.monotonic() - worker.last_request > idle_timeout:
+                server.shutdown()
+                return
+    threading.Thread(target=exit_when_idle, daemon=True).start()
+    print(f'serving {model} on {path}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    import fileio
+    # started by start(): the settings of the caller, otherwise those of config.yaml
+    config = json.loads(os.environ[CONFIG_VARIABLE]) if CONFIG_VARIABLE in os.environ else fileio.load_config()
+    if len(sys.argv) < 2 or sys.argv[1] not in ('serve', 'status', 'stop'):
+        print('local_worker.py serve|status|stop [model]', file=sys.stderr)
+        sys.exit(-1)
+    model = sys.argv[2] if len(sys.argv) > 2 else config.get('local-model', DEFAULT_MODEL)
+    if sys.argv[1] == 'serve':
+        serve(model, config)
+    else:
+        try:
+            print(request(model, {'type': sys.argv[1]}, config, timeout=5))
+        except OSError:
+            print(f'no worker serves {model}', file=sys.stderr)
+            sys.exit(1)
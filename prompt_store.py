@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# log of the prompts of exec-llm.py, backed by SQLite, replacing the scan of prompts.txt
+# each prompt is stored once (unique index on its hash), searchable with full-text search (FTS5),
+# with the artefacts written for it (.txt record, .py program) and the results of their executions (sandbox.py)
+# ./prompt_store.py search <words>   ./prompt_store.py show <id>   ./prompt_store.py import [prompts.txt]   ./prompt_store.py stats
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".prompts.sqlite")
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode('utf8')).hexdigest()
+
+
+class PromptStore:
+    """SQLite store of the prompts, their artefacts and executions"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA foreign_keys=ON')
+        self._db.execute('CREATE TABLE IF NOT EXISTS prompts (id INTEGER PRIMARY KEY, hash TEXT UNIQUE, prompt TEXT, created REAL, used REAL, uses INTEGER)')
+        # kind is 'record' (prompt, program and answer) or 'program', path is absolute
+        self._db.execute('CREATE TABLE IF NOT EXISTS artefacts (id INTEGER PRIMARY KEY, prompt INTEGER REFERENCES prompts(id), kind TEXT, path TEXT, created REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS artefacts_prompt ON artefacts (prompt)')
+        # the result dicts of sandbox.Sandbox.run
+        self._db.execute('CREATE TABLE IF NOT EXISTS executions (id INTEGER PRIMARY KEY, prompt INTEGER REFERENCES prompts(id), artefact INTEGER REFERENCES artefacts(id), '
+                         'status TEXT, returncode INTEGER, duration REAL, result TEXT, created REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS executions_prompt ON executions (prompt)')
+        try:
+            # an external content index, the text is only stored in prompts
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS prompts_fts USING fts5(prompt, content='prompts', content_rowid='id')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5, search falls back to LIKE
+            self.fts = False
+        self._db.commit()
+
+    def add(self, prompt, use=True):
+        """Record a use of the prompt (or only the prompt, if not use) and return (its id, True if it is new)"""
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute('INSERT OR IGNORE INTO prompts (hash, prompt, created, used, uses) VALUES (?, ?, ?, ?, ?)', (prompt_hash(prompt), prompt, now, now, int(use)))
+            new = cursor.rowcount == 1
+            if new:
+                prompt_id = cursor.lastrowid
+                if self.fts:
+                    self._db.execute('INSERT INTO prompts_fts (rowid, prompt) VALUES (?, ?)', (prompt_id, prompt))
+            else:
+                prompt_id = self._db.execute('SELECT id FROM prompts WHERE hash=?', (prompt_hash(prompt),)).fetchone()[0]
+                if use:
+                    self._db.execute('UPDATE prompts SET used=?, uses=uses+1 WHERE id=?', (now, prompt_id))
+            self._db.commit()
+        return prompt_id, new
+
+    def __contains__(self, prompt):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM prompts WHERE hash=?', (prompt_hash(prompt),)).fetchone() is not None
+
+    def add_artefact(self, prompt_id, path, kind):
+        """Link a file written for the prompt and return its id"""
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO artefacts (prompt, kind, path, created) VALUES (?, ?, ?, ?)', (prompt_id, kind, os.path.abspath(path), time.time()))
+            self._db.commit()
+            return cursor.lastrowid
+
+    def add_execution(self, prompt_id, result, artefact_id=None):
+        """Record the result of running a program of the prompt, see sandbox.Sandbox.run"""
+        with self._lock:
+            self._db.execute('INSERT INTO executions (prompt, artefact, status, returncode, duration, result, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (prompt_id, artefact_id, result['status'], result['returncode'], result['duration'], json.dumps(result), time.time()))
+            self._db.commit()
+
+    def search(self, query, limit=20):
+        """Return [(id, prompt)] of the prompts containing all the words of the query, best first (LIKE substring without FTS5)"""
+        with self._lock:
+            if self.fts:
+                # each word is quoted as an FTS5 phrase, so that punctuation (hello-world, print("x) is searched and not parsed as query syntax
+                match = ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+                if not match:
+                    return []
+                return self._db.execute('SELECT rowid, prompt FROM prompts_fts WHERE prompts_fts MATCH ? ORDER BY rank LIMIT ?', (match, limit)).fetchall()
+            return self._db.execute("SELECT id, prompt FROM prompts WHERE prompt LIKE ? ESCAPE '\\' ORDER BY used DESC LIMIT ?",
+                                    ('%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%', limit)).fetchall()
+
+    def get(self, prompt_id):
+        """Return the prompt with its artefacts and executions, or None"""
+        with self._lock:
+            row = self._db.execute('SELECT id, prompt, created, used, uses FROM prompts WHERE id=?', (prompt_id,)).fetchone()
+            if row is None:
+                return None
+            artefacts = self._db.execute('SELECT id, kind, path, created FROM artefacts WHERE prompt=? ORDER BY id', (prompt_id,)).fetchall()
+            executions = self._db.execute('SELECT artefact, result FROM executions WHERE prompt=? ORDER BY id', (prompt_id,)).fetchall()
+        return {'id': row[0], 'prompt': row[1], 'created': row[2], 'used': row[3], 'uses': row[4],
+                'artefacts': [dict(zip(('id', 'kind', 'path', 'created'), a)) for a in artefacts],
+                'executions': [{'artefact': artefact, **json.loads(result)} for artefact, result in executions]}
+
+    def import_text(self, path):
+        """Add the prompts of a prompts.txt written by exec-llm.py (separated by blank lines), return the number of new ones"""
+        with open(path) as f:
+            prompts = [p.strip('\n') for p in f.read().split('\n\n')]
+        return sum(self.add(p, use=False)[1] for p in prompts if p.strip())
+
+    def stats(self):
+        with self._lock:
+            return {table: self._db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in ('prompts', 'artefacts', 'executions')}
+
+    def close(self):
+        self._db.close()
+
+
+def from_config(config):
+    """Return the store configured by 'prompt-store-path' in config.yaml"""
+    return PromptStore(config.get('prompt-store-path', DEFAULT_PATH))
+
+
+if __name__ == '__main__':
+    import fileio
+    store = from_config(fileio.load_config())
+    if len(sys.argv) >= 3 and sys.argv[1] == 'search':
+        for prompt_id, prompt in store.search(' '.join(sys.argv[2:])):
+            print(f'{prompt_id}: ' + prompt.replace('\n', ' ')[:120])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'show':
+        print(json.dumps(store.get(int(sys.argv[2])), indent=2))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'import':
+        print(f"{store.import_text(sys.argv[2] if len(sys.argv) > 2 else 'prompts.txt')} new prompts")
+    elif len(sys.argv) == 2 and sys.argv[1] == 'stats':
+        print(store.stats())
+    else:
+        print('prompt_store.py search <words> | show <id> | import [prompts.txt] | stats', file=sys.stderr)
+        sys.exit(-1)
@@ -0,0 +1,484 @@
+#!/usr/bin/python3
+# registry of the LLM provider backends
+# every backend exposes the same interface: complete, stream, acomplete and batch,
+# plus capability metadata (context window, pricing) per model
+# from providers import get_provider, provider_for_model
+import json
+import os
+import subprocess
+
+import http_pool
+import ratelimit
+
+PROVIDERS = {}
+_instances = {}
+
+
+class ProviderError(Exception):
+    """Raised when a provider answers with an error status"""
+
+    def __init__(self, provider, status_code, body):
+        super().__init__(f'{provider}: error {status_code}: {body}')
+        self.provider = provider
+        self.status_code = status_code
+        self.body = body
+
+    @property
+    def code(self):
+        """The error code of the body, eg 'context_length_exceeded', if any"""
+        if isinstance(self.body, dict) and isinstance(self.body.get('error'), dict):
+            return self.body['error'].get('code') or self.body['error'].get('type')
+        return None
+
+
+def register_provider(name):
+    """Class decorator adding a provider backend to the registry under the given name"""
+    def register(cls):
+        cls.name = name
+        PROVIDERS[name] = cls
+        return cls
+    return register
+
+
+def config_key(config):
+    """A hashable snapshot of a config, equal for configs with the same values"""
+    return json.dumps(config or {}, sort_keys=True, default=str)
+
+
+def get_provider(name, config=None):
+    """Return the backend registered under name, instantiated once per process and config"""
+    if name not in PROVIDERS:
+        raise Exception(f'unknown provider {name}, known providers are {", ".join(PROVIDERS)}')
+    # a backend reads its model, base URL and key from its config, a call with another config gets another backend
+    key = (name, config_key(config))
+    if key not in _instances:
+        _instances[key] = PROVIDERS[name](config or {})
+    return _instances[key]
+
+
+def provider_for_model(model, config=None):
+    """Return the backend serving the given model, eg 'gpt-4o' -> openai, 'claude-3-haiku' -> anthropic"""
+    for name, cls in PROVIDERS.items():
+        if any(model.startswith(prefix) for prefix in cls.model_prefixes):
+            return get_provider(name, config)
+    raise Exception(f'no provider for model {model}')
+
+
+def pricing_table():
+    """Return {model: {'prompt': $/token, 'completion': $/token}} for all known models"""
+    return {model: info['pricing'] for cls in PROVIDERS.values() for model, info in cls.models.items() if 'pricing' in info}
+
+
+def iter_sse(response):
+    """Yield the JSON payload of each server-sent event of a streaming response"""
+    for line in response.iter_lines(decode_unicode=True):
+        # skip keep-alive blank lines, comments and "event:" lines, the type is also in the payload
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return
+        yield json.loads(data)
+
+
+def join_messages(messages):
+    """Flatten chat messages into one prompt, for the completion-only APIs"""
+    return ' '.join(m['content'] for m in messages)
+
+
+class Provider:
+    """Base class of the provider backends.
+    Subclasses implement complete(), and stream() when the API supports it."""
+
+    name = None
+    # prefixes of the model names served by this provider, used by provider_for_model
+    model_prefixes = ()
+    default_model = None
+    default_temperature = None
+    # per model: context_window and max_output_tokens in tokens, pricing in $ per token
+    models = {}
+    supports_streaming = False
+    # several answers per request (complete_n)
+    supports_choices = False
+    # price of the prompt tokens read from (and written to) the provider prompt cache, relative to the prompt price
+    cache_read_factor = None
+    cache_write_factor = None
+
+    def __init__(self, config):
+        self.config = config
+
+    def model(self, model=None):
+        return model or self.default_model
+
+    def capabilities(self, model=None):
+        """Return the metadata of a model, matched by longest prefix, eg 'gpt-4o-2024-08-06' -> 'gpt-4o'"""
+        model = self.model(model)
+        matches = [name for name in self.models if model.startswith(name)]
+        info = dict(self.models[max(matches, key=len)]) if matches else {}
+        info.update({'provider': self.name, 'model': model, 'streaming': self.supports_streaming})
+        if 'pricing' in info and self.cache_read_factor is not None:
+            info['pricing'] = dict(info['pricing'], cached_prompt=info['pricing']['prompt'] * self.cache_read_factor,
+                                   cache_write=info['pricing']['prompt'] * (self.cache_write_factor or 1))
+        return info
+
+    def complete(self, messages, model=None, temperature=None, max_tokens=None):
+        """Return {'content': str, 'model': str, 'usage': {'prompt_tokens': int, 'completion_tokens': int}}"""
+        raise NotImplementedError
+
+    def stream(self, messages, model=None, temperature=None, max_tokens=None, usage=None):
+        """Yield the text of the answer as it arrives, and fill usage once known.
+        Providers without streaming yield the whole answer at once."""
+        completion = self.complete(messages, model, temperature, max_tokens)
+        if usage is not None:
+            usage.update(completion['usage'])
+        yield completion['content']
+
+    def complete_n(self, messages, n, model=None, temperature=None, max_tokens=None):
+        """Return {'contents': [n answers], 'model': str, 'usage': total usage}, sampled at temperature.
+        Providers without a number of choices per request send n requests concurrently."""
+        completions = self.batch([messages] * n, model, temperature, max_tokens, concurrency=n)
+        usage = {}
+        for completion in completions:
+            for key, value in completion['usage'].items():
+                usage[key] = usage.get(key, 0) + value
+        return {'contents': [c['content'] for c in completions], 'model': completions[0]['model'], 'usage': usage}
+
+    async def acomplete(self, messages, model=None, temperature=None, max_tokens=None):
+        """complete() without blocking the event loop"""
+        import asyncio
+        return await asyncio.to_thread(self.complete, messages, model, temperature, max_tokens)
+
+    def batch(self, conversations, model=None, temperature=None, max_tokens=None, concurrency=8):
+        """complete() each list of messages, concurrently, and return the completions in order"""
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(lambda messages: self.complete(messages, model, temperature, max_tokens), conversations))
+
+    def send(self, model, request, tokens=0):
+        """Send a request through the rate-limit scheduler and raise ProviderError on error statuses"""
+        response = ratelimit.get_scheduler(self.config).send(self.name, model, request, tokens)
+        if response.status_code != 200:
+            try:
+                body = response.json()
+            except ValueError:
+                body = response.text
+            raise ProviderError(self.name, response.status_code, body)
+        return response
+
+
+@register_provider('openai')
+class OpenAIProvider(Provider):
+    model_prefixes = ('gpt', 'o1', 'o3', 'o4')
+    default_temperature = 0  # for live coding
+    supports_streaming = True
+    supports_choices = True
+    # prompts sharing a prefix of 1024+ tokens are cached automatically, the cached tokens cost half
+    # https://platform.openai.com/docs/guides/prompt-caching
+    cache_read_factor = 0.5
+    # https://openai.com/api/pricing/
+    models = {
+        'gpt-3.5-turbo': {'context_window': 16385, 'max_output_tokens': 4096, 'pricing': {'prompt': 0.5/1e6, 'completion': 1.5/1e6}},
+        'gpt-3.5-turbo-0125': {'context_window': 16385, 'max_output_tokens': 4096, 'pricing': {'prompt': 0.5/1e6, 'completion': 1.5/1e6}},
+        'gpt-3.5-turbo-instruct': {'context_window': 4096, 'max_output_tokens': 4096, 'pricing': {'prompt': 1.5/1e6, 'completion': 2/1e6}},
+        'gpt-4': {'context_window': 8192, 'max_output_tokens': 8192, 'pricing': {'prompt': 30/1e6, 'completion': 60/1e6}},
+        'gpt-4-turbo': {'context_window': 128000, 'max_output_tokens': 4096, 'pricing': {'prompt': 10/1e6, 'completion': 15/1e6}},
+        'gpt-4-32k': {'context_window': 32768, 'max_output_tokens': 8192, 'pricing': {'prompt': 60/1e6, 'completion': 120/1e6}},
+        'gpt-4o': {'context_window': 128000, 'max_output_tokens': 16384, 'pricing': {'prompt': 5/1e6, 'completion': 15/1e6}},
+        'gpt-4o-mini': {'context_window': 128000, 'max_output_tokens': 16384, 'pricing': {'prompt': 0.15/1e6, 'completion': 0.6/1e6}},
+    }
+
+    @property
+    def default_model(self):
+        return self.config.get('model')
+
+    @property
+    def base_url(self):
+        return self.config.get('openai-base-url', 'https://api.openai.com/v1')
+
+    def post(self, model, body, stream=False):
+        headers = {'Content-Type': 'application/json', 'Authorization': f"Bearer {self.config['api-key']}"}
+        # only the prompt is reserved, the completion is charged from the usage once it is known
+        tokens = ratelimit.estimate_tokens(body['messages'])
+        return self.send(model, lambda: http_pool.post(self.name, f'{self.base_url}/chat/completions', self.config, headers=headers, json=body, stream=stream), tokens)
+
+    def body(self, messages, model, temperature, max_tokens):
+        body = {'model': model, 'messages': messages}
+        temperature = self.default_temperature if temperature is None else temperature
+        if temperature is not None:
+            body['temperature'] = temperature
+        if max_tokens:
+            body['max_tokens'] = max_tokens
+        return body
+
+    def complete(self, messages, model=None, temperature=None, max_tokens=None):
+        model = self.model(model)
+        response = self.post(model, self.body(messages, model, temperature, max_tokens)).json()
+        ratelimit.get_scheduler(self.config).consume(self.name, model, response['usage']['completion_tokens'])
+        return {'content': response['choices'][0]['message']['content'], 'model': response.get('model', model),
+                'usage': self.usage(response['usage'])}
+
+    def complete_n(self, messages, n, model=None, temperature=None, max_tokens=None):
+        # one request, the prompt tokens are paid once for the n choices
+        model = self.model(model)
+        body = self.body(messages, model, temperature, max_tokens)
+        body['n'] = n
+        response = self.post(model, body).json()
+        ratelimit.get_scheduler(self.config).consume(self.name, model, response['usage']['completion_tokens'])
+        return {'contents': [choice['message']['content'] for choice in response['choices']], 'model': response.get('model', model),
+                'usage': self.usage(response['usage'])}
+
+    def usage(self, usage):
+        """Return the token counts of an API usage object, cached_tokens are included in prompt_tokens"""
+        details = usage.get('prompt_tokens_details') or {}
+        return {'prompt_tokens': usage['prompt_tokens'], 'completion_tokens': usage['completion_tokens'],
+                'cached_tokens': details.get('cached_tokens', 0)}
+
+    def stream(self, messages, model=None, temperature=None, max_tokens=None, usage=None):
+        model = self.model(model)
+        body = self.body(messages, model, temperature, max_tokens)
+        body['stream'] = True
+        # the last chunk then carries the usage of the whole completion
+        body['stream_options'] = {'include_usage': True}
+        for chunk in iter_sse(self.post(model, body, stream=True)):
+            if chunk.get('usage'):
+                ratelimit.get_scheduler(self.config).consume(self.name, model, chunk['usage']['completion_tokens'])
+                if usage is not None:
+                    usage.update(self.usage(chunk['usage']))
+            for choice in chunk.get('choices', []):
+                if choice['delta'].get('content'):
+                    yield choice['delta']['content']
+
+    def list_models(self):
+        """Return the ids of the models available with the API key"""
+        headers = {'Authorization': f"Bearer {self.config['api-key']}"}
+        r = http_pool.get(self.name, f'{self.base_url}/models', self.config, headers=headers)
+        r.raise_for_status()
+        return [model['id'] for model in r.json()['data']]
+
+
+@register_provider('anthropic')
+class AnthropicProvider(Provider):
+    model_prefixes = ('claude',)
+    default_model = 'claude-3-5-sonnet-latest'
+    default_temperature = 0
+    # the messages API requires max_tokens
+    default_max_tokens = 1024
+    supports_streaming = True
+    # the prefixes marked with cache_control are cached for 5 minutes, writing costs 25% more and reading 90% less
+    # https://docs.anthropic.com/en/docs/build-with-claude/prompt-caching
+    cache_read_factor = 0.1
+    cache_write_factor = 1.25
+    # https://www.anthropic.com/pricing#anthropic-api
+    models = {
+        'claude-3-haiku': {'context_window': 200000, 'max_output_tokens': 4096, 'pricing': {'prompt': 0.25/1e6, 'completion': 1.25/1e6}},
+        'claude-3-5-haiku': {'context_window': 200000, 'max_output_tokens': 8192, 'pricing': {'prompt': 0.8/1e6, 'completion': 4/1e6}},
+        'claude-3-5-sonnet': {'context_window': 200000, 'max_output_tokens': 8192, 'pricing': {'prompt': 3/1e6, 'completion': 15/1e6}},
+        'claude-3-opus': {'context_window': 200000, 'max_output_tokens': 4096, 'pricing': {'prompt': 15/1e6, 'completion': 75/1e6}},
+    }
+
+    @property
+    def base_url(self):
+        return self.config.get('anthropic-base-url', 'https://api.anthropic.com/v1')
+
+    def body(self, messages, model, temperature, max_tokens):
+        # system messages are not part of the conversation in the messages API
+        system = [{'type': 'text', 'text': m['content']} for m in messages if m['role'] == 'system']
+        conversation = [{'role': m['role'], 'content': m['content']} for m in messages if m['role'] != 'system']
+        if self.config.get('prompt-caching', True):
+            # the system prompt (instructions, context files) is the prefix shared by all the requests,
+            # and in a conversation the whole history is sent again at the next turn
+            # prefixes shorter than the model minimum (1024 or 2048 tokens) are not cached, at no extra cost
+            if system:
+                system[-1]['cache_control'] = {'type': 'ephemeral'}
+            if len(conversation) > 1:
+                last = conversation[-1]
+                conversation[-1] = {'role': last['role'], 'content': [{'type': 'text', 'text': last['content'], 'cache_control': {'type': 'ephemeral'}}]}
+        body = {
+            'model': model,
+            'messages': conversation,
+            'max_tokens': max_tokens or self.default_max_tokens,
+        }
+        temperature = self.default_temperature if temperature is None else temperature
+        if temperature is not None:
+            body['temperature'] = temperature
+        if system:
+            body['system'] = system
+        return body
+
+    def usage(self, usage):
+        """Return the token counts of an API usage object, the input_tokens of the API exclude the cached ones"""
+        cached = usage.get('cache_read_input_tokens') or 0
+        written = usage.get('cache_creation_input_tokens') or 0
+        return {'prompt_tokens': usage['input_tokens'] + cached + written, 'cached_tokens': cached, 'cache_write_tokens': written}
+
+    def post(self, model, body, stream=False):
+        headers = {
+            'x-api-key': self.config.get('anthropic-key') or os.environ['ANTHROPIC_API_KEY'],
+            'anthropic-version': '2023-06-01',
+            'Content-Type': 'application/json',
+        }
+        tokens = ratelimit.estimate_tokens(body['messages'])
+        return self.send(model, lambda: http_pool.post(self.name, f'{self.base_url}/messages', self.config, headers=headers, json=body, stream=stream), tokens)
+
+    def complete(self, messages, model=None, temperature=None, max_tokens=None):
+        model = self.model(model)
+        response = self.post(model, self.body(messages, model, temperature, max_tokens)).json()
+        ratelimit.get_scheduler(self.config).consume(self.name, model, response['usage']['output_tokens'])
+        return {'content': ''.join(x['text'] for x in response['content'] if x['type'] == 'text'), 'model': response.get('model', model),
+                'usage': dict(self.usage(response['usage']), completion_tokens=response['usage']['output_tokens'])}
+
+    def stream(self, messages, model=None, temperature=None, max_tokens=None, usage=None):
+        model = self.model(model)
+        body = self.body(messages, model, temperature, max_tokens)
+        body['stream'] = True
+        usage = {} if usage is None else usage
+        for event in iter_sse(self.post(model, body, stream=True)):
+            if event['type'] == 'message_start':
+                usage.update(self.usage(event['message']['usage']))
+            elif event['type'] == 'content_block_delta' and event['delta']['type'] == 'text_delta':
+                yield event['delta']['text']
+            elif event['type'] == 'message_delta':
+                usage['completion_tokens'] = event['usage']['output_tokens']
+                ratelimit.get_scheduler(self.config).consume(self.name, model, usage['completion_tokens'])
+            elif event['type'] == 'error':
+                raise ProviderError(self.name, 200, event)
+
+
+@register_provider('google')
+class GoogleProvider(Provider):
+    """Vertex AI predict API, authenticated with the service account stored in the keyring"""
+    model_prefixes = ('code-bison', 'text-bison')
+    default_model = 'gemini-1.5-pro-001'
+    default_temperature = 0.5
+    project_id = 'assert-experiments'
+    models = {
+        'code-bison': {'context_window': 6144, 'max_output_tokens': 1024},
+    }
+
+    @property
+    def base_url(self):
+        return self.config.get('vertex-base-url', 'https://us-central1-aiplatform.googleapis.com/v1')
+
+    def authorized_session(self):
+        """Build an authorized session from the Google service account stored in the keyring"""
+        import keyring
+        from google.oauth2 import service_account
+        from google.auth.transport.requests import AuthorizedSession
+        credentials = service_account.Credentials.from_service_account_info(json.loads(keyring.get_keyring().get_password('login2', 'google-service-account')))
+        return AuthorizedSession(credentials.with_scopes(['https://www.googleapis.com/auth/cloud-platform']))
+
+    def complete(self, messages, model=None, temperature=None, max_tokens=None):
+        model = self.model(model)
+        prompt = join_messages(messages)
+        url = f'{self.base_url}/projects/{self.project_id}/locations/us-central1/publishers/google/models/{model}:predict'
+        # the session (and the credentials read from the keyring) is built once and reused
+        # 'vertex-auth: false' sends unauthenticated requests, eg to benchmarks/stub_server.py
+        session = http_pool.get_session(self.name, self.config, factory=self.authorized_session if self.config.get('vertex-auth', True) else None)
+        temperature = self.default_temperature if temperature is None else temperature
+        data = {'instances': [{'prefix': prompt}], 'parameters': {'temperature': temperature, 'maxOutputTokens': max_tokens or 256}}
+        response = self.send(model, lambda: session.post(url, json=data, timeout=http_pool.timeout(self.config)), len(prompt) // 4)
+        content = response.json()['predictions'][0]['content']
+        return {'content': content, 'model': model, 'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4}}
+
+
+@register_provider('gemini')
+class GeminiProvider(Provider):
+    """Gemini through the vertexai SDK, works on August 2024"""
+    model_prefixes = ('gemini',)
+    default_model = 'gemini-1.5-pro-001'
+    project_id = 'assert-experiments'
+    supports_streaming = True
+    models = {
+        'gemini-1.5-flash': {'context_window': 1048576, 'max_output_tokens': 8192, 'pricing': {'prompt': 0.075/1e6, 'completion': 0.3/1e6}},
+        'gemini-1.5-pro': {'context_window': 2097152, 'max_output_tokens': 8192, 'pricing': {'prompt': 1.25/1e6, 'completion': 5/1e6}},
+    }
+    _initialized = False
+
+    def generative_model(self, model):
+        import vertexai
+        from vertexai.generative_models import GenerativeModel
+        if not GeminiProvider._initialized:
+            vertexai.init(project=self.project_id, location='us-central1')
+            GeminiProvider._initialized = True
+        return GenerativeModel(model)
+
+    def generation_config(self, temperature, max_tokens):
+        config = {}
+        if temperature is not None:
+            config['temperature'] = temperature
+        if max_tokens:
+            config['max_output_tokens'] = max_tokens
+        return config
+
+    def complete(self, messages, model=None, temperature=None, max_tokens=None):
+        model = self.model(model)
+        response = self.generative_model(model).generate_content(join_messages(messages), generation_config=self.generation_config(temperature, max_tokens))
+        return {'content': response.text, 'model': model,
+                'usage': {'prompt_tokens': response.usage_metadata.prompt_token_count, 'completion_tokens': response.usage_metadata.candidates_token_count}}
+
+    def stream(self, messages, model=None, temperature=None, max_tokens=None, usage=None):
+        model = self.model(model)
+        for chunk in self.generative_model(model).generate_content(join_messages(messages), generation_config=self.generation_config(temperature, max_tokens), stream=True):
+            if usage is not None and chunk.usage_metadata:
+                usage['prompt_tokens'] = chunk.usage_metadata.prompt_token_count
+                usage['completion_tokens'] = chunk.usage_metadata.candidates_token_count
+            yield chunk.text
+
+
+@register_provider('huggingface')
+class HuggingFaceProvider(Provider):
+    model_prefixes = ('bigcode/',)
+    default_model = 'bigcode/starcoderplus'
+    models = {
+        'bigcode/starcoderplus': {'context_window': 8192, 'max_output_tokens': 1024, 'pricing': {'prompt': 0, 'completion': 0}},
+    }
+
+    def complete(self, messages, model=None, temperature=None, max_tokens=None):
+        model = self.model(model)
+        prompt = join_messages(messages)
+        url = 'https://api-inference.huggingface.co/models/' + model
+        headers = {'Authorization': 'Bearer ' + self.config['hf-key'], 'Content-Type': 'application/json'}
+        data = {'inputs': prompt, 'parameters': {'max_new_tokens': max_tokens or 100, 'stop': []}}
+        if temperature:
+            data['parameters']['temperature'] = temperature
+        response = self.send(model, lambda: http_pool.post(self.name, url, self.config, headers=headers, json=data))
+        content = response.json()[0]['generated_text']
+        return {'content': content, 'model': model, 'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4}}
+
+
+@register_provider('local')
+class LocalLLMProvider(Provider):
+    """Local model through the llm CLI (https://llm.datasette.io), eg offline in the plane"""
+    model_prefixes = ('mistral',)
+    default_model = 'mistral-7b-instruct-v0'
+    models = {
+        'mistral-7b-instruct-v0': {'context_window': 8192, 'max_output_tokens': 4096, 'pricing': {'prompt': 0, 'completion': 0}},
+    }
+
+    def complete(self, messages, model=None, temperature=None, max_tokens=None):
+        model = self.model(model)
+        prompt = join_messages(messages)
+        content = subprocess.check_output(['llm', '-m', model, prompt]).decode('utf8')
+        return {'content': content, 'model': model, 'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4}}
+
+
+
+@register_provider('local-worker')
+class LocalWorkerProvider(Provider):
+    """Local model kept resident by local_worker.py, on the CPU, started on first use and shared by the processes"""
+    models = LocalLLMProvider.models
+
+    @property
+    def default_model(self):
+        return self.config.get('local-model', LocalLLMProvider.default_model)
+
+    def complete(self, messages, model=None, temperature=None, max_tokens=None):
+        import local_worker
+        model = self.model(model)
+        response = local_worker.complete(model, join_messages(messages), max_tokens, temperature, self.config)
+        return {'content': response['content'], 'model': response['model'], 'usage': response['usage']}
+
+if __name__ == '__main__':
+    # ./providers.py: list the registered providers and their models
+    for name, cls in PROVIDERS.items():
+        print(name + ': ' + ', '.join(cls.models))
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+# rate-limit aware scheduling of LLM API requests
+# token buckets for the requests-per-minute and tokens-per-minute budgets of each provider/model,
+# configured in config.yaml:
+#   rate-limits:
+#     openai/gpt-4o: {rpm: 500, tpm: 30000}
+#     anthropic: {rpm: 50, tpm: 40000}
+#   max-retries: 6
+# the budgets are also synced with the Retry-After and x-ratelimit-* response headers
+import json
+import random
+import re
+import threading
+import time
+
+DEFAULT_MAX_RETRIES = 6
+# seconds, jittered exponential backoff between retries of a rate-limited request without Retry-After
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+# share of the Retry-After delay added at random, so that the requests held back do not retry all at once
+RETRY_AFTER_JITTER = 0.1
+RATE_LIMITED_STATUS = (429,)
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request is still rate-limited after all retries"""
+
+    def __init__(self, response):
+        super().__init__(f'rate limit exceeded, status code {response.status_code}')
+        self.response = response
+
+
+class TokenBucket:
+    """A bucket refilled at per_minute/60 units per second, holding at most per_minute units"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        """Take amount units and return how many seconds to wait before they are available"""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)
+        return 0 if self.level >= 0 else -self.level / self.rate
+
+    def sync(self, remaining, now):
+        """Lower the level to what the server reports as remaining"""
+        self.reserve(0, now)
+        self.level = min(self.level, float(remaining))
+
+
+class Budget:
+    """The rate-limit state of one provider/model"""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0
+
+
+def parse_duration(value):
+    """Parse the reset durations of the x-ratelimit-* headers, eg '20ms', '1s', '6m0s', '1h2m3.5s', '12'"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r'([\d.]+)(ms|s|m|h)', value)
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def parse_reset(value, now_wall):
+    """Parse a reset header, either a duration or an RFC 3339 timestamp (Anthropic), into seconds from now"""
+    if re.match(r'\d{4}-\d{2}-\d{2}T', value):
+        from datetime import datetime
+        reset = datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        return max(0, reset - now_wall)
+    return parse_duration(value)
+
+
+def parse_retry_after(headers):
+    """Return the delay in seconds requested by Retry-After (seconds or HTTP date) or retry-after-ms, or None"""
+    if headers.get('retry-after-ms'):
+        return float(headers['retry-after-ms']) / 1000
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        import email.utils
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0, date.timestamp() - time.time())
+
+
+def backoff_delay(attempt, retry_after=None):
+    """The delay the server asked for plus a small jitter, or full-jitter exponential backoff when it did not say"""
+    if retry_after is not None:
+        return retry_after * (1 + random.uniform(0, RETRY_AFTER_JITTER))
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def estimate_tokens(messages):
+    """Rough token count of chat messages, about 4 characters per token"""
+    return sum(len(str(m.get('content', ''))) for m in messages) // 4 + 4 * len(messages)
+
+
+class Scheduler:
+    """Paces requests per provider/model so that they stay within their budgets, and retries the rate-limited ones"""
+
+    def __init__(self, limits=None, max_retries=DEFAULT_MAX_RETRIES):
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def budget(self, provider, model):
+        key = f'{provider}/{model}'
+        if key not in self._budgets:
+            limit = self.limits.get(key) or self.limits.get(provider) or {}
+            self._budgets[key] = Budget(limit.get('rpm'), limit.get('tpm'))
+        return self._budgets[key]
+
+    def acquire(self, provider, model, tokens=0):
+        """Block until one request of the given number of tokens fits in the budget"""
+        time.sleep(self.reserve(provider, model, tokens))
+
+    def reserve(self, provider, model, tokens=0):
+        """Reserve one request of the given number of tokens and return how long to wait before sending it"""
+        now = time.monotonic()
+        with self._lock:
+            budget = self.budget(provider, model)
+            wait = max(0, budget.blocked_until - now)
+            if budget.requests:
+                wait = max(wait, budget.requests.reserve(1, now))
+            if budget.tokens and tokens:
+                wait = max(wait, budget.tokens.reserve(tokens, now))
+        return wait
+
+    def consume(self, provider, model, tokens):
+        """Charge tokens known only after the response, eg the completion tokens"""
+        with self._lock:
+            budget = self.budget(provider, model)
+            if budget.tokens and tokens:
+                budget.tokens.reserve(tokens, time.monotonic())
+
+    def block(self, provider, model, seconds):
+        """Hold back every request to this provider/model for the given number of seconds"""
+        with self._lock:
+            budget = self.budget(provider, model)
+            budget.blocked_until = max(budget.blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, provider, model, headers):
+        """Sync the budget with the rate-limit headers of OpenAI (x-ratelimit-*) and Anthropic (anthropic-ratelimit-*)"""
+        now, now_wall = time.monotonic(), time.time()
+        headers = {k.lower(): v for k, v in headers.items()}
+        with self._lock:
+            budget = self.budget(provider, model)
+            for kind, bucket in (('requests', budget.requests), ('tokens', budget.tokens)):
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}') or headers.get(f'anthropic-ratelimit-{kind}-remaining')
+                reset = headers.get(f'x-ratelimit-reset-{kind}') or headers.get(f'anthropic-ratelimit-{kind}-reset')
+                if remaining is None:
+                    continue
+                if bucket:
+                    bucket.sync(remaining, now)
+                if int(float(remaining)) <= 0 and reset:
+                    budget.blocked_until = max(budget.blocked_until, now + parse_reset(reset, now_wall))
+
+    def send(self, provider, model, request, tokens=0):
+        """Call request() within the budget and retry it while the response is rate-limited.
+        request returns a response object with status_code and headers.
+        Raises RateLimitExceeded when the retries are exhausted."""
+        attempt = 0
+        while True:
+            self.acquire(provider, model, tokens)
+            response = request()
+            self.update_from_headers(provider, model, response.headers)
+            if response.status_code not in RATE_LIMITED_STATUS:
+                return response
+            if attempt >= self.max_retries:
+                raise RateLimitExceeded(response)
+            # a streamed response is only released to the connection pool when closed
+            response.close()
+            self.block(provider, model, backoff_delay(attempt, parse_retry_after({k.lower(): v for k, v in response.headers.items()})))
+            attempt += 1
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(config=None):
+    """Return the scheduler of the rate-limits and max-retries keys of config.yaml,
+    one per process for each distinct setting, so that the budgets are shared by all the providers"""
+    config = config or {}
+    limits, max_retries = config.get('rate-limits'), config.get('max-retries', DEFAULT_MAX_RETRIES)
+    key = json.dumps([limits, max_retries], sort_keys=True)
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = Scheduler(limits, max_retries)
+        return _schedulers[key]
@@ -1,41 +1,28 @@
 #!/usr/bin/python3
-# a harness for openai llms with execution
-# ./exec-llm.py "a function that computes the babbage number" | python
+# refactors a python file with the LLM, or prints a summary of it without instruction
+# ./refactor-file-llm.py <file> "introduce a main function"   writes <file>.refactored
+# ./refactor-file-llm.py <file>                                prints a summary
+# to refactor many files in one process, see ./transform.py refactor
 
-import openai
 import sys
-import re
-import time
-import yaml 
-import requests
-from io import StringIO
-import tokenize
-import difflib
-from stockholm_diff import *
-from  ellm import *
+import transform
+from ellm import get_llm_answer
 
-# Prompt for testing
-
-
-if len(sys.argv)==0:
-    print("summarize-file-with-llm.py <file-to-comment>")
+if len(sys.argv) < 2:
+    print("refactor-file-llm.py <file> [instruction]")
     sys.exit(-1)
 
 
 file_to_comment = sys.argv[1]
+if len(sys.argv) > 2:
+    transform.main(['refactor', '--print', '--instruction', sys.argv[2], file_to_comment])
+
 lang = file_to_comment.split(".")[-1]
-#refactor_command = sys.argv[2]
-# introduce a main function
 prompt = "write a docstring summary of the following python function.\n"
 initial_program = open(file_to_comment).read()
 prompt += "```"+lang+"\n"+initial_program+"\n```"
 
-
-# Get the answer from LLM based on the config
-answer = get_llm_answer(prompt, lambda x: x)
+# Get the answer from LLM based on the config, the default metaprompt sends the prompt as one user message
+answer = get_llm_answer(prompt)
 
 print(answer)
-
-
-
-#print(extract_program(answer, lang))
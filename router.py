@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+# cost- and latency-aware model routing
+# picks, per request, the cheapest configured model whose context fits the prompt
+# and whose observed latency meets the SLO, configured in config.yaml:
+#   router:
+#     slo: 20
+#     models:
+#       - openai/gpt-4o-mini
+#       - openai/gpt-4o
+#       - anthropic/claude-3-5-sonnet-latest
+# the observed latencies are kept in .router-stats.json and adapt the choices over time
+# ./router.py shows the observed latencies
+import json
+import os
+import random
+import sys
+import threading
+
+import fileio
+import providers
+import ratelimit
+
+DEFAULT_STATS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.router-stats.json')
+# seconds, see 'slo' in the router section of config.yaml
+DEFAULT_SLO = 30
+# weight of the last observation in the moving average of latencies
+EWMA_ALPHA = 0.2
+# probability to try another model meeting the constraints, so that their latency keeps being observed
+EXPLORATION = 0.05
+# expected number of output tokens per task, None means about as many as the prompt (rewriting a file)
+TASK_OUTPUT_TOKENS = {
+    'classify': 5,
+    'docstring': 150,
+    'header': 200,
+    'rewrite': None,
+}
+DEFAULT_OUTPUT_TOKENS = 500
+# seconds per output token assumed for a model never observed
+DEFAULT_SECONDS_PER_TOKEN = 0.02
+
+
+class Router:
+    """Chooses a (provider, model) per request and learns the latency of each model"""
+
+    def __init__(self, models, config=None, slo=DEFAULT_SLO, stats_path=DEFAULT_STATS_PATH):
+        self.config = config or {}
+        # 'provider/model' strings, the model may contain slashes (eg huggingface)
+        self.candidates = [tuple(m.split('/', 1)) for m in models]
+        self.slo = slo
+        self.stats_path = stats_path
+        self._lock = threading.Lock()
+        self.stats = {}
+        if stats_path and os.path.exists(stats_path):
+            with open(stats_path) as f:
+                self.stats = json.load(f)
+
+    def expected_output_tokens(self, prompt_tokens, task):
+        if task in TASK_OUTPUT_TOKENS:
+            return TASK_OUTPUT_TOKENS[task] or prompt_tokens
+        return DEFAULT_OUTPUT_TOKENS
+
+    def predicted_latency(self, model, output_tokens):
+        """Seconds expected for a completion of output_tokens, from the moving averages of past requests"""
+        stats = self.stats.get(model)
+        if stats is None:
+            return output_tokens * DEFAULT_SECONDS_PER_TOKEN
+        return stats['overhead'] + stats['per_token'] * output_tokens
+
+    def estimate(self, provider, model, prompt_tokens, output_tokens):
+        """Return (cost in $, latency in seconds) of a request, or None if it does not fit the model"""
+        capabilities = provider.capabilities(model)
+        if prompt_tokens + output_tokens > capabilities.get('context_window', float('inf')):
+            return None
+        if output_tokens > capabilities.get('max_output_tokens', float('inf')):
+            return None
+        pricing = capabilities.get('pricing', {'prompt': 0, 'completion': 0})
+        cost = prompt_tokens * pricing['prompt'] + output_tokens * pricing['completion']
+        return cost, self.predicted_latency(model, output_tokens)
+
+    def choose(self, messages, task=None):
+        """Return (provider, model) for the messages: the cheapest model fitting the context and the SLO,
+        or the fastest fitting one if none meets the SLO"""
+        prompt_tokens = ratelimit.estimate_tokens(messages)
+        output_tokens = self.expected_output_tokens(prompt_tokens, task)
+        options = []
+        for provider_name, model in self.candidates:
+            provider = providers.get_provider(provider_name, self.config)
+            estimate = self.estimate(provider, model, prompt_tokens, output_tokens)
+            if estimate is not None:
+                options.append((estimate, provider, model))
+        if not options:
+            raise Exception(f'no configured model fits a prompt of {prompt_tokens} tokens')
+        within_slo = [o for o in options if o[0][1] <= self.slo]
+        if within_slo and random.random() < EXPLORATION:
+            _, provider, model = random.choice(within_slo)
+        elif within_slo:
+            _, provider, model = min(within_slo, key=lambda o: o[0][0])
+        else:
+            _, provider, model = min(options, key=lambda o: o[0][1])
+        return provider, model
+
+    def record(self, model, latency, completion_tokens):
+        """Update the moving averages of the model with an observed request"""
+        with self._lock:
+            stats = self.stats.get(model)
+            if stats is None:
+                # first observation: all the latency is attributed to the tokens, the overhead is learned later
+                stats = self.stats[model] = {'overhead': 0.0, 'per_token': latency / max(completion_tokens, 1), 'requests': 0}
+            else:
+                predicted = stats['overhead'] + stats['per_token'] * completion_tokens
+                error = latency - predicted
+                # split the error between the fixed overhead and the per-token time
+                stats['overhead'] = max(0.0, stats['overhead'] + EWMA_ALPHA * error / 2)
+                stats['per_token'] = max(0.0, stats['per_token'] + EWMA_ALPHA * error / 2 / max(completion_tokens, 1))
+            stats['requests'] += 1
+            self.save()
+
+    def save(self):
+        if not self.stats_path:
+            return
+        fileio.write_atomically(self.stats_path, json.dumps(self.stats, indent=2))
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(config):
+    """Return the router configured in the router section of config.yaml, or None if routing is disabled.
+    Routers are cached per config, so that a later config is not served the first one's router."""
+    if not config.get('router'):
+        return None
+    key = providers.config_key(config)
+    with _routers_lock:
+        if key not in _routers:
+            router_config = config['router']
+            _routers[key] = Router(router_config['models'], config, router_config.get('slo', DEFAULT_SLO), router_config.get('stats-path', DEFAULT_STATS_PATH))
+        return _routers[key]
+
+
+if __name__ == '__main__':
+    router = Router([], stats_path=sys.argv[1] if len(sys.argv) > 1 else DEFAULT_STATS_PATH)
+    for model, stats in sorted(router.stats.items()):
+        print(f"{model}: {stats['overhead']:.2f}s + {stats['per_token'] * 1000:.1f}ms/token over {stats['requests']} requests")
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+# runs generated python programs in a pool of resource-limited workers, with structured results
+# each worker is an interpreter started once, with the common modules already imported,
+# which forks one child per program: the child gets its own session and temporary directory,
+# CPU, memory and output limits, and is killed with its subprocesses at the timeout
+# a guard against runaway programs, not a security boundary against malicious code (no network or filesystem isolation)
+# ./sandbox.py prog1.py prog2.py ... [--jobs N] [--timeout S] [--memory MB] [--json]
+import concurrent.futures
+import io
+import json
+import os
+import queue
+import resource
+import runpy
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import click
+
+# defaults of the sandbox-* keys of config.yaml
+TIMEOUT = 10
+MEMORY_MB = 512
+OUTPUT_BYTES = 1 << 20
+# imported by the workers before forking, so that the programs do not pay for them
+PRELOAD = ('math', 're', 'json', 'random', 'itertools', 'functools', 'collections', 'datetime', 'string', 'typing')
+# the environment of the programs, the API keys of the caller are not passed
+ENVIRONMENT = ('PATH', 'LANG', 'LC_ALL', 'TZ')
+
+
+def limit(cpu_time, memory, output):
+    """Set the resource limits of the current process"""
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (output, output))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+def child(directory, job):
+    """Run main.py in the forked child, never returns"""
+    code = 1
+    try:
+        os.setsid()
+        os.chdir(directory)
+        for fd, name, flags in ((0, 'stdin', os.O_RDONLY), (1, 'stdout', os.O_WRONLY | os.O_CREAT), (2, 'stderr', os.O_WRONLY | os.O_CREAT)):
+            os.dup2(os.open(name, flags, 0o600), fd)
+        os.closerange(3, 256)
+        sys.stdin, sys.stdout, sys.stderr = (open(0, closefd=False), open(1, 'w', closefd=False), open(2, 'w', closefd=False))
+        # python ignores SIGXFSZ, the program is stopped at the output limit instead of failing its writes
+        signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+        limit(job['cpu_time'], job['memory'], job['output'])
+        sys.argv = ['main.py'] + job.get('args', [])
+        sys.path[0] = directory
+        runpy.run_path('main.py', run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException as e:
+        traceback.print_exc()
+        with open('exception', 'w') as f:
+            f.write(type(e).__name__)
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def read(path, size):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(size).decode('utf8', 'replace')
+    except OSError:
+        return ''
+
+
+def execute(job):
+    """Run a job {program, stdin, timeout, cpu_time, memory, output} in a forked child and return its result"""
+    directory = tempfile.mkdtemp(prefix='sandbox-')
+    try:
+        for name, content in (('main.py', job['program']), ('stdin', job.get('stdin', ''))):
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write(content)
+        start = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            child(directory, job)
+        expired = []
+
+        def expire(signum, frame):
+            expired.append(True)
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        signal.signal(signal.SIGALRM, expire)
+        signal.setitimer(signal.ITIMER_REAL, job['timeout'])
+        _, status, usage = os.wait4(pid, 0)
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        duration = time.monotonic() - start
+        try:
+            # the subprocesses left behind
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        exception = read(os.path.join(directory, 'exception'), 100) or None
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+            result = {signal.SIGXCPU: 'cpu-limit', signal.SIGXFSZ: 'output-limit'}.get(os.WTERMSIG(status), 'killed')
+            if expired and os.WTERMSIG(status) == signal.SIGKILL:
+                result = 'timeout'
+        else:
+            returncode = os.WEXITSTATUS(status)
+            result = 'ok' if returncode == 0 else 'memory-limit' if exception == 'MemoryError' else 'error'
+        return {'status': result, 'returncode': returncode, 'exception': exception,
+                'stdout': read(os.path.join(directory, 'stdout'), job['output']), 'stderr': read(os.path.join(directory, 'stderr'), job['output']),
+                'duration': duration, 'cpu_time': usage.ru_utime + usage.ru_stime, 'max_rss': usage.ru_maxrss * 1024}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def serve():
+    """Worker loop: one JSON job per line on stdin, one JSON result per line on stdout"""
+    for name in PRELOAD:
+        __import__(name)
+    jobs = io.TextIOWrapper(sys.stdin.buffer, encoding='utf8')
+    for line in jobs:
+        try:
+            result = execute(json.loads(line))
+        except Exception as e:
+            result = {'status': 'crashed', 'returncode': None, 'exception': type(e).__name__, 'stdout': '', 'stderr': str(e),
+                      'duration': 0, 'cpu_time': 0, 'max_rss': 0}
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+
+class Worker:
+    """A worker process, restarted if it dies"""
+
+    def __init__(self):
+        self.process = None
+        self.start()
+
+    def start(self):
+        environment = {name: os.environ[name] for name in ENVIRONMENT if name in os.environ}
+        code = f'import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); import sandbox; sandbox.serve()'
+        self.process = subprocess.Popen([sys.executable, '-c', code], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        env=environment, text=True, encoding='utf8')
+
+    def run(self, job):
+        try:
+            self.process.stdin.write(json.dumps(job) + '\n')
+            self.process.stdin.flush()
+            # the worker enforces the timeout, this only guards against the worker itself hanging
+            ready, _, _ = select.select([self.process.stdout], [], [], job['timeout'] + 10)
+            line = self.process.stdout.readline() if ready else ''
+        except (BrokenPipeError, OSError):
+            line = ''
+        if line:
+            return json.loads(line)
+        self.close()
+        self.start()
+        return {'status': 'crashed', 'returncode': None, 'exception': None, 'stdout': '', 'stderr': 'the sandbox worker died',
+                'duration': 0, 'cpu_time': 0, 'max_rss': 0}
+
+    def close(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class Sandbox:
+    """Pool of workers running python programs, with the limits given or configured by the sandbox-* keys of config.yaml"""
+
+    def __init__(self, workers=None, timeout=None, memory=None, cpu_time=None, output=None, config=None):
+        config = config or {}
+        self.workers = workers or config.get('sandbox-workers') or os.cpu_count()
+        self.timeout = timeout or config.get('sandbox-timeout', TIMEOUT)
+        self.memory = (memory or config.get('sandbox-memory', MEMORY_MB)) * 1024 * 1024
+        self.cpu_time = int(cpu_time or config.get('sandbox-cpu-time') or max(1, self.timeout))
+        self.output = output or config.get('sandbox-output', OUTPUT_BYTES)
+        # the workers are started now, their startup is not paid by the first programs
+        self._idle = queue.Queue()
+        self._all = [Worker() for _ in range(self.workers)]
+        for worker in self._all:
+            self._idle.put(worker)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def run(self, program, stdin='', timeout=None, args=None):
+        """Run a program and return {status, returncode, exception, stdout, stderr, duration, cpu_time, max_rss},
+        status being ok, error, timeout, cpu-limit, memory-limit, output-limit, killed or crashed"""
+        job = {'program': program, 'stdin': stdin, 'args': list(args or []), 'timeout': timeout or self.timeout,
+               'cpu_time': self.cpu_time, 'memory': self.memory, 'output': self.output}
+        worker = self._idle.get()
+        try:
+            return worker.run(job)
+        finally:
+            self._idle.put(worker)
+
+    def run_many(self, programs, stdin='', timeout=None):
+        """Run the programs in parallel on the workers and return their results, in order"""
+        return list(self._executor.map(lambda program: self.run(program, stdin, timeout), programs))
+
+    def close(self):
+        self._executor.shutdown()
+        for worker in self._all:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@click.command()
+@click.argument('files', nargs=-1, required=True)
+@click.option('--jobs', type=int, default=None, help='Number of workers (default: sandbox-workers, or the number of CPUs)')
+@click.option('--timeout', type=float, default=None, help=f'Wall-clock limit per program in seconds (default: {TIMEOUT})')
+@click.option('--memory', type=int, default=None, help=f'Address space limit per program in MB (default: {MEMORY_MB})')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON')
+def main(files, jobs, timeout, memory, as_json):
+    programs = []
+    for path in files:
+        with open(path) as f:
+            programs.append(f.read())
+    with Sandbox(min(jobs or os.cpu_count(), len(files)), timeout, memory) as sandbox:
+        results = sandbox.run_many(programs)
+    if as_json:
+        print(json.dumps([{'file': path, **result} for path, result in zip(files, results)], indent=2))
+    else:
+        for path, result in zip(files, results):
+            print(f"{path}: {result['status']} ({result['returncode']}) in {result['duration']:.2f}s, {result['max_rss'] >> 20} MB")
+    sys.exit(0 if all(result['status'] == 'ok' for result in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# append-only JSONL log of a chat session, one record per message
+# a turn costs one small append instead of rewriting the whole session,
+# and a crash mid-write loses at most the last, truncated, line
+# ./session_log.py <session.jsonl> prints the messages of a session
+import json
+import os
+import sys
+import time
+
+import fileio
+
+# when to fsync the log: after every record, after every assistant answer, or leave it to the OS
+FSYNC_POLICIES = ('always', 'turn', 'never')
+
+
+class SessionLog:
+    """Appends the messages of a chat session, with their usage and timings, to a JSONL file"""
+
+    def __init__(self, path, model=None, fsync='turn'):
+        if fsync not in FSYNC_POLICIES:
+            raise Exception(f'unknown fsync policy {fsync}, use one of {", ".join(FSYNC_POLICIES)}')
+        self.path = path
+        self.fsync = fsync
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = fileio.open_log(path)
+        if not exists:
+            self.write({'type': 'session', 'model': model, 'created': time.time()}, sync=False)
+
+    def write(self, record, sync):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def append(self, message, usage=None, timings=None, model=None):
+        """Append one message, usage is the token counts and timings the latencies in seconds of the answer"""
+        record = {'type': 'message', 'time': time.time(), 'message': message}
+        if model:
+            record['model'] = model
+        if usage:
+            record['usage'] = usage
+        if timings:
+            record['timings'] = timings
+        sync = self.fsync == 'always' or (self.fsync == 'turn' and message['role'] == 'assistant')
+        self.write(record, sync)
+
+    def close(self):
+        self.file.close()
+
+
+def load_session(path):
+    """Return (model, messages, usage totals) of a session log, to resume it.
+    A truncated last line, left by a crash, is skipped."""
+    model = None
+    messages = []
+    usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record['type'] == 'session':
+                model = record.get('model')
+            elif record['type'] == 'message':
+                messages.append(record['message'])
+                model = record.get('model', model)
+                for key in usage:
+                    usage[key] += record.get('usage', {}).get(key, 0)
+    return model, messages, usage
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('session_log.py <session.jsonl>', file=sys.stderr)
+        sys.exit(-1)
+    model, messages, usage = load_session(sys.argv[1])
+    print(f'model: {model}, tokens: {usage}')
+    for message in messages:
+        print(f"--- {message['role']}")
+        print(message['content'])
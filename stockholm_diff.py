@@ -1,16 +1,12 @@
 #!/usr/bin/python3
 # a library for behavioral diff
 # from stockholm_diff import *
-import sys
+import hashlib
 import re
-import time
-import yaml
-import requests
 from io import StringIO
 import tokenize
 import difflib
 import ast
-import astor
 
 def remove_comments_and_docstrings(source):
     """The function `remove_comments_and_docstrings(source)` takes a string input `source` which represents a Python source code. It returns a modified version of the input source code with all the comments and docstrings removed. The function uses Python's tokenize module to parse the source code and selectively remove the comments and docstrings while preserving the indentation and structure of the code."""
@@ -75,28 +71,125 @@ This function takes a string input 'line', removes any leading or trailing white
 
 def split_for_diff(s):
     """The function 'prefilter' takes a single argument 'line' which is a string. It removes any leading or trailing white spaces from 'line' and replaces any occurrence of one or more consecutive white spaces within 'line' with a single space. The function returns the modified string."""
-    # we remove empty lines as well
-    return [prefilter(x) for x in s.split('\n') if len(prefilter(x)) > 0]
+    # we remove empty lines as well, each line is filtered once
+    return [x for x in map(prefilter, s.split('\n')) if len(x) > 0]
 
 class RemoveDocstrings(ast.NodeTransformer):
 
     def visit_FunctionDef(self, node):
-        if len(node.body) > 0 and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Str):
-            # remove first statement
-            node.body = node.body[1:]
+        # remove first statement, with the rule of same_tree
+        node.body = without_docstring(node, node.body)
         return self.generic_visit(node)
 
-    def visit_ClassDef(self, node):
-        if len(node.body) > 0 and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Str):
-            # remove first statement
-            node.body = node.body[1:]
-        return self.generic_visit(node)
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+    visit_Module = visit_FunctionDef
 
-    def visit_Module(self, node):
-        if len(node.body) > 0 and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Str):
-            # remove first statement
-            node.body = node.body[1:]
-        return self.generic_visit(node)
+DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+# the pseudo-definition holding the module-level code, in definition_fingerprints
+MODULE = '<module>'
+
+def unique_qualname(qualname, seen):
+    """Return qualname, suffixed with #2, #3... when it was already seen (eg a property and its setter)."""
+    seen[qualname] = seen.get(qualname, 0) + 1
+    return qualname if seen[qualname] == 1 else qualname + '#' + str(seen[qualname])
+
+def iter_definitions(tree, prefix='', seen=None):
+    """Yield (qualified name, node) of the functions and classes of a tree, eg 'Class.method' or 'outer.inner', in one walk."""
+    seen = {} if seen is None else seen
+    for child in ast.iter_child_nodes(tree):
+        if isinstance(child, DEFINITIONS):
+            qualname = unique_qualname(prefix + child.name, seen)
+            yield qualname, child
+            yield from iter_definitions(child, qualname + '.', seen)
+        else:
+            # definitions under if, try, with...
+            yield from iter_definitions(child, prefix, seen)
+
+def definition_fingerprints(tree):
+    """Return {qualified name: (fingerprint, own fingerprint)} of the definitions of a tree, plus MODULE, in one pass, linear in the size of the tree.
+    Both ignore docstrings, comments and formatting. The fingerprint covers the nested definitions, the own fingerprint only their names,
+    so that a changed method changes the fingerprint of its class but only the own fingerprint of the method."""
+    result = {}
+    seen = {}
+
+    def digests(tokens, children):
+        # each definition is hashed once: its own tokens, then the fingerprints of its nested definitions
+        own = '\0'.join(tokens).encode('utf8', 'surrogatepass')
+        return hashlib.blake2b(own + ''.join(children).encode(), digest_size=16).hexdigest(), hashlib.blake2b(own, digest_size=16).hexdigest()
+
+    def visit(node, prefix, tokens, children):
+        if isinstance(node, DEFINITIONS):
+            qualname = unique_qualname(prefix + node.name, seen)
+            # reserved now, so that the definitions are listed in source order
+            result[qualname] = None
+            node_tokens, node_children = [], []
+            visit_fields(node, qualname + '.', node_tokens, node_children)
+            result[qualname] = digests(node_tokens, node_children)
+            tokens.append('def ' + node.name)
+            children.append(result[qualname][0])
+        else:
+            visit_fields(node, prefix, tokens, children)
+
+    def visit_fields(node, prefix, tokens, children):
+        tokens.append(type(node).__name__)
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                if field == 'body':
+                    value = without_docstring(node, value)
+                tokens.append(field + ':' + str(len(value)))
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        visit(item, prefix, tokens, children)
+                    else:
+                        tokens.append(repr((type(item).__name__, item)))
+            elif isinstance(value, ast.AST):
+                tokens.append(field)
+                visit(value, prefix, tokens, children)
+            else:
+                # the type tells 1 from 1.0 and True
+                tokens.append(field + '=' + repr((type(value).__name__, value)))
+
+    tokens, children = [], []
+    visit(tree, '', tokens, children)
+    result[MODULE] = digests(tokens, children)
+    return result
+
+def fingerprint(node):
+    """Return a hash of a definition (or module) that ignores its docstrings, comments and formatting, so that it only changes with its code, nested definitions included."""
+    if isinstance(node, ast.Module):
+        return definition_fingerprints(node)[MODULE][0]
+    fingerprints = definition_fingerprints(ast.Module(body=[node], type_ignores=[]))
+    return next(iter(fingerprints.values()))[0]
+
+def diff_definitions(before, after):
+    """Return {'added': [...], 'removed': [...], 'changed': [...]}, the qualified names of the definitions of two Python programs
+    whose own code differs, MODULE standing for the module-level code. The delta is empty when the programs behave the same."""
+    return definitions_delta(definition_fingerprints(ast.parse(before)), definition_fingerprints(ast.parse(after)))
+
+def definitions_delta(before, after):
+    """Return the diff_definitions delta of two definition_fingerprints results, eg cached ones."""
+    return {
+        'added': [q for q in after if q not in before],
+        'removed': [q for q in before if q not in after],
+        'changed': [q for q in after if q in before and before[q][1] != after[q][1]],
+    }
+
+def group_equivalent(programs):
+    """Return the lists of indices of the programs that are the same once docstrings, comments and formatting are ignored, in order of first occurrence.
+    Programs that do not parse are only grouped with identical texts."""
+    groups = {}
+    for index, program in enumerate(programs):
+        try:
+            key = fingerprint(ast.parse(program))
+        except (SyntaxError, ValueError):
+            key = 'text:' + program
+        groups.setdefault(key, []).append(index)
+    return list(groups.values())
+
+def format_delta(delta):
+    """Return a one-line summary of a diff_definitions delta, eg 'changed: foo, Bar.baz; added: qux'."""
+    return '; '.join(kind + ': ' + ', '.join(names) for kind, names in delta.items() if names)
 
 def str2ast2str(source):
     '''"""
@@ -106,13 +199,67 @@ This function visits a Module node in an Abstract Syntax Tree (AST). If the firs
     RemoveDocstrings().visit(tree)
     return ast.unparse(tree)
 
+# the definitions whose first statement, if a string, is a docstring
+DOCSTRING_OWNERS = (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+def without_docstring(node, body):
+    """Return the statements of body without the leading docstring, if node can have one."""
+    if isinstance(node, DOCSTRING_OWNERS) and len(body) > 0 and isinstance(body[0], ast.Expr) \
+            and isinstance(body[0].value, ast.Constant) and isinstance(body[0].value.value, str):
+        return body[1:]
+    return body
+
+def same_tree(before, after):
+    """Return True if the two ASTs are equal once docstrings are ignored, comparing them in lockstep and stopping at the first difference. Positions (lineno, col_offset) are not compared."""
+    stack = [(before, after)]
+    while stack:
+        a, b = stack.pop()
+        if type(a) is not type(b):
+            return False
+        if isinstance(a, ast.AST):
+            for field in a._fields:
+                x = getattr(a, field, None)
+                y = getattr(b, field, None)
+                if field == 'body' and isinstance(x, list):
+                    x = without_docstring(a, x)
+                    y = without_docstring(b, y)
+                stack.append((x, y))
+        elif isinstance(a, list):
+            if len(a) != len(b):
+                return False
+            stack.extend(zip(a, b))
+        elif a != b:
+            # constants, names and operators' attributes; the type check above tells 1 from 1.0 and True
+            return False
+    return True
+
+def same_behavior(before, after):
+    """Return True if the two Python programs are the same once comments, docstrings and formatting are ignored, without computing a diff. This is the cheap check to run after every LLM edit."""
+    if before == after:
+        return True
+    return same_tree(ast.parse(before), ast.parse(after))
+
 def diff_python(before, after):
     '''"""
 This function takes two Python code strings as input, removes comments and docstrings, converts them into abstract syntax trees (ASTs), and then back into strings. It then uses the 'difflib' library to generate a list of differences between the two code strings. The differences are returned in a unified diff format.
+The ASTs are first compared structurally, the text diff is only computed when they differ.
 """'''
-    f = remove_comments_and_docstrings
-    f = str2ast2str
-    before = f(before)
-    after = f(after)
-    delta = [x for x in difflib.unified_diff(split_for_diff(before), split_for_diff(after), n=0)]
+    if before == after:
+        return []
+    before_tree = ast.parse(before)
+    after_tree = ast.parse(after)
+    if same_tree(before_tree, after_tree):
+        return []
+    before_tree = RemoveDocstrings().visit(before_tree)
+    after_tree = RemoveDocstrings().visit(after_tree)
+    # unparse formats both programs the same way, so the lines are compared as they are:
+    # the whitespace left is in string constants and the indentation, which same_tree compares too
+    delta = list(difflib.unified_diff(unparsed_lines(before_tree), unparsed_lines(after_tree), n=0))
+    if not delta:
+        # a difference unparse does not show, the trees themselves are diffed, so that a behavior change never has an empty diff
+        delta = list(difflib.unified_diff(ast.dump(before_tree, indent=1).split('\n'), ast.dump(after_tree, indent=1).split('\n'), n=0))
     return delta
+
+def unparsed_lines(tree):
+    """Return the non-empty lines of the unparsed tree."""
+    return [line for line in ast.unparse(tree).split('\n') if line.strip()]
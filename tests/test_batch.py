@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+import ellm
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    """Answer each prompt after the number of milliseconds it names, recording the provider it was routed to"""
+    calls = []
+    in_flight = [0, 0]
+    lock = threading.Lock()
+
+    def get_llm_answer(prompt, metaprompt=None, use_cache=None, task=None, provider=None, model=None):
+        if prompt == 'fail':
+            raise ConnectionError('no route to the provider')
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(int(prompt) / 1000)
+        with lock:
+            in_flight[0] -= 1
+            calls.append((prompt, provider))
+        return 'answer ' + prompt
+    monkeypatch.setattr(ellm, '_config', {'provider': 'openai'})
+    monkeypatch.setattr(ellm, 'get_llm_answer', get_llm_answer)
+    return calls, in_flight
+
+
+def test_ordered_answers(answers):
+    assert ellm.get_llm_answers(['30', '1', '10']) == ['answer 30', 'answer 1', 'answer 10']
+
+
+def test_unordered_answers_arrive_as_they_complete(answers):
+    assert ellm.get_llm_answers(['60', '1', '30'], ordered=False) == [(1, 'answer 1'), (2, 'answer 30'), (0, 'answer 60')]
+
+
+def test_concurrency_is_bounded(answers):
+    _, in_flight = answers
+    ellm.get_llm_answers(['20'] * 12, concurrency=3)
+    assert in_flight[1] == 3
+
+
+def test_rate_is_applied_to_the_routed_provider(answers, monkeypatch):
+    calls, _ = answers
+    ellm._config['batch-rate'] = 1000
+    monkeypatch.setattr(ellm, 'route', lambda prompt, metaprompt, task: ('anthropic', 'claude-3-haiku'))
+    monkeypatch.setattr(ellm, '_next_request_time', {})
+    ellm.get_llm_answers(['1', '1'])
+    assert [provider for _, provider in calls] == ['anthropic', 'anthropic']
+    assert list(ellm._next_request_time) == ['anthropic']
+
+
+def test_a_failed_request_raises(answers):
+    with pytest.raises(ConnectionError):
+        ellm.get_llm_answers(['1', 'fail', '1'])
+
+
+def test_a_failed_request_answers_none(answers, capsys):
+    assert ellm.get_llm_answers(['20', 'fail', '1'], errors='none') == ['answer 20', None, 'answer 1']
+    assert 'request 1: failed, ConnectionError' in capsys.readouterr().err
+
+
+def test_transform_goes_on_after_a_failed_request(answers, tmp_path):
+    import asyncio
+    import transform
+    paths = []
+    for i, prompt in enumerate(('1', 'fail', '1')):
+        (tmp_path / f'{i}.py').write_text(prompt)
+        paths.append(str(tmp_path / f'{i}.py'))
+    written = []
+
+    def planner(path, source, options):
+        """The file content is its prompt"""
+        def finish(answers):
+            written.append(path)
+            return answers[0]
+        return [source], finish
+    options = {'in_place': True, 'suffix': '', 'print': False}
+    assert asyncio.run(transform.transform(paths, planner, options)) == 1
+    assert sorted(written) == paths
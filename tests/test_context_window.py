@@ -0,0 +1,61 @@
+import pytest
+
+import context_window
+import tokens
+
+MODEL = 'gpt-4o-mini'
+
+
+def conversation(turns, size=200):
+    messages = [{'role': 'system', 'content': 'you are a code reviewer'}]
+    for i in range(turns):
+        messages.append({'role': 'user', 'content': f'question {i} ' + 'x' * size})
+        messages.append({'role': 'assistant', 'content': f'answer {i} ' + 'y' * size})
+    messages.append({'role': 'user', 'content': 'last question'})
+    return messages
+
+
+def window_for(messages, max_output_tokens):
+    """A context window whose prompt budget is exactly the size of messages"""
+    needed = tokens.count_message_tokens(messages, MODEL) + max_output_tokens
+    return int(needed / (1 - context_window.SAFETY_MARGIN)) + 1
+
+
+def test_truncate():
+    assert tokens.truncate('some text', 0) == ''
+    assert tokens.truncate('some text', -1, keep='start') == ''
+    assert tokens.truncate('some text', 100) == 'some text'
+
+
+def test_messages_that_fit_are_kept():
+    messages = conversation(2)
+    assert context_window.fit_messages(messages, MODEL, 100000) is messages
+
+
+def test_sliding_window_keeps_the_system_and_last_messages():
+    messages = conversation(10)
+    window = window_for(messages[:1] + messages[-5:], 100)
+    fitted = context_window.fit_messages(messages, MODEL, window, 100)
+    assert fitted[0] == messages[0]
+    assert fitted[-1] == messages[-1]
+    assert fitted == messages[:1] + messages[-5:]
+    assert tokens.count_message_tokens(fitted, MODEL) <= context_window.budget(window, 100)
+
+
+def test_summarize_fits_the_budget():
+    messages = conversation(10)
+    window = window_for(messages[:1] + messages[-5:], 100)
+    fitted = context_window.fit_messages(messages, MODEL, window, 100, policy='summarize', summarize=lambda old: 'z' * 10000)
+    assert fitted[0] == messages[0]
+    assert fitted[1]['content'].startswith(context_window.SUMMARY_PREFIX)
+    assert fitted[-1] == messages[-1]
+    assert tokens.count_message_tokens(fitted, MODEL) <= context_window.budget(window, 100)
+
+
+def test_pinned_messages_that_do_not_fit_overflow():
+    messages = conversation(1, size=4000)
+    messages[-1]['content'] = 'w' * 4000
+    with pytest.raises(context_window.ContextOverflow) as overflow:
+        context_window.fit_messages(messages, MODEL, 500, 100)
+    assert overflow.value.available == context_window.budget(500, 100)
+    assert overflow.value.needed > overflow.value.available
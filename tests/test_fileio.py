@@ -0,0 +1,25 @@
+import os
+import stat
+
+import fileio
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_write_atomically_keeps_the_permissions(tmp_path):
+    path = tmp_path / 'script.py'
+    path.write_text('print(1)\n')
+    path.chmod(0o755)
+    fileio.write_atomically(str(path), 'print(2)\n')
+    assert path.read_text() == 'print(2)\n'
+    assert mode(path) == 0o755
+    assert os.listdir(tmp_path) == ['script.py']
+
+
+def test_write_atomically_creates_with_the_umask(tmp_path):
+    path = tmp_path / 'new.py'
+    fileio.write_atomically(str(path), 'x = 1\n')
+    assert path.read_text() == 'x = 1\n'
+    assert mode(path) == 0o666 & ~fileio.UMASK
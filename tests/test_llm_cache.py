@@ -0,0 +1,85 @@
+import itertools
+
+import ellm
+import llm_cache
+
+
+def test_key_ignores_dict_ordering():
+    messages = [{'role': 'user', 'content': 'hi'}]
+    reordered = [{'content': 'hi', 'role': 'user'}]
+    assert llm_cache.cache_key('openai', 'gpt-4o', 0, messages) == llm_cache.cache_key('openai', 'gpt-4o', 0, reordered)
+    assert llm_cache.cache_key('openai', 'gpt-4o', 0, messages) != llm_cache.cache_key('openai', 'gpt-4o', 0.5, messages)
+    assert llm_cache.cache_key('openai', 'gpt-4o', 0, messages) != llm_cache.cache_key('openai', 'gpt-4o-mini', 0, messages)
+
+
+def test_put_get_and_counters(tmp_path):
+    cache = llm_cache.Cache(str(tmp_path / 'cache.sqlite'))
+    assert cache.get('k') is None
+    cache.put('k', 'answer')
+    assert cache.get('k') == 'answer'
+    assert cache.stats() == {'entries': 1, 'bytes': 6, 'hits': 1, 'misses': 1}
+    cache.clear()
+    assert cache.get('k') is None
+
+
+def test_counters_survive_reopening(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = llm_cache.Cache(path)
+    cache.put('k', 'answer')
+    cache.get('k')
+    cache.close()
+    assert llm_cache.Cache(path).stats()['hits'] == 1
+
+
+def test_expired_entries_are_misses(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, 'time', lambda: now[0])
+    cache = llm_cache.Cache(str(tmp_path / 'cache.sqlite'), max_age=60)
+    cache.put('k', 'answer')
+    now[0] += 59
+    assert cache.get('k') == 'answer'
+    now[0] += 2
+    assert cache.get('k') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_size_eviction_removes_least_recently_used(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(llm_cache.time, 'time', lambda: float(next(clock)))
+    # room for two answers of 10 bytes
+    cache = llm_cache.Cache(str(tmp_path / 'cache.sqlite'), max_size=25 / (1024 * 1024))
+    for key in 'abc':
+        cache.put(key, key * 10)
+    # a is now more recently used than b
+    cache.get('a')
+    assert cache.evict() == 1
+    assert cache.get('b') is None
+    assert cache.get('a') == 'a' * 10
+    assert cache.get('c') == 'c' * 10
+
+
+class CountingProvider:
+    name = 'counting'
+    default_temperature = 0
+
+    def __init__(self):
+        self.calls = 0
+
+    def model(self, model=None):
+        return model or 'm'
+
+    def complete(self, messages, model=None):
+        self.calls += 1
+        return {'content': 'answer ' + messages[0]['content'], 'usage': {'prompt_tokens': 1, 'completion_tokens': 1}}
+
+
+def test_get_llm_answer_asks_the_provider_once(tmp_path, monkeypatch):
+    provider = CountingProvider()
+    monkeypatch.setattr(ellm, '_config', {'provider': 'counting', 'usage-ledger': False, 'cache-path': str(tmp_path / 'cache.sqlite')})
+    monkeypatch.setattr(ellm, '_cache', None)
+    monkeypatch.setattr(ellm, 'get_provider', lambda name=None: provider)
+    assert ellm.get_llm_answer('hello', use_cache=True) == 'answer hello'
+    assert ellm.get_llm_answer('hello', use_cache=True) == 'answer hello'
+    assert provider.calls == 1
+    assert ellm.get_llm_answer('hello', use_cache=False) == 'answer hello'
+    assert provider.calls == 2
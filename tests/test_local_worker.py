@@ -0,0 +1,56 @@
+import threading
+import time
+
+import local_worker
+
+
+class Options:
+    model_fields = {'temp': None, 'max_tokens': None}
+
+
+class Model:
+    Options = Options
+
+    def __init__(self):
+        self.options = []
+
+    def prompt(self, prompt, **options):
+        self.options.append(options)
+        return self
+
+    def text(self):
+        return 'answer'
+
+
+def test_llm_library_options_are_passed_under_the_plugin_names():
+    backend = local_worker.LlmLibraryBackend.__new__(local_worker.LlmLibraryBackend)
+    backend.model = Model()
+    assert backend.complete('prompt', 100, 0.8)[0] == 'answer'
+    backend.complete('prompt', None, None)
+    assert backend.model.options == [{'temp': 0.8, 'max_tokens': 100}, {}]
+
+
+def test_concurrent_starts_spawn_one_worker(monkeypatch, tmp_path):
+    spawned = []
+
+    class Process:
+        def __init__(self, *args, **kwargs):
+            time.sleep(0.05)
+            spawned.append(self)
+
+        def poll(self):
+            return None
+
+    def request(model, payload, config=None, timeout=None):
+        if not spawned:
+            raise FileNotFoundError(model)
+        return {'model': model}
+    monkeypatch.setattr(local_worker.subprocess, 'Popen', Process)
+    monkeypatch.setattr(local_worker, 'request', request)
+    config = {'local-socket-dir': str(tmp_path)}
+    threads = [threading.Thread(target=local_worker.start, args=('model', config)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(spawned) == 1
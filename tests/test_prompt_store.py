@@ -0,0 +1,56 @@
+import pytest
+
+import prompt_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = prompt_store.PromptStore(str(tmp_path / 'prompts.sqlite'))
+    yield store
+    store.close()
+
+
+def test_a_prompt_is_stored_once(store):
+    first, new = store.add('write fibonacci')
+    assert new
+    assert store.add('write fibonacci') == (first, False)
+    assert 'write fibonacci' in store
+    assert 'write factorial' not in store
+    assert store.get(first)['uses'] == 2
+    assert store.stats() == {'prompts': 1, 'artefacts': 0, 'executions': 0}
+
+
+@pytest.mark.parametrize('query, found', [
+    ('fibonacci', [1]),
+    ('numbers fibonacci', [1]),
+    ('hello-world', [2]),
+    ('print("x', [3]),
+    ('"', []),
+    ('AND', []),
+    ('NEAR(', []),
+    ('', []),
+])
+def test_search_treats_the_query_as_words(store, query, found):
+    if not store.fts:
+        pytest.skip('SQLite built without FTS5, search is a LIKE substring')
+    for prompt in ['the fibonacci numbers', 'say hello-world please', 'print("x") in python']:
+        store.add(prompt)
+    assert [prompt_id for prompt_id, _ in store.search(query)] == found
+
+
+def test_artefacts_and_executions(store, tmp_path):
+    prompt_id, _ = store.add('write fibonacci')
+    program = store.add_artefact(prompt_id, str(tmp_path / 'fib.py'), 'program')
+    store.add_execution(prompt_id, {'status': 'ok', 'returncode': 0, 'duration': 0.1, 'stdout': '55\n'}, program)
+    record = store.get(prompt_id)
+    assert [(a['id'], a['kind']) for a in record['artefacts']] == [(program, 'program')]
+    assert record['executions'] == [{'artefact': program, 'status': 'ok', 'returncode': 0, 'duration': 0.1, 'stdout': '55\n'}]
+    assert store.get(prompt_id + 1) is None
+
+
+def test_import_text_does_not_count_uses(store, tmp_path):
+    path = tmp_path / 'prompts.txt'
+    path.write_text('write fibonacci\n\nwrite factorial\n\nwrite fibonacci\n')
+    assert store.import_text(str(path)) == 2
+    assert store.import_text(str(path)) == 0
+    assert store.get(store.add('write factorial', use=False)[0])['uses'] == 0
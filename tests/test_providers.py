@@ -0,0 +1,88 @@
+import pytest
+import requests
+
+import http_pool
+import providers
+import ratelimit
+from benchmarks import stub_server
+
+MESSAGES = [{'role': 'system', 'content': 'be brief'}, {'role': 'user', 'content': 'comment\n```python\nx = 1\n```'}]
+
+
+@pytest.fixture(scope='module')
+def stub():
+    server = stub_server.start(latency=0)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def config(stub):
+    # back to the defaults, a test may have changed the behaviour of the stub
+    requests.post(stub.url.rsplit('/v1', 1)[0] + '/_stub/config', json=stub_server.DEFAULTS | {'latency': 0}).raise_for_status()
+    return {'api-key': 'stub', 'anthropic-key': 'stub', 'model': 'gpt-4o-mini', 'openai-base-url': stub.url,
+            'anthropic-base-url': stub.url, 'vertex-base-url': stub.url, 'vertex-auth': False}
+
+
+def behave(stub, **behaviour):
+    requests.post(stub.url.rsplit('/v1', 1)[0] + '/_stub/config', json=behaviour).raise_for_status()
+
+
+def test_a_provider_per_config():
+    a = providers.get_provider('openai', {'model': 'gpt-4o'})
+    assert providers.get_provider('openai', {'model': 'gpt-4o'}) is a
+    assert providers.get_provider('openai', {'model': 'gpt-4o-mini'}).model() == 'gpt-4o-mini'
+    assert a.model() == 'gpt-4o'
+
+
+def test_a_session_per_pool_configuration():
+    session = http_pool.get_session('openai', {'http-pool-size': 2})
+    assert http_pool.get_session('openai', {'http-pool-size': 2, 'model': 'gpt-4o'}) is session
+    assert http_pool.get_session('openai', {'http-pool-size': 3}) is not session
+    assert http_pool.get_session('openai', {'http-pool-size': 2}, factory=requests.Session) is not session
+
+
+def test_provider_for_model():
+    assert providers.provider_for_model('claude-3-haiku-20240307').name == 'anthropic'
+    assert providers.provider_for_model('gpt-4o-2024-08-06').name == 'openai'
+    assert providers.provider_for_model('gpt-4o-2024-08-06').capabilities('gpt-4o-2024-08-06')['context_window'] == 128000
+
+
+@pytest.mark.parametrize('name', ['openai', 'anthropic', 'google'])
+def test_complete(stub, config, name):
+    completion = providers.get_provider(name, config).complete(MESSAGES)
+    assert completion['content'] == '```python\nx = 1\n```'
+    assert completion['usage']['completion_tokens'] > 0
+
+
+@pytest.mark.parametrize('name', ['openai', 'anthropic'])
+def test_stream_fills_usage_and_charges_the_budget(stub, config, name):
+    config['rate-limits'] = {name: {'tpm': 100000}}
+    provider = providers.get_provider(name, config)
+    usage = {}
+    assert ''.join(provider.stream(MESSAGES, max_tokens=1000, usage=usage)) == '```python\nx = 1\n```'
+    assert usage['completion_tokens'] > 0
+    bucket = ratelimit.get_scheduler(config).budget(name, provider.model()).tokens
+    # the prompt was reserved before sending, the completion is charged when its usage arrives, max_tokens is not
+    assert usage['completion_tokens'] <= bucket.capacity - bucket.level <= ratelimit.estimate_tokens(MESSAGES) + usage['completion_tokens']
+
+
+def test_complete_n_in_one_request(stub, config):
+    completion = providers.get_provider('openai', config).complete_n(MESSAGES, 3)
+    assert completion['contents'] == ['```python\nx = 1\n```'] * 3
+    assert requests.get(stub.url.rsplit('/v1', 1)[0] + '/_stub/stats').json().get('openai 200', 0) >= 1
+
+
+def test_rate_limited_requests_are_retried(stub, config):
+    behave(stub, **{'rate-limit-rate': 0.2, 'retry-after': 0.001})
+    provider = providers.get_provider('openai', config)
+    for _ in range(10):
+        assert provider.complete(MESSAGES)['content'] == '```python\nx = 1\n```'
+
+
+def test_errors_raise_provider_error(stub, config):
+    behave(stub, **{'error-rate': 1})
+    with pytest.raises(providers.ProviderError) as error:
+        providers.get_provider('anthropic', config).complete(MESSAGES)
+    assert error.value.status_code == 500
+    assert error.value.code == 'server_error'
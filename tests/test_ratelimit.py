@@ -0,0 +1,91 @@
+import email.utils
+import time
+
+import pytest
+
+import ratelimit
+
+
+def test_backoff_honours_retry_after_with_small_jitter():
+    for attempt in range(10):
+        delay = ratelimit.backoff_delay(attempt, retry_after=0.01)
+        assert 0.01 <= delay <= 0.01 * (1 + ratelimit.RETRY_AFTER_JITTER)
+    assert ratelimit.backoff_delay(5, retry_after=0) == 0
+
+
+def test_backoff_is_exponential_and_capped_without_retry_after():
+    for attempt in range(12):
+        delays = [ratelimit.backoff_delay(attempt) for _ in range(50)]
+        assert all(0 <= d <= min(ratelimit.BACKOFF_CAP, ratelimit.BACKOFF_BASE * 2 ** attempt) for d in delays)
+    # full jitter: the delays spread over the whole interval
+    assert max(ratelimit.backoff_delay(10) for _ in range(50)) > ratelimit.BACKOFF_CAP / 4
+
+
+def test_parse_retry_after():
+    assert ratelimit.parse_retry_after({}) is None
+    assert ratelimit.parse_retry_after({'retry-after': '2'}) == 2
+    assert ratelimit.parse_retry_after({'retry-after-ms': '250', 'retry-after': '2'}) == 0.25
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < ratelimit.parse_retry_after({'retry-after': date}) <= 30
+
+
+@pytest.mark.parametrize('value, seconds', [('20ms', 0.02), ('1s', 1), ('6m0s', 360), ('1h2m3.5s', 3723.5), ('12', 12)])
+def test_parse_duration(value, seconds):
+    assert ratelimit.parse_duration(value) == pytest.approx(seconds)
+
+
+def test_token_bucket_waits_for_the_refill():
+    bucket = ratelimit.TokenBucket(60)
+    now = bucket.updated
+    assert bucket.reserve(60, now) == 0
+    # one unit per second
+    assert bucket.reserve(2, now) == pytest.approx(2)
+    assert bucket.reserve(0, now + 10) == 0
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_send_retries_rate_limited_requests_and_closes_them():
+    responses = [Response(429, {'Retry-After-Ms': '1'}), Response(429, {'retry-after-ms': '1'}), Response(200)]
+    sent = iter(responses)
+    scheduler = ratelimit.Scheduler()
+    start = time.monotonic()
+    assert scheduler.send('openai', 'gpt-4o', lambda: next(sent)) is responses[2]
+    # the server asked for 1ms, not the exponential backoff
+    assert time.monotonic() - start < 0.5
+    assert [r.closed for r in responses] == [True, True, False]
+
+
+def test_send_gives_up_after_max_retries():
+    scheduler = ratelimit.Scheduler(max_retries=2)
+    calls = []
+
+    def request():
+        calls.append(1)
+        return Response(429, {'retry-after': '0'})
+    with pytest.raises(ratelimit.RateLimitExceeded):
+        scheduler.send('openai', 'gpt-4o', request)
+    assert len(calls) == 3
+
+
+def test_exhausted_budget_blocks_until_reset():
+    scheduler = ratelimit.Scheduler({'openai': {'rpm': 100}})
+    scheduler.update_from_headers('openai', 'gpt-4o', {'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '2s'})
+    assert 1.5 < scheduler.reserve('openai', 'gpt-4o') <= 2
+    # the budgets are per provider/model
+    assert scheduler.reserve('openai', 'gpt-4o-mini') == 0
+
+
+def test_schedulers_are_shared_per_setting():
+    limits = {'rate-limits': {'openai': {'rpm': 10}}}
+    assert ratelimit.get_scheduler(dict(limits, model='a')) is ratelimit.get_scheduler(dict(limits, model='b'))
+    assert ratelimit.get_scheduler(limits) is not ratelimit.get_scheduler({'rate-limits': {'openai': {'rpm': 20}}})
+    assert ratelimit.get_scheduler({'rate-limits': {'openai': {'rpm': 20}}}).limits == {'openai': {'rpm': 20}}
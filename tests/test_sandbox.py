@@ -0,0 +1,67 @@
+import pytest
+
+import sandbox
+
+
+@pytest.fixture(scope='module')
+def box():
+    with sandbox.Sandbox(workers=2, timeout=5, memory=256, cpu_time=1, output=4096) as box:
+        yield box
+
+
+def test_ok_with_stdin_and_args(box):
+    result = box.run('import sys\nprint(input().upper(), sys.argv[1:])', stdin='hello\n', args=['a'])
+    assert result['status'] == 'ok'
+    assert result['returncode'] == 0
+    assert result['stdout'] == "HELLO ['a']\n"
+
+
+def test_error(box):
+    result = box.run('raise ValueError("boom")')
+    assert result['status'] == 'error'
+    assert result['exception'] == 'ValueError'
+    assert 'boom' in result['stderr']
+    assert box.run('import sys\nsys.exit(3)')['returncode'] == 3
+
+
+def test_timeout(box):
+    result = box.run('import time\ntime.sleep(30)', timeout=0.5)
+    assert result['status'] == 'timeout'
+    assert result['duration'] < 5
+
+
+def test_cpu_limit(box):
+    assert box.run('while True:\n    pass')['status'] == 'cpu-limit'
+
+
+def test_memory_limit(box):
+    assert box.run('x = bytearray(1024 * 1024 * 1024)')['status'] == 'memory-limit'
+
+
+def test_output_limit(box):
+    result = box.run('print("x" * 100000)')
+    assert result['status'] == 'output-limit'
+    assert len(result['stdout']) <= 4096
+
+
+def test_environment_is_not_passed(box, monkeypatch):
+    # the workers were started before, their environment is the minimal one
+    monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+    assert box.run('import os\nprint(os.environ.get("OPENAI_API_KEY"))')['stdout'] == 'None\n'
+
+
+def test_programs_run_in_their_own_directory(box):
+    results = box.run_many(['open("f", "w").write("1")\nimport os\nprint(sorted(os.listdir()))'] * 2)
+    assert [r['stdout'] for r in results] == ["['f', 'main.py', 'stderr', 'stdin', 'stdout']\n"] * 2
+
+
+def test_run_many_keeps_the_order(box):
+    results = box.run_many([f'print({i})' for i in range(6)])
+    assert [r['stdout'] for r in results] == [f'{i}\n' for i in range(6)]
+
+
+def test_a_dead_worker_is_restarted(box):
+    # the parent of a program is its worker
+    result = box.run('import os, signal\nos.kill(os.getppid(), signal.SIGKILL)')
+    assert result['status'] == 'crashed'
+    assert box.run('print(1)')['stdout'] == '1\n'
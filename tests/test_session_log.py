@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+import session_log
+
+
+def test_load_session_returns_model_messages_and_usage(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    log = session_log.SessionLog(path, 'gpt-4o')
+    log.append({'role': 'user', 'content': 'hi'})
+    log.append({'role': 'assistant', 'content': 'hello'}, usage={'prompt_tokens': 3, 'completion_tokens': 2}, timings={'total': 0.5})
+    log.append({'role': 'user', 'content': 'again'}, model='gpt-4o-mini')
+    log.append({'role': 'assistant', 'content': 'hello'}, usage={'prompt_tokens': 7, 'completion_tokens': 2})
+    log.close()
+    model, messages, usage = session_log.load_session(path)
+    assert model == 'gpt-4o-mini'
+    assert [m['content'] for m in messages] == ['hi', 'hello', 'again', 'hello']
+    assert usage == {'prompt_tokens': 10, 'completion_tokens': 4}
+
+
+def test_a_truncated_last_line_is_skipped_and_ended(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    log = session_log.SessionLog(path, 'gpt-4o')
+    log.append({'role': 'user', 'content': 'hi'})
+    log.close()
+    # a crash in the middle of a write
+    with open(path, 'a') as f:
+        f.write('{"type": "message", "mess')
+    assert session_log.load_session(path)[1] == [{'role': 'user', 'content': 'hi'}]
+    log = session_log.SessionLog(path, 'gpt-4o')
+    log.append({'role': 'assistant', 'content': 'hello'})
+    log.close()
+    assert [m['content'] for m in session_log.load_session(path)[1]] == ['hi', 'hello']
+
+
+def test_resuming_appends_without_a_new_header(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    session_log.SessionLog(path, 'gpt-4o').close()
+    session_log.SessionLog(path, 'claude-3-haiku').close()
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert records == [{'type': 'session', 'model': 'gpt-4o', 'created': records[0]['created']}]
+
+
+def test_unknown_fsync_policy(tmp_path):
+    with pytest.raises(Exception, match='unknown fsync policy'):
+        session_log.SessionLog(str(tmp_path / 'session.jsonl'), fsync='sometimes')
@@ -0,0 +1,104 @@
+import ast
+
+import pytest
+
+import stockholm_diff
+
+SAME = [
+    ('x = 1\n', 'x = 1  # one\n'),
+    ('def f(a, b):\n    return a+b\n', 'def f(a, b):\n    """Add."""\n    return (a + b)\n'),
+    ('class A:\n    "doc"\n    def f(self): pass\n', 'class A:\n\n    def f(self):\n        pass\n'),
+    ('"module doc"\nimport os\n', 'import os\n'),
+]
+
+DIFFERENT = [
+    ('x = 1\n', 'x = 2\n'),
+    ('x = 1\n', 'x = 1.0\n'),
+    ('x = 1\n', 'x = True\n'),
+    ('x = "a  b"\n', 'x = "a b"\n'),
+    ('if a:\n    f()\ng()\n', 'if a:\n    f()\n    g()\n'),
+    # a string that is not the first statement is code
+    ('def f():\n    x = 1\n    "s"\n', 'def f():\n    x = 1\n'),
+    ('def f(a, b):\n    return a + b\n', 'def f(b, a):\n    return a + b\n'),
+]
+
+
+@pytest.mark.parametrize('before, after', SAME)
+def test_same_behavior(before, after):
+    assert stockholm_diff.same_tree(ast.parse(before), ast.parse(after))
+    assert stockholm_diff.same_behavior(before, after)
+    assert stockholm_diff.diff_python(before, after) == []
+
+
+@pytest.mark.parametrize('before, after', DIFFERENT)
+def test_different_behavior_has_a_diff(before, after):
+    assert not stockholm_diff.same_tree(ast.parse(before), ast.parse(after))
+    assert not stockholm_diff.same_behavior(before, after)
+    assert stockholm_diff.diff_python(before, after) != []
+
+
+def test_diff_python_shows_the_changed_lines():
+    delta = stockholm_diff.diff_python('x = "a  b"\ny = 2\n', 'x = "a b"\ny = 2\n')
+    assert [line for line in delta if line[0] in '+-' and not line.startswith(('---', '+++'))] == ["-x = 'a  b'", "+x = 'a b'"]
+
+
+PROGRAM = '''
+import os
+
+class A:
+    """A class."""
+
+    def f(self):
+        return 1
+
+    @property
+    def p(self):
+        return self._p
+
+    @p.setter
+    def p(self, value):
+        self._p = value
+
+def outer():
+    def inner():
+        return 2
+    return inner()
+'''
+
+
+def test_definition_fingerprints_names_every_definition_in_order():
+    fingerprints = stockholm_diff.definition_fingerprints(ast.parse(PROGRAM))
+    assert list(fingerprints) == ['A', 'A.f', 'A.p', 'A.p#2', 'outer', 'outer.inner', stockholm_diff.MODULE]
+
+
+def test_fingerprints_ignore_docstrings_comments_and_formatting():
+    reformatted = PROGRAM.replace('"""A class."""', '# no docstring').replace('return 1', 'return (1)')
+    assert stockholm_diff.definition_fingerprints(ast.parse(PROGRAM)) == stockholm_diff.definition_fingerprints(ast.parse(reformatted))
+
+
+def test_a_changed_method_changes_its_class_only_through_the_nested_fingerprint():
+    before = stockholm_diff.definition_fingerprints(ast.parse(PROGRAM))
+    after = stockholm_diff.definition_fingerprints(ast.parse(PROGRAM.replace('return 1', 'return 3')))
+    changed = {q for q in before if before[q] != after[q]}
+    assert changed == {'A', 'A.f', stockholm_diff.MODULE}
+    # the own fingerprint of the class covers the names of its methods, not their code
+    assert before['A'][1] == after['A'][1]
+    assert stockholm_diff.diff_definitions(PROGRAM, PROGRAM.replace('return 1', 'return 3')) == {'added': [], 'removed': [], 'changed': ['A.f']}
+
+
+def test_diff_definitions():
+    after = PROGRAM.replace('def inner', 'def renamed').replace('return inner()', 'return renamed()') + '\nx = 1\n'
+    delta = stockholm_diff.diff_definitions(PROGRAM, after)
+    assert delta == {'added': ['outer.renamed'], 'removed': ['outer.inner'], 'changed': ['outer', stockholm_diff.MODULE]}
+    assert stockholm_diff.format_delta(delta) == 'added: outer.renamed; removed: outer.inner; changed: outer, <module>'
+    assert stockholm_diff.diff_definitions(PROGRAM, PROGRAM) == {'added': [], 'removed': [], 'changed': []}
+
+
+def test_fingerprint_tells_constant_types_apart():
+    assert stockholm_diff.fingerprint(ast.parse('x = 1')) != stockholm_diff.fingerprint(ast.parse('x = True'))
+    assert stockholm_diff.fingerprint(ast.parse('x = 1')) == stockholm_diff.fingerprint(ast.parse('x = (1)  # one'))
+
+
+def test_group_equivalent():
+    programs = ['x = 1\n', 'x = 2\n', 'x = 1  # same\n', 'def (\n', 'def (\n', '"""doc"""\nx = 1\n']
+    assert stockholm_diff.group_equivalent(programs) == [[0, 2, 5], [1], [3, 4]]
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+# local token counting with tiktoken, see the tiktok.py experiment
+# the encoders are loaded once per process and model
+# falls back to ~4 characters per token when tiktoken is not installed
+# ./tokens.py <model> <text>
+import functools
+import sys
+
+# tokens added by the chat format, per message and to prime the reply
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=None):
+    """Return the tiktoken encoding of model, or None without tiktoken.
+    Models unknown to tiktoken (claude, gemini, ...) get an approximation with cl100k_base."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except (KeyError, TypeError, AttributeError):
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        # tiktoken downloads the encodings on first use, offline we count approximately
+        print(f'no tiktoken encoding for {model}, counting ~4 characters per token: {e}', file=sys.stderr)
+        return None
+
+
+def count_tokens(text, model=None):
+    """Return the number of tokens of text for model"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model=None):
+    """Return the number of prompt tokens of chat messages for model"""
+    return sum(TOKENS_PER_MESSAGE + count_tokens(m['role'], model) + count_tokens(str(m['content']), model) for m in messages) + TOKENS_PER_REPLY
+
+
+def truncate(text, max_tokens, model=None, keep='end'):
+    """Return text cut to at most max_tokens, keeping its end (or its start)"""
+    if max_tokens <= 0:
+        # text[-0:] would be the whole text
+        return ''
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[-max_tokens * 4:] if keep == 'end' else text[:max_tokens * 4]
+    encoded = encoding.encode(text, disallowed_special=())
+    if len(encoded) <= max_tokens:
+        return text
+    return encoding.decode(encoded[-max_tokens:] if keep == 'end' else encoded[:max_tokens])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('tokens.py <model> <text>', file=sys.stderr)
+        sys.exit(-1)
+    print(count_tokens(sys.argv[2], sys.argv[1]))
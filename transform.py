@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+# transforms many python files with the LLM in one process: comment, header, docstring and refactor
+# the requests of all the files go through one pool of workers and one provider connection (ellm.aget_llm_answers),
+# and each file is written as soon as all its answers have arrived, atomically, to <file><suffix> or in place
+# ./transform.py comment 'src/**/*.py' [--in-place] [--concurrency N]
+# ./transform.py header a.py b.py
+# ./transform.py docstring src/ [--overwrite]
+# ./transform.py refactor --instruction "introduce a main function" a.py
+import asyncio
+import glob
+import os
+import sys
+
+import click
+
+import chunking
+import document_repo
+import ellm
+import fileio
+import stockholm_diff
+import tokens
+
+COMMENT_PROMPT = "comment the following code using inline comments. return one single code block.\n"
+HEADER_PROMPT = "write a header comment for the python file summarizing the program. return only the comment lines in one single code block.\n"
+
+
+def code_metaprompt(prompt):
+    return [
+        {"role": "system", "content": "You are a software developer. You write only code as output, starting with ``` and ending with ```."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def expand(patterns):
+    """Return the files matching the paths, directories (their python files) and globs, each once, in order"""
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, f) for f in document_repo.python_files(pattern)]
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for path in matches:
+            if path not in files:
+                files.append(path)
+    return files
+
+
+def insert_header(source, answer):
+    """Return source with the comment lines of answer after its shebang and encoding lines"""
+    header = ellm.extract_program(answer) or answer
+    header = "".join(line + "\n" if line.startswith("#") or not line.strip() else "# " + line + "\n" for line in header.strip("\n").split("\n"))
+    lines = source.splitlines(keepends=True)
+    first = 0
+    while first < len(lines) and first < 2 and (lines[first].startswith("#!") or "coding" in lines[first] and lines[first].startswith("#")):
+        first += 1
+    return "".join(lines[:first]) + header + "".join(lines[first:])
+
+
+# a planner returns the prompts of a file and the function writing its output from their answers (None when missing),
+# or None when there is nothing to do, the function returns the new program, or None if nothing was written
+
+def plan_comment(path, source, options):
+    """The file is commented chunk by chunk, a chunk whose behavior changed is kept uncommented, see chunking.py"""
+    chunks = chunking.split(source)
+
+    def finish(answers):
+        program, kept = chunking.reassemble(chunks, answers, ellm.extract_program)
+        for index, delta in kept:
+            print(f"{path}: chunk {index} kept as is: " + " ".join(delta)[:200], file=sys.stderr)
+        fileio.write_atomically(options['output'], program)
+        return program
+    return chunking.prompts(chunks, options['instruction'] or COMMENT_PROMPT), finish
+
+
+def plan_header(path, source, options):
+    """Only the header is asked for, a file too large is described by its outline"""
+    described = source if tokens.count_tokens(source) <= chunking.chunk_tokens() else chunking.outline(source)
+
+    def finish(answers):
+        if answers[0] is None:
+            raise Exception('no answer from the provider')
+        program = insert_header(source, answers[0])
+        if not stockholm_diff.same_behavior(source, program):
+            print(f"{path}: behavior has been changed by the LLM!!! " + format_changes(source, program), file=sys.stderr)
+            return None
+        fileio.write_atomically(options['output'], program)
+        return program
+    return [(options['instruction'] or HEADER_PROMPT) + "```python\n" + described + "\n```"], finish
+
+
+def plan_docstring(path, source, options):
+    """One request per definition without docstring (all of them with overwrite), one rewrite of the file with all the answers"""
+    todo = [(qualname, kind, segment) for qualname, kind, segment, _, docstring in document_repo.definitions(source)
+            if docstring is None or options['overwrite']]
+    if not todo:
+        return None
+
+    def finish(answers):
+        docstrings = {qualname: ellm.extract_docstring(answer).strip() for (qualname, _, _), answer in zip(todo, answers) if answer is not None}
+        if not docstrings:
+            raise Exception('no answer from the provider')
+        # replace_docstrings writes the file itself, atomically, and refuses a change of behavior
+        return ellm.replace_docstrings(path, docstrings, output=options['output'])
+    return [ellm.docstring_prompt(segment, kind=kind) for _, kind, segment in todo], finish
+
+
+def plan_refactor(path, source, options):
+    """The whole file is sent with the instruction, the behavior is expected to change and the changed definitions are reported"""
+    def finish(answers):
+        if answers[0] is None:
+            raise Exception('no answer from the provider')
+        program = ellm.extract_program(answers[0])
+        if not program.strip():
+            print(f"{path}: no code in the answer", file=sys.stderr)
+            return None
+        program = program if program.endswith('\n') else program + '\n'
+        print(f"{path}: " + format_changes(source, program), file=sys.stderr)
+        fileio.write_atomically(options['output'], program)
+        return program
+    return [options['instruction'] + "```python\n" + source + "\n```"], finish
+
+
+def format_changes(before, after):
+    try:
+        return stockholm_diff.format_delta(stockholm_diff.diff_definitions(before, after))
+    except SyntaxError as e:
+        return f'does not parse: {e}'
+
+
+async def transform(files, planner, options, metaprompt=code_metaprompt, task='rewrite', concurrency=None):
+    """Send the prompts of all the files concurrently and write each file once it has all its answers.
+    Return the number of files that failed."""
+    jobs = {}
+    failed = 0
+    for path in files:
+        try:
+            with open(path) as f:
+                source = f.read()
+            planned = planner(path, source, {**options, 'output': output_path(path, options)})
+        except (OSError, SyntaxError, UnicodeDecodeError) as e:
+            print(f'{path}: skipped, {e}', file=sys.stderr)
+            failed += 1
+            continue
+        if planned is None:
+            print(f'{path}: nothing to do', file=sys.stderr)
+            continue
+        prompts, finish = planned
+        jobs[path] = {'prompts': prompts, 'answers': [None] * len(prompts), 'pending': len(prompts), 'finish': finish}
+    requests = [(path, i) for path, job in jobs.items() for i in range(len(job['prompts']))]
+    print(f'{len(jobs)} files, {len(requests)} requests', file=sys.stderr)
+
+    def complete(path):
+        nonlocal failed
+        job = jobs[path]
+        try:
+            program = job['finish'](job['answers'])
+        except Exception as e:
+            print(f'{path}: failed, {type(e).__name__}: {e}', file=sys.stderr)
+            program = None
+        if program is None:
+            failed += 1
+            return
+        print(f'{path}: written to {output_path(path, options)}', file=sys.stderr)
+        if options['print']:
+            print(program)
+        # the finish functions keep what they could from the answers, the file is still reported as failed
+        missing = job['answers'].count(None)
+        if missing:
+            print(f'{path}: {missing} of {len(job["answers"])} requests failed', file=sys.stderr)
+            failed += 1
+
+    for path, job in jobs.items():
+        if job['pending'] == 0:
+            complete(path)
+    async for index, answer in ellm.aget_llm_answers([jobs[path]['prompts'][i] for path, i in requests], metaprompt, concurrency, ordered=False, task=task, errors='none'):
+        path, i = requests[index]
+        jobs[path]['answers'][i] = answer
+        jobs[path]['pending'] -= 1
+        if jobs[path]['pending'] == 0:
+            complete(path)
+    return failed
+
+
+def output_path(path, options):
+    return path if options['in_place'] else path + options['suffix']
+
+
+def run(patterns, planner, options, metaprompt=code_metaprompt, task='rewrite'):
+    files = expand(patterns)
+    if not files:
+        raise click.UsageError('no file matches')
+    failed = asyncio.run(transform(files, planner, options, metaprompt, task, options['concurrency']))
+    sys.exit(1 if failed else 0)
+
+
+def common_options(suffix):
+    """The options of every command"""
+    def decorate(command):
+        command = click.argument('patterns', nargs=-1, required=True)(command)
+        command = click.option('--in-place', is_flag=True, help='Overwrite the files instead of writing <file><suffix>')(command)
+        command = click.option('--suffix', default=suffix, show_default=True, help='Suffix of the output files')(command)
+        command = click.option('--concurrency', type=int, default=None, help='Maximum number of requests in flight (default: batch-concurrency)')(command)
+        command = click.option('--print', 'print_', is_flag=True, help='Also print the new programs')(command)
+        return command
+    return decorate
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@common_options('.commented')
+@click.option('--instruction', default=None, help='Instruction sent with each chunk')
+def comment(patterns, in_place, suffix, concurrency, print_, instruction):
+    """Add inline comments, chunk by chunk"""
+    run(patterns, plan_comment, {'in_place': in_place, 'suffix': suffix, 'concurrency': concurrency, 'print': print_, 'instruction': instruction})
+
+
+@main.command()
+@common_options('.commented')
+@click.option('--instruction', default=None, help='Instruction sent with the file')
+def header(patterns, in_place, suffix, concurrency, print_, instruction):
+    """Add a header comment summarizing each file"""
+    run(patterns, plan_header, {'in_place': in_place, 'suffix': suffix, 'concurrency': concurrency, 'print': print_, 'instruction': instruction}, task='header')
+
+
+@main.command()
+@common_options('.documented')
+@click.option('--overwrite', is_flag=True, help='Regenerate the existing docstrings too')
+def docstring(patterns, in_place, suffix, concurrency, print_, overwrite):
+    """Add the missing docstrings of the functions and classes"""
+    run(patterns, plan_docstring, {'in_place': in_place, 'suffix': suffix, 'concurrency': concurrency, 'print': print_, 'overwrite': overwrite},
+        metaprompt=ellm.DEFAULT_META, task='docstring')
+
+
+@main.command()
+@common_options('.refactored')
+@click.option('--instruction', required=True, help='The refactoring, eg "introduce a main function"')
+def refactor(patterns, in_place, suffix, concurrency, print_, instruction):
+    """Apply a refactoring instruction to each file"""
+    run(patterns, plan_refactor, {'in_place': in_place, 'suffix': suffix, 'concurrency': concurrency, 'print': print_, 'instruction': instruction.rstrip() + "\n"})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+# ledger of the tokens and dollars spent, aggregated per day, model and script in SQLite
+# the prompt tokens are estimated locally (tokens.py) before sending and reconciled with
+# the usage reported by the provider, so that a bulk job can be budgeted before launching it
+# ./usage_ledger.py report [day|model|script]
+# ./usage_ledger.py estimate <model> <task> <file>... (task: classify, docstring, rewrite)
+import datetime
+import os
+import sqlite3
+import sys
+import threading
+
+import providers
+import router
+import tokens
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm-usage.sqlite")
+GROUPS = ('day', 'model', 'script')
+
+
+def pricing(model, config=None):
+    """Return {'prompt': $/token, 'completion': $/token} of a model, or None if unknown"""
+    try:
+        return providers.provider_for_model(model, config).capabilities(model).get('pricing')
+    except Exception:
+        return None
+
+
+def cost(model, prompt_tokens, completion_tokens, config=None, cached_tokens=0, cache_write_tokens=0):
+    """Return the cost in $ of a request, or None if the pricing of the model is unknown.
+    cached_tokens and cache_write_tokens are the part of prompt_tokens read from and written to the provider prompt cache."""
+    rates = pricing(model, config)
+    if rates is None:
+        return None
+    uncached = prompt_tokens - cached_tokens - cache_write_tokens
+    return (uncached * rates['prompt'] + cached_tokens * rates.get('cached_prompt', rates['prompt'])
+            + cache_write_tokens * rates.get('cache_write', rates['prompt']) + completion_tokens * rates['completion'])
+
+
+def estimate(prompts, model, metaprompt=lambda x: [{"content": x, "role": "user"}], task=None, config=None):
+    """Return the expected requests, tokens and cost of sending the prompts to model, counted locally"""
+    prompt_tokens = completion_tokens = 0
+    for prompt in prompts:
+        n = tokens.count_message_tokens(metaprompt(prompt), model)
+        prompt_tokens += n
+        completion_tokens += router.TASK_OUTPUT_TOKENS.get(task, router.DEFAULT_OUTPUT_TOKENS) or n
+    return {'requests': len(prompts), 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'cost': cost(model, prompt_tokens, completion_tokens, config)}
+
+
+class Ledger:
+    """SQLite store of the usage, one row per (day, model, script)"""
+
+    def __init__(self, path=DEFAULT_PATH, config=None):
+        self.path = path
+        self.config = config
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # estimated_tokens is the local count of the prompt tokens, to compare with prompt_tokens
+        # unpriced counts the requests to models without known pricing, their cost is not included
+        # cached_tokens and cache_write_tokens are the prompt tokens read from and written to the provider prompt cache
+        self._db.execute('CREATE TABLE IF NOT EXISTS usage (day TEXT, model TEXT, script TEXT, requests INTEGER, '
+                         'estimated_tokens INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL, unpriced INTEGER, '
+                         'cached_tokens INTEGER DEFAULT 0, cache_write_tokens INTEGER DEFAULT 0, '
+                         'PRIMARY KEY (day, model, script))')
+        # ledgers created before the prompt cache was reported
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(usage)')]
+        for column in ('cached_tokens', 'cache_write_tokens'):
+            if column not in columns:
+                self._db.execute(f'ALTER TABLE usage ADD COLUMN {column} INTEGER DEFAULT 0')
+        self._db.commit()
+
+    def record(self, model, estimated_tokens, usage=None, answer=None, script=None):
+        """Add a request, with the usage reported by the provider.
+        Missing counts (eg an interrupted stream) are estimated from the prompt count and the answer."""
+        usage = usage or {}
+        prompt_tokens = usage.get('prompt_tokens', estimated_tokens)
+        completion_tokens = usage.get('completion_tokens')
+        if completion_tokens is None:
+            completion_tokens = tokens.count_tokens(answer, model) if answer else 0
+        cached_tokens = usage.get('cached_tokens', 0)
+        cache_write_tokens = usage.get('cache_write_tokens', 0)
+        dollars = cost(model, prompt_tokens, completion_tokens, self.config, cached_tokens, cache_write_tokens)
+        day = datetime.date.today().isoformat()
+        script = script or os.path.basename(sys.argv[0]) or 'python'
+        with self._lock:
+            self._db.execute('INSERT INTO usage (day, model, script, requests, estimated_tokens, prompt_tokens, completion_tokens, cost, unpriced, cached_tokens, cache_write_tokens) '
+                             'VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(day, model, script) DO UPDATE SET '
+                             'requests=requests+1, estimated_tokens=estimated_tokens+excluded.estimated_tokens, '
+                             'prompt_tokens=prompt_tokens+excluded.prompt_tokens, completion_tokens=completion_tokens+excluded.completion_tokens, '
+                             'cost=cost+excluded.cost, unpriced=unpriced+excluded.unpriced, '
+                             'cached_tokens=cached_tokens+excluded.cached_tokens, cache_write_tokens=cache_write_tokens+excluded.cache_write_tokens',
+                             (day, model, script, estimated_tokens, prompt_tokens, completion_tokens, dollars or 0, int(dollars is None), cached_tokens, cache_write_tokens))
+            self._db.commit()
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'cached_tokens': cached_tokens,
+                'cache_write_tokens': cache_write_tokens, 'cost': dollars}
+
+    def report(self, group='day', since=None):
+        """Return the usage totals per group (day, model or script), since the given ISO day"""
+        if group not in GROUPS:
+            raise Exception(f'unknown group {group}, use one of {", ".join(GROUPS)}')
+        with self._lock:
+            rows = self._db.execute(f'SELECT {group}, SUM(requests), SUM(estimated_tokens), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost), SUM(unpriced), '
+                                    f'SUM(cached_tokens), SUM(cache_write_tokens) FROM usage WHERE day >= ? GROUP BY {group} ORDER BY {group}', (since or '',)).fetchall()
+        keys = (group, 'requests', 'estimated_tokens', 'prompt_tokens', 'completion_tokens', 'cost', 'unpriced', 'cached_tokens', 'cache_write_tokens')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self):
+        self._db.close()
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger(config):
+    """Return the ledger configured by the usage-* keys of config.yaml, or None if 'usage-ledger: false'.
+    Ledgers are cached per config, so that a later config is not served the first one's ledger."""
+    if not config.get('usage-ledger', True):
+        return None
+    key = providers.config_key(config)
+    with _ledgers_lock:
+        if key not in _ledgers:
+            _ledgers[key] = Ledger(config.get('usage-path', DEFAULT_PATH), config)
+        return _ledgers[key]
+
+
+if __name__ == '__main__':
+    import fileio
+    config = fileio.load_config()
+    if len(sys.argv) >= 2 and sys.argv[1] == 'report':
+        group = sys.argv[2] if len(sys.argv) > 2 else 'day'
+        for row in Ledger(config.get('usage-path', DEFAULT_PATH), config).report(group):
+            unpriced = f" ({row['unpriced']} requests without pricing)" if row['unpriced'] else ''
+            error = (row['estimated_tokens'] - row['prompt_tokens']) / max(row['prompt_tokens'], 1)
+            cached = row['cached_tokens'] / max(row['prompt_tokens'], 1)
+            print(f"{row[group]}: {row['requests']} requests, {row['prompt_tokens']} prompt tokens (estimated {error:+.1%}, cached {cached:.0%}), "
+                  f"{row['completion_tokens']} completion tokens, ${row['cost']:.4f}{unpriced}")
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'estimate':
+        model, task = sys.argv[2], sys.argv[3]
+        prompts = []
+        for path in sys.argv[4:]:
+            with open(path) as f:
+                prompts.append(f.read())
+        expected = estimate(prompts, model, task=task, config=config)
+        dollars = 'unknown pricing' if expected['cost'] is None else f"${expected['cost']:.4f}"
+        print(f"{expected['requests']} requests, {expected['prompt_tokens']} prompt tokens, ~{expected['completion_tokens']} completion tokens, {dollars}")
+    else:
+        print('usage_ledger.py report [day|model|script]\nusage_ledger.py estimate <model> <task> <file>...', file=sys.stderr)
+        sys.exit(-1)